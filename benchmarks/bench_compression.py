@@ -0,0 +1,106 @@
+"""Storage benchmark: article bodies as plain text against the CompressedText column type.
+
+Run from the project root:
+
+    python -m benchmarks.bench_compression [--articles N] [--html-bytes N] [--json FILE]
+
+Both variants get the same synthetic cleaned html, written in batches the
+way DatabaseAccess.store_posts writes them, into their own sqlite file with
+nibbler's pragmas. It reports the database size, write throughput, the time
+to read every body back in order (the digest build) and to read bodies one
+by one by post_id (the random access path).
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, event, select
+
+from benchmarks.bench_pipeline import article_html
+from nibbler.nibbler import CompressedText, HTMLNormalizer, NibblerConfig, set_sqlite_pragmas
+
+
+def make_table(column_type):
+    """a table shaped like nibbler_post's body storage"""
+    return Table('nibbler_post', MetaData(),
+                 Column('post_id', Integer, primary_key=True),
+                 Column('article_text', column_type))
+
+
+def measure(work_dir, name, column_type, bodies, batch_size, lookups):
+    """write, scan and look up every body with one column type"""
+    db_file = os.path.join(work_dir, f'{name}.db')
+    engine = create_engine(f'sqlite:///{db_file}')
+    event.listen(engine, 'connect', set_sqlite_pragmas)
+    table = make_table(column_type)
+    table.metadata.create_all(engine)
+
+    start = time.perf_counter()
+    for offset in range(0, len(bodies), batch_size):
+        with engine.begin() as connection:
+            connection.execute(table.insert(), [{'article_text': body} for body in bodies[offset:offset + batch_size]])
+    write_seconds = time.perf_counter() - start
+
+    with engine.begin() as connection:
+        connection.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+    db_bytes = os.path.getsize(db_file)
+
+    start = time.perf_counter()
+    with engine.connect() as connection:
+        read_bytes = sum(len(body) for body in connection.execute(select(table.c.article_text)).scalars())
+    scan_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with engine.connect() as connection:
+        for post_id in lookups:
+            connection.execute(select(table.c.article_text).where(table.c.post_id == post_id)).scalar()
+    lookup_seconds = time.perf_counter() - start
+    engine.dispose()
+
+    body_bytes = sum(len(body.encode('utf-8')) for body in bodies)
+    assert read_bytes == sum(len(body) for body in bodies)
+    return {
+        'db_bytes': db_bytes,
+        'write_mb_per_sec': body_bytes / write_seconds / 1e6,
+        'scan_mb_per_sec': body_bytes / scan_seconds / 1e6,
+        'lookups_per_sec': len(lookups) / lookup_seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark compressed article body storage.')
+    parser.add_argument('--articles', type=int, default=5000, help='number of article bodies')
+    parser.add_argument('--html-bytes', type=int, default=8000, help='approximate size of each body before cleaning')
+    parser.add_argument('--batch-size', type=int, default=500, help='bodies per insert transaction')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the synthetic content')
+    parser.add_argument('--json', metavar='FILE', help='also write the results to this file as json')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    # store what nibbler stores: the html after cleaning
+    normalizer = HTMLNormalizer(NibblerConfig('to@example.com', 'from@example.com', '.'))
+    bodies = [normalizer.normalize(article_html(rng, args.html_bytes), 'https://example.com/a.html')
+              for _ in range(args.articles)]
+    lookups = [rng.randint(1, args.articles) for _ in range(min(args.articles, 2000))]
+
+    results = {'parameters': vars(args), 'body_bytes': sum(len(body.encode('utf-8')) for body in bodies)}
+    with tempfile.TemporaryDirectory() as work_dir:
+        results['plain'] = measure(work_dir, 'plain', String(65535), bodies, args.batch_size, lookups)
+        results['compressed'] = measure(work_dir, 'compressed', CompressedText(65535), bodies, args.batch_size, lookups)
+    results['size_ratio'] = results['compressed']['db_bytes'] / results['plain']['db_bytes']
+
+    for name in ('plain', 'compressed'):
+        result = results[name]
+        print(f"{name:11} {result['db_bytes'] / 1024 / 1024:8.1f} MiB  write {result['write_mb_per_sec']:7.1f} MB/s  "
+              f"scan {result['scan_mb_per_sec']:7.1f} MB/s  {result['lookups_per_sec']:8.0f} lookups/s")
+    print(f"compressed database is {results['size_ratio']:.0%} of the plain one")
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
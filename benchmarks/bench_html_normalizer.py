@@ -0,0 +1,151 @@
+"""Micro-benchmark of HTMLNormalizer: the single pass normalize against the old four parse path.
+
+Run from the project root:
+
+    python -m benchmarks.bench_html_normalizer [--corpus DIR] [--repeat N] [--json FILE]
+
+Every *.html file in the corpus directory is treated as one article body as it
+arrives in a feed. The default corpus holds samples shaped like WordPress,
+Substack, Blogger and Medium feed content; point --corpus at a directory of
+saved feed bodies to measure your own subscriptions.
+"""
+import argparse
+import glob
+import json
+import os
+import time
+import tracemalloc
+
+import lxml.html
+from lxml.html.clean import Cleaner
+
+from nibbler.nibbler import HTMLNormalizer, NibblerConfig
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+LINK = 'https://example.com/2023/05/a-post'
+
+
+def legacy_cleaner():
+    """the Cleaner as HTMLNormalizer configured it before the single pass normalizer, without srcset"""
+    cleaner = Cleaner()
+    cleaner.style = True
+    cleaner.javascript = True
+    cleaner.remove_tags = ['span']
+    cleaner.kill_tags = ['br']
+    return cleaner
+
+
+LEGACY_CLEANER = legacy_cleaner()
+
+
+def legacy_pipeline(normalizer, input_html, link):
+    """the acquisition and newsletter html path before the single pass normalizer"""
+    # clean_html: Cleaner parse/serialize, then a reparse and one xpath scan per attribute
+    cleaner_html = LEGACY_CLEANER.clean_html(input_html)
+    domhtml = lxml.html.fromstring(cleaner_html)
+    for attribute in ['class', 'id', 'style', 'width', 'height', 'border']:
+        for tag in domhtml.xpath(f'//*[@{attribute}]'):
+            tag.attrib.pop(attribute)
+    article = lxml.html.tostring(domhtml).decode("utf-8")
+    # add_full_image_path: another parse/serialize
+    domarticle = lxml.html.fromstring(article.encode("utf-8"))
+    link_prefix = link[0: link.rindex('.') + 4]
+    for img in domarticle.xpath('//img'):
+        if 'http' not in img.attrib['src']:
+            img.attrib['src'] = link_prefix + img.attrib['src']
+    article = lxml.html.tostring(domarticle).decode("utf-8")
+    # add_email_markup: and one more
+    attrs = normalizer.config.get_email_image_styles()
+    domarticle = lxml.html.fromstring(article.encode("utf-8"))
+    for img in domarticle.xpath('//img'):
+        img.attrib['width'] = str(attrs['width'])
+        img.attrib['height'] = str(attrs['height'])
+        img.attrib['border'] = str(attrs['border'])
+    return lxml.html.tostring(domarticle).decode("utf-8")
+
+
+def single_pass(normalizer, input_html, link):
+    """the same work through HTMLNormalizer.normalize"""
+    return normalizer.normalize(input_html, link, email_markup=True)
+
+
+def comparable(output_html):
+    """output_html without the attributes only the single pass handles: it resolves link hrefs
+    and keeps and resolves srcset, the legacy path did neither"""
+    domhtml = lxml.html.fromstring(output_html)
+    for tag in domhtml.iter():
+        if isinstance(tag.tag, str):
+            tag.attrib.pop('href', None)
+            tag.attrib.pop('srcset', None)
+    return lxml.html.tostring(domhtml).decode("utf-8")
+
+
+def measure(func, normalizer, articles, repeat):
+    """time per article and peak python heap use for one pipeline"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for article in articles:
+            func(normalizer, article, LINK)
+    elapsed = time.perf_counter() - start
+
+    # tracemalloc only sees python objects, libxml2's own buffers are not counted
+    tracemalloc.start()
+    for article in articles:
+        func(normalizer, article, LINK)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    count = repeat * len(articles)
+    return {
+        'articles': count,
+        'usec_per_article': elapsed / count * 1e6,
+        'peak_traced_bytes': peak,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the HTMLNormalizer pipelines.')
+    parser.add_argument('--corpus', default=CORPUS_DIR, help='directory of *.html article bodies')
+    parser.add_argument('--repeat', type=int, default=200, help='passes over the corpus per pipeline')
+    parser.add_argument('--json', metavar='FILE', help='also write the results to this file as json')
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.corpus, '*.html')))
+    articles = []
+    for path in paths:
+        with open(path, encoding='utf-8') as corpus_file:
+            articles.append(corpus_file.read())
+    if not articles:
+        parser.error(f'no *.html files in {args.corpus}')
+
+    normalizer = HTMLNormalizer(NibblerConfig('to@example.com', 'from@example.com', args.corpus))
+    differing = [os.path.basename(path) for path, article in zip(paths, articles)
+                 if comparable(legacy_pipeline(normalizer, article, LINK))
+                 != comparable(single_pass(normalizer, article, LINK))]
+    mismatches = len(differing)
+
+    results = {
+        'corpus_files': len(articles),
+        'corpus_bytes': sum(len(article) for article in articles),
+        'output_mismatches': mismatches,
+        'legacy': measure(legacy_pipeline, normalizer, articles, args.repeat),
+        'single_pass': measure(single_pass, normalizer, articles, args.repeat),
+    }
+    results['speedup'] = results['legacy']['usec_per_article'] / results['single_pass']['usec_per_article']
+
+    for name in ('legacy', 'single_pass'):
+        result = results[name]
+        print(f"{name:12} {result['usec_per_article']:9.1f} us/article  "
+              f"peak {result['peak_traced_bytes'] / 1024:8.1f} KiB traced")
+    print(f"speedup {results['speedup']:.2f}x, {mismatches} of {len(articles)} outputs differ "
+          "(ignoring href and srcset, which only the single pass resolves)")
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+    if differing:
+        # the timings only compare like with like when both paths produce the same html
+        parser.exit(1, f"outputs differ for: {', '.join(differing)}\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Startup benchmark: what a fresh nibbler process pays before it does any work.
+
+Run from the project root:
+
+    python -m benchmarks.bench_import [--repeat N] [--json FILE]
+
+Every measurement starts a new interpreter, since imports are only slow the
+first time. It times `nibbler --version`, importing nibbler.nibbler, each
+heavy dependency on its own, and loading the newsletter template with an
+empty and with a filled jinja2 bytecode cache.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+COMMANDS = {
+    'version': ['-m', 'nibbler', '--version'],
+    'import_nibbler': ['-c', 'import nibbler.nibbler'],
+    'import_sqlalchemy_orm': ['-c', 'import sqlalchemy.orm'],
+    'import_feedparser': ['-c', 'import feedparser'],
+    'import_jinja2': ['-c', 'import jinja2'],
+    'import_lxml_clean': ['-c', 'import lxml.html.clean'],
+    'import_smtplib_email': ['-c', 'import smtplib, email.mime.multipart, email.mime.text, email.mime.image'],
+}
+
+LOAD_TEMPLATE = ('import sys, time; from nibbler.nibbler import template_environment; '
+                 'start = time.perf_counter(); template_environment(sys.argv[1]).get_template("nibble.html"); '
+                 'print(time.perf_counter() - start)')
+
+
+def wall_ms(args, repeat):
+    """median wall clock of running the interpreter with args"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, check=True, stdout=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def template_ms(bytecode_dir):
+    """time to load the newsletter template in a fresh process"""
+    output = subprocess.run([sys.executable, '-c', LOAD_TEMPLATE, bytecode_dir],
+                            check=True, capture_output=True, text=True).stdout
+    return float(output) * 1000
+
+
+def slowest_imports(module, count=10):
+    """the modules with the largest cumulative import time under python -X importtime"""
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            check=True, capture_output=True, text=True).stderr
+    imports = []
+    for line in stderr.splitlines()[1:]:
+        _, cumulative, name = line.split('|')
+        imports.append((int(cumulative), name.strip()))
+    return [{'module': name, 'cumulative_ms': cumulative / 1000} for cumulative, name in sorted(imports)[-count:]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the startup cost of nibbler.')
+    parser.add_argument('--repeat', type=int, default=10, help='fresh processes per measurement')
+    parser.add_argument('--json', metavar='FILE', help='also write the results to this file as json')
+    args = parser.parse_args()
+
+    results = {'python': sys.version.split()[0]}
+    results['wall_ms'] = {name: wall_ms(command, args.repeat) for name, command in COMMANDS.items()}
+    with tempfile.TemporaryDirectory() as bytecode_dir:
+        results['template_cold_ms'] = template_ms(bytecode_dir)
+        results['template_warm_ms'] = statistics.median(template_ms(bytecode_dir) for _ in range(args.repeat))
+    results['slowest_imports'] = slowest_imports('nibbler.nibbler')
+
+    for name, milliseconds in results['wall_ms'].items():
+        print(f"{name:24} {milliseconds:8.1f} ms")
+    print(f"{'template, cold cache':24} {results['template_cold_ms']:8.1f} ms")
+    print(f"{'template, warm cache':24} {results['template_warm_ms']:8.1f} ms")
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
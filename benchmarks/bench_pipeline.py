@@ -0,0 +1,222 @@
+"""End to end benchmark: acquisition, html normalization and the digest build on synthetic feeds.
+
+Run from the project root:
+
+    python -m benchmarks.bench_pipeline [--feeds N] [--entries N] [--html-bytes N]
+                                        [--duplicate-ratio R] [--workers N] [--json FILE]
+
+The feeds are generated and served by a stand-in http server on localhost, so
+the numbers cover nibbler's own work and not the internet. Acquisition runs
+twice against a fresh database: a cold pass where every post is new, then an
+incremental pass where --duplicate-ratio of each feed's entries were already
+stored, which is what a nightly run mostly sees. Results are printed and can
+be written as json to compare across releases.
+"""
+import argparse
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+from xml.sax.saxutils import escape
+
+from sqlalchemy import text
+
+from nibbler.nibbler import DatabaseAccess, FeedAcquirer, HTMLNormalizer, NibblerConfig, NibblerNewsletter
+
+WORDS = ('feed digest nibble article reader lorem ipsum server markup python image link cache '
+         'morning letter wire story update column ').split()
+
+
+def article_html(rng, size):
+    """roughly size bytes of the markup feeds carry: styled paragraphs, links, images and a script"""
+    parts = ['<div class="entry-content" style="margin:0">']
+    length = len(parts[0])
+    while length < size:
+        words = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(20, 60)))
+        choice = rng.random()
+        if choice < 0.15:
+            part = f'<p><img src="/uploads/{rng.randint(1, 9999)}.jpg" width="640" height="480" class="wp-image"></p>'
+        elif choice < 0.2:
+            part = f'<script>track({rng.randint(1, 9999)})</script>'
+        elif choice < 0.4:
+            part = f'<p id="p{length}">{words} <a href="https://example.com/{rng.randint(1, 9999)}" style="color:red">more</a></p>'
+        else:
+            part = f'<p>{words}</p>'
+        parts.append(part)
+        length += len(part)
+    parts.append('</div>')
+    return ''.join(parts)
+
+
+def generate_feed(rng, feed_number, generation, entries, html_bytes, duplicate_ratio):
+    """rss for one feed; in generation 1 duplicate_ratio of the entries are carried over from generation 0"""
+    carried = round(entries * duplicate_ratio) if generation else 0
+    items = []
+    for number in range(entries):
+        item_generation = generation - 1 if number < carried else generation
+        guid = f'urn:bench:{feed_number}:{item_generation}:{number}'
+        link = f'https://feed{feed_number}.example.com/{item_generation}/{number}.html'
+        items.append(f'<item><title>Post {number} of feed {feed_number}</title><link>{link}</link>'
+                     f'<guid>{guid}</guid><pubDate>Mon, 01 May 2023 06:00:00 GMT</pubDate>'
+                     f'<description>{escape(article_html(rng, html_bytes))}</description></item>')
+    return (f'<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>'
+            f'<title>Feed {feed_number}</title><link>https://feed{feed_number}.example.com/</link>'
+            f'{"".join(items)}</channel></rss>').encode('utf-8')
+
+
+class FeedServer():
+    """stand-in http server serving the current generation of every synthetic feed at /feed/<n>.xml"""
+
+    def __init__(self):
+        self.bodies = {}
+        bodies = self.bodies
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = bodies.get(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/rss+xml; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def url(self, feed_number):
+        return f'http://127.0.0.1:{self.server.server_port}/feed/{feed_number}.xml'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def write_subscriptions(sub_dir, server, feeds):
+    """an opml file subscribing to every synthetic feed"""
+    outlines = ''.join(f'<outline text="Feed {number}" type="rss" xmlUrl="{escape(server.url(number))}"/>'
+                       for number in range(feeds))
+    with open(os.path.join(sub_dir, 'subscriptions.xml'), 'w', encoding='utf-8') as opml_file:
+        opml_file.write(f'<?xml version="1.0"?><opml version="2.0"><body>{outlines}</body></opml>')
+
+
+def peak_rss_kib():
+    """the high water mark of this process's resident memory so far"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def db_bytes(dal, db_file):
+    """size of the database once the write ahead log is folded back in"""
+    dal.session.execute(text('PRAGMA wal_checkpoint(TRUNCATE)'))
+    return sum(os.path.getsize(path) for path in (db_file, db_file + '-wal') if os.path.exists(path))
+
+
+def acquire(acquirer, dal):
+    """one acquisition pass over every subscribed feed"""
+    feeds = dal.fetchable_feeds(datetime.now()).all()
+    start = time.perf_counter()
+    stored = acquirer.acquire_feeds(feeds)
+    elapsed = time.perf_counter() - start
+    articles = sum(len(guids) for guids in stored.values())
+    return {
+        'seconds': elapsed,
+        'feeds': len(feeds),
+        'new_articles': articles,
+        'feeds_per_sec': len(feeds) / elapsed,
+        'articles_per_sec': articles / elapsed,
+        'peak_rss_kib': peak_rss_kib(),
+    }
+
+
+def normalize(config, rng, count, html_bytes):
+    """HTMLNormalizer on its own, without the fetch and database around it"""
+    normalizer = HTMLNormalizer(config)
+    bodies = [article_html(rng, html_bytes) for _ in range(count)]
+    start = time.perf_counter()
+    for body in bodies:
+        normalizer.normalize(body, 'https://feed0.example.com/0/0.html')
+    elapsed = time.perf_counter() - start
+    return {'seconds': elapsed, 'articles': count, 'articles_per_sec': count / elapsed,
+            'peak_rss_kib': peak_rss_kib()}
+
+
+def digest(config, dal, work_dir):
+    """stream the newsletter for everything queued to a file"""
+    newsletter = NibblerNewsletter(dal, config)
+    post_ids = dal.pending_post_ids()
+    filename = os.path.join(work_dir, 'digest.eml')
+    start = time.perf_counter()
+    newsletter.write_nibbler_newsletter(newsletter.email_articles(post_ids), filename)
+    elapsed = time.perf_counter() - start
+    return {'seconds': elapsed, 'articles': len(post_ids), 'articles_per_sec': len(post_ids) / elapsed,
+            'email_bytes': os.path.getsize(filename), 'peak_rss_kib': peak_rss_kib()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark acquisition, normalization and the digest build.')
+    parser.add_argument('--feeds', type=int, default=50, help='number of synthetic feeds')
+    parser.add_argument('--entries', type=int, default=20, help='entries in each feed')
+    parser.add_argument('--html-bytes', type=int, default=4000, help='approximate size of each entry body')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.8,
+                        help='share of each feed already stored when the incremental pass runs')
+    parser.add_argument('--workers', type=int, default=8, help='feeds fetched concurrently')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the synthetic content')
+    parser.add_argument('--json', metavar='FILE', help='also write the results to this file as json')
+    args = parser.parse_args()
+    if not 0 <= args.duplicate_ratio <= 1:
+        parser.error('--duplicate-ratio must be between 0 and 1')
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as work_dir, FeedServer() as server:
+        write_subscriptions(work_dir, server, args.feeds)
+        # every feed lives on localhost, so the per host limit would otherwise serialize the run
+        config = NibblerConfig('to@example.com', 'from@example.com', work_dir, db_dir=work_dir,
+                               email_dir=work_dir, max_workers=args.workers, per_host_limit=args.workers)
+        db_file = os.path.join(work_dir, 'nibbler.db')
+        dal = DatabaseAccess(config.get_database_connection(), config.get_db_batch_size())
+        acquirer = FeedAcquirer(dal, config)
+        acquirer.load_new_feeds()
+
+        results = {'parameters': vars(args)}
+        results['generate_seconds'] = 0.0
+        for generation, name in enumerate(('acquire_cold', 'acquire_incremental')):
+            start = time.perf_counter()
+            for number in range(args.feeds):
+                server.bodies[f'/feed/{number}.xml'] = generate_feed(rng, number, generation, args.entries,
+                                                                     args.html_bytes, args.duplicate_ratio)
+            results['generate_seconds'] += time.perf_counter() - start
+            results[name] = acquire(acquirer, dal)
+        results['feed_bytes'] = sum(len(body) for body in server.bodies.values())
+        results['normalize'] = normalize(config, rng, args.entries * 5, args.html_bytes)
+        results['digest'] = digest(config, dal, work_dir)
+        results['db_bytes'] = db_bytes(dal, db_file)
+        results['peak_rss_kib'] = peak_rss_kib()
+
+    for name in ('acquire_cold', 'acquire_incremental'):
+        result = results[name]
+        print(f"{name:20} {result['feeds_per_sec']:9.1f} feeds/s {result['articles_per_sec']:9.1f} articles/s "
+              f"({result['new_articles']} new)")
+    for name in ('normalize', 'digest'):
+        print(f"{name:20} {results[name]['articles_per_sec']:9.1f} articles/s")
+    print(f"database {results['db_bytes'] / 1024:.0f} KiB, peak rss {results['peak_rss_kib'] / 1024:.1f} MiB")
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,5 @@
 import argparse
 
-from nibbler.nibbler import run_nibbler
-
 
 def main():
     parser = argparse.ArgumentParser(prog='nibbler', description='A simple RSS to email application.')
@@ -12,10 +10,48 @@ def main():
     parser.add_argument('-s', '--smtp-ini', metavar='smtp_ini', help='optional path to smtp ini file')
     parser.add_argument('-d', '--db-dir', metavar='db_dir', help='optional path to sqlite db dir')
     parser.add_argument('-e', '--email-dir', metavar='email_dir', help='optional path to directory where email file is output before sending')
+    parser.add_argument('-w', '--max-workers', metavar='max_workers', type=int, help='optional number of feeds fetched concurrently; default 8')
+    parser.add_argument('--per-host-limit', metavar='per_host_limit', type=int, help='optional number of concurrent fetches per host; default 2')
+    parser.add_argument('--feed-timeout', metavar='feed_timeout', type=float, help='optional seconds a feed download may take in all before it is abandoned; default 30')
+    parser.add_argument('--feed-max-mb', metavar='feed_max_mb', type=int, help='optional size in MB a feed download may grow to after decompression before it is abandoned; default 16')
+    parser.add_argument('--db-batch-size', metavar='db_batch_size', type=int, help='optional number of new posts written per database transaction; default 500')
+    parser.add_argument('-p', '--clean-processes', metavar='clean_processes', type=int, help='optional number of processes cleaning html for large backfills; default 1')
+    parser.add_argument('--clean-threshold', metavar='clean_threshold', type=int, help='optional smallest batch of new posts cleaned in other processes; default 50')
+    parser.add_argument('-m', '--mode', metavar='mode', choices=['all', 'acquire', 'digest', 'serve', 'report', 'compact'], help='optional step to run: acquire only stores new posts, digest only sends the queued ones, serve keeps running and polls each feed on its own schedule, report lists failing and quarantined feeds, compact prunes old posts and vacuums the database; default all')
+    parser.add_argument('--poll-min-minutes', metavar='poll_min_minutes', type=int, help='optional shortest time between polls of one feed in serve mode; default 15')
+    parser.add_argument('--poll-max-minutes', metavar='poll_max_minutes', type=int, help='optional longest time between polls of one feed in serve mode; default 1440')
+    parser.add_argument('--digest-hour', metavar='digest_hour', type=int, choices=range(24), help='optional hour of the day the newsletter is built in serve mode; default 6')
+    parser.add_argument('--quarantine-after', metavar='quarantine_after', type=int, help='optional failures in a row before a feed is no longer fetched; default 10')
+    parser.add_argument('--cache-dir', metavar='cache_dir', help='optional path to a directory where raw feed downloads are cached')
+    parser.add_argument('--cache-max-mb', metavar='cache_max_mb', type=int, help='optional size the feed cache is trimmed to; default 512')
+    parser.add_argument('--cache-max-days', metavar='cache_max_days', type=int, help='optional days a cached feed download is kept; default 30')
+    parser.add_argument('--replay', action='store_true', help='parse feeds from the cache instead of the network')
+    parser.add_argument('--log-level', metavar='log_level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help='optional lowest level written to the log; default INFO')
+    parser.add_argument('--metrics-file', metavar='metrics_file', help='optional file the timings of each stage are written to, prometheus text when it ends in .prom, json otherwise')
+    parser.add_argument('--retention-days', metavar='retention_days', type=int, help='optional days a post keeps its content before compaction prunes it; default forever')
+    parser.add_argument('--retention-count', metavar='retention_count', type=int, help='optional newest posts of each feed that keep their content when compacting; default all')
+    parser.add_argument('--retention-ini', metavar='retention_ini', help='optional path to an ini file with retention limits for single feeds')
+    parser.add_argument('--subscribers-ini', metavar='subscribers_ini', help='optional path to an ini file of more subscribers, each with their own email and subscriptions.xml')
+    parser.add_argument('--smtp-connections', metavar='smtp_connections', type=int, help='optional number of smtp connections newsletters are sent over concurrently; default 2')
+    parser.add_argument('--smtp-rate', metavar='smtp_rate', type=float, help='optional most messages sent per second; default no limit')
+    parser.add_argument('--outbox-dir', metavar='outbox_dir', help='optional path to a directory where unsent messages wait and are retried by later runs')
+    parser.add_argument('--image-mode', metavar='image_mode', choices=['inline', 'static'], help='optional way to send article images from the cache instead of linking the originals: inline attaches them to the email, static copies them to --image-static-dir; needs --cache-dir')
+    parser.add_argument('--image-static-dir', metavar='image_static_dir', help='optional path to the directory images are copied to in static image mode')
+    parser.add_argument('--image-static-url', metavar='image_static_url', help='optional url at which --image-static-dir is served')
+    parser.add_argument('--image-workers', metavar='image_workers', type=int, help='optional number of images downloaded concurrently; default 8')
+    parser.add_argument('--image-cache-mb', metavar='image_cache_mb', type=int, help='optional size the image cache is trimmed to; default 256')
     parser.add_argument('-v', '--version', action='version', version='%(prog)s 0.3')
 
     args = parser.parse_args()
+    if args.replay and args.cache_dir is None:
+        parser.error('--replay needs --cache-dir')
+    if args.image_mode is not None and args.cache_dir is None:
+        parser.error('--image-mode needs --cache-dir')
+    if args.image_mode == 'static' and (args.image_static_dir is None or args.image_static_url is None):
+        parser.error('--image-mode static needs --image-static-dir and --image-static-url')
 
+    # imported only once the arguments are good, so --help, --version and usage errors return at once
+    from nibbler.nibbler import run_nibbler
     run_nibbler(args)
 
 
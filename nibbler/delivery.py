@@ -0,0 +1,290 @@
+"""Delivers newsletter files over a small pool of reused SMTP connections, with an optional on-disk outbox."""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import queue
+import shutil
+import smtplib
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+def send_file(server, sender, recipient, filename):
+    """MAIL, RCPT and DATA for a message file; smtplib.sendmail would need it all in memory
+    when the server supports PIPELINING the three commands go out in a single write"""
+    if server.has_extn('pipelining'):
+        server.send(f'MAIL FROM:{smtplib.quoteaddr(sender)}\r\n'
+                    f'RCPT TO:{smtplib.quoteaddr(recipient)}\r\n'
+                    'DATA\r\n')
+        replies = [server.getreply() for _ in range(3)]
+    else:
+        replies = [server.mail(sender)]
+        replies.append(server.rcpt(recipient) if replies[0][0] == 250 else (503, b'no sender'))
+        if replies[1][0] in (250, 251):
+            server.putcmd("data")
+            replies.append(server.getreply())
+        else:
+            replies.append((503, b'no recipient'))
+    (mail_code, mail_response), (rcpt_code, rcpt_response), (data_code, data_response) = replies
+    if mail_code != 250:
+        raise smtplib.SMTPSenderRefused(mail_code, mail_response, sender)
+    if rcpt_code not in (250, 251):
+        raise smtplib.SMTPRecipientsRefused({recipient: (rcpt_code, rcpt_response)})
+    if data_code != 354:
+        raise smtplib.SMTPDataError(data_code, data_response)
+    block = bytearray()
+    with open(filename, "rb") as message_file:
+        for line in message_file:
+            line = line.rstrip(b'\r\n')
+            if line.startswith(b'.'):
+                line = b'.' + line  # dot-stuffing, RFC 5321 4.5.2
+            block += line + b'\r\n'
+            if len(block) >= 65536:
+                server.send(bytes(block))
+                block.clear()
+    block += b'.\r\n'
+    server.send(bytes(block))
+    code, response = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, response)
+
+
+class SmtpConnectionPool():
+    """ Authenticated SMTP connections that stay open between messages
+
+    EHLO, STARTTLS and login happen once per connection instead of once per message.
+    A connection that fails is dropped and the next message opens a fresh one. """
+
+    def __init__(self, host, port, username=None, password=None, starttls=True, size=2, timeout=60):
+        self.host = host
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.connects = 0
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        logger.info("Connecting to smtp server %s:%s.", self.host, self.port)
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            server.ehlo()
+            if self.starttls:
+                server.starttls()
+                # stmplib docs recommend calling ehlo() before & after starttls()
+                server.ehlo()
+            if self.username:
+                server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+        self.connects += 1
+        return server
+
+    @contextmanager
+    def connection(self):
+        """ an open connection for one message, reused afterwards unless the message broke it """
+        with self._slots:
+            try:
+                server = self._idle.get_nowait()
+            except queue.Empty:
+                server = self._connect()
+            try:
+                yield server
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+                # the server refused this message, the connection itself is fine once reset
+                try:
+                    server.rset()
+                except (smtplib.SMTPException, OSError):
+                    server.close()
+                else:
+                    self._idle.put(server)
+                raise
+            except BaseException:
+                server.close()
+                raise
+            self._idle.put(server)
+
+    def close(self):
+        """ QUIT every idle connection """
+        while True:
+            try:
+                server = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                server.close()
+
+
+class Throttle():
+    """ Spaces calls out to at most rate per second across every thread, None for no limit """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Outbox():
+    """ Messages waiting for delivery, kept on disk until the server takes them
+
+    each message is <id>.eml with an <id>.json beside it holding the envelope and retry state;
+    messages that keep failing past max_attempts move to dead/ for a person to look at """
+
+    def __init__(self, outbox_dir, max_attempts=5, retry_base=timedelta(minutes=5)):
+        self.outbox_dir = outbox_dir
+        self.dead_dir = os.path.join(outbox_dir, 'dead')
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        os.makedirs(self.dead_dir, exist_ok=True)
+
+    def _path(self, message_id, extension):
+        return os.path.join(self.outbox_dir, f'{message_id}.{extension}')
+
+    def _write_state(self, state):
+        temp_path = self._path(state['id'], 'json.tmp')
+        with open(temp_path, 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(temp_path, self._path(state['id'], 'json'))
+
+    def add(self, sender, recipient, filename):
+        """ copy a message file into the outbox, returns its id """
+        message_id = f'{time.time_ns()}-{uuid.uuid4().hex[:8]}'
+        shutil.copyfile(filename, self._path(message_id, 'eml.tmp'))
+        os.replace(self._path(message_id, 'eml.tmp'), self._path(message_id, 'eml'))
+        # the state file is written last, a message without one is not picked up
+        self._write_state({'id': message_id, 'sender': sender, 'recipient': recipient, 'attempts': 0,
+                           'next_attempt': None, 'last_error': None})
+        return message_id
+
+    def pending(self, now=None):
+        """ the state of every message due for a delivery attempt, oldest first """
+        now = (now or datetime.now()).isoformat()
+        due = []
+        for name in sorted(os.listdir(self.outbox_dir)):
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(self.outbox_dir, name)) as state_file:
+                state = json.load(state_file)
+            if state['next_attempt'] is None or state['next_attempt'] <= now:
+                due.append(state)
+        return due
+
+    def message_file(self, state):
+        return self._path(state['id'], 'eml')
+
+    def delivered(self, state):
+        os.remove(self._path(state['id'], 'eml'))
+        os.remove(self._path(state['id'], 'json'))
+
+    def failed(self, state, error, now=None):
+        """ schedule another attempt, doubling the wait each time, or give up on the message """
+        state['attempts'] += 1
+        state['last_error'] = str(error)
+        if state['attempts'] >= self.max_attempts:
+            logger.error("Giving up on the message to %s after %s attempts: %s",
+                         state['recipient'], state['attempts'], error)
+            self._write_state(state)
+            for extension in ('eml', 'json'):
+                os.replace(self._path(state['id'], extension),
+                           os.path.join(self.dead_dir, f"{state['id']}.{extension}"))
+            return
+        retry = (now or datetime.now()) + self.retry_base * 2 ** (state['attempts'] - 1)
+        state['next_attempt'] = retry.isoformat()
+        logger.warning("Message to %s failed, retrying after %s: %s", state['recipient'], retry, error)
+        self._write_state(state)
+
+
+class DeliveryService():
+    """ Sends message files concurrently over an SmtpConnectionPool at a throttled rate
+
+    with an outbox a message is handed over as soon as it is on disk there, and failures are
+    retried by later runs; without one, deliver reports which messages the server took """
+
+    def __init__(self, smtp_config, connections=2, rate=None, outbox_dir=None, timeout=60):
+        self.pool = SmtpConnectionPool(smtp_config['host'], smtp_config['port'], smtp_config.get('username'),
+                                       smtp_config.get('password'), smtp_config.get('starttls', True),
+                                       size=connections, timeout=timeout)
+        self.connections = connections
+        self.throttle = Throttle(rate)
+        self.outbox = Outbox(outbox_dir) if outbox_dir is not None else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+
+    def send(self, sender, recipient, filename):
+        """ send one message file, retrying once on a fresh connection if a reused one has gone away """
+        for attempt in (1, 2):
+            self.throttle.wait()
+            try:
+                with self.pool.connection() as server:
+                    send_file(server, sender, recipient, filename)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                if attempt == 2:
+                    raise
+                logger.info("Smtp connection was lost, reconnecting.")
+                continue
+            logger.info("Send email message to: %s", recipient)
+            return
+
+    def _try_send(self, sender, recipient, filename):
+        try:
+            self.send(sender, recipient, filename)
+        except Exception as e:
+            logger.error("Sending the message to %s failed with %s: %s", recipient, type(e).__name__, e)
+            return e
+        return None
+
+    def deliver(self, messages):
+        """ send a list of (sender, recipient, filename), returns a list of booleans in the same order:
+        whether the server took each message, or with an outbox whether it is safely queued there """
+        if self.outbox is None:
+            with ThreadPoolExecutor(max_workers=self.connections) as executor:
+                errors = list(executor.map(lambda message: self._try_send(*message), messages))
+            return [error is None for error in errors]
+        for sender, recipient, filename in messages:
+            self.outbox.add(sender, recipient, filename)
+        self.flush()
+        return [True] * len(messages)
+
+    def flush(self, now=None):
+        """ try every message in the outbox that is due, returns how many were delivered """
+        due = self.outbox.pending(now)
+        if not due:
+            return 0
+        logger.info("Delivering %s messages from the outbox.", len(due))
+        with ThreadPoolExecutor(max_workers=self.connections) as executor:
+            errors = list(executor.map(lambda state: self._try_send(state['sender'], state['recipient'],
+                                                                    self.outbox.message_file(state)), due))
+        for state, error in zip(due, errors):
+            if error is None:
+                self.outbox.delivered(state)
+            else:
+                self.outbox.failed(state, error, now)
+        return errors.count(None)
@@ -0,0 +1,95 @@
+"""On-disk cache of raw feed downloads, for replaying acquisition without the network."""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class FeedCache():
+    """ Content addressed store of raw feed bodies
+
+    bodies/ab/abcd... holds each distinct body once, named by its sha256
+    urls/<sha256 of url>.json points a feed url at the body it last returned,
+    together with the response headers feedparser needs to parse it again """
+
+    def __init__(self, cache_dir, max_bytes=None, max_age=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age  # seconds
+        self.body_dir = os.path.join(cache_dir, 'bodies')
+        self.url_dir = os.path.join(cache_dir, 'urls')
+        os.makedirs(self.body_dir, exist_ok=True)
+        os.makedirs(self.url_dir, exist_ok=True)
+
+    def _body_path(self, digest):
+        return os.path.join(self.body_dir, digest[:2], digest)
+
+    def _url_path(self, url):
+        return os.path.join(self.url_dir, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+    def _write_atomic(self, path, data):
+        """ write to a temp file and rename, so readers never see half a file """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(handle, 'wb') as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+
+    def store(self, url, body, headers):
+        """ remember body as the latest response for url, returns the body's sha256 """
+        digest = hashlib.sha256(body).hexdigest()
+        body_path = self._body_path(digest)
+        if os.path.exists(body_path):
+            os.utime(body_path)  # an unchanged feed keeps its body fresh for eviction
+        else:
+            self._write_atomic(body_path, body)
+        entry = {'url': url, 'sha256': digest, 'headers': headers, 'stored_at': time.time()}
+        self._write_atomic(self._url_path(url), json.dumps(entry).encode('utf-8'))
+        return digest
+
+    def load(self, url):
+        """ the latest (body, headers) stored for url, or None """
+        try:
+            with open(self._url_path(url), 'rb') as entry_file:
+                entry = json.load(entry_file)
+            body_path = self._body_path(entry['sha256'])
+            with open(body_path, 'rb') as body_file:
+                body = body_file.read()
+        except (OSError, ValueError, KeyError):
+            return None
+        os.utime(body_path)
+        return body, entry['headers']
+
+    def evict(self):
+        """ drop bodies older than max_age, then the least recently used ones until
+        the cache fits in max_bytes; returns the number of bytes freed """
+        bodies = []
+        for root, _, names in os.walk(self.body_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                bodies.append((stat.st_mtime, stat.st_size, path))
+        bodies.sort()
+        total = sum(size for _, size, _ in bodies)
+        cutoff = time.time() - self.max_age if self.max_age is not None else None
+        freed = 0
+        for mtime, size, path in bodies:
+            too_old = cutoff is not None and mtime < cutoff
+            too_big = self.max_bytes is not None and total > self.max_bytes
+            if not too_old and not too_big:
+                break
+            os.remove(path)
+            total -= size
+            freed += size
+        if cutoff is not None:
+            for name in os.listdir(self.url_dir):
+                path = os.path.join(self.url_dir, name)
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+        if freed:
+            logger.info("Evicted %s bytes from the feed cache.", freed)
+        return freed
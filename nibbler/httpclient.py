@@ -0,0 +1,216 @@
+"""Keep-alive http connections shared by the feed download threads."""
+import base64
+import http.client
+import logging
+import threading
+import time
+import urllib.error
+from urllib.parse import quote, urljoin, urlsplit
+import zlib
+
+logger = logging.getLogger(__name__)
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+# what a reused connection raises when the server closed it while it sat idle
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                           ConnectionResetError, BrokenPipeError)
+
+
+class ResponseTooLarge(ValueError):
+    """ the response, after decompression, is bigger than the pool's max_bytes """
+
+
+class HttpConnectionPool():
+    """ Reuses http(s) connections between requests to the same host
+
+    Many feeds live on a few hosts, so keeping the connection open skips the DNS lookup,
+    TCP and TLS setup for every feed after the first. Bodies are requested compressed,
+    decompressed as they arrive and cut off at max_bytes.
+
+    timeout bounds a whole get, redirects included, not just each socket operation,
+    so a server trickling out a byte at a time cannot hold a download thread forever.
+
+    get has the signature and result of feedparser.http.get, so its result can go
+    straight to feedparser. Every failure is raised as a urllib.error.URLError, like
+    feedparser's own download. Proxies are not supported. """
+
+    def __init__(self, timeout=30, max_idle_per_host=2, max_bytes=16 * 1024 * 1024, max_redirects=5):
+        self.timeout = timeout
+        self.max_idle_per_host = max_idle_per_host
+        self.max_bytes = max_bytes
+        self.max_redirects = max_redirects
+        self.connects = 0
+        self.requests = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._ssl_context = None
+
+    def _connect(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            if self._ssl_context is None:
+                import ssl
+                self._ssl_context = ssl.create_default_context()
+            connection = http.client.HTTPSConnection(host, port, timeout=self.timeout, context=self._ssl_context)
+        else:
+            connection = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        with self._lock:
+            self.connects += 1
+        return connection
+
+    def _checkout(self, key):
+        """ an idle connection to key and True, or a new one and False """
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._connect(key), False
+
+    def _checkin(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        """ close every idle connection """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def get(self, url, etag=None, modified=None, agent=None, accept=None, result=None):
+        """ download url following redirects, returns the decompressed body
+        result is filled in like feedparser.http.get fills it: headers, etag, modified, href and status """
+        if result is None:
+            result = {}
+        headers = {'Accept-Encoding': 'gzip, deflate'}
+        if agent:
+            headers['User-Agent'] = agent
+        if accept:
+            headers['Accept'] = accept
+        if etag:
+            headers['If-None-Match'] = etag
+        if isinstance(modified, str):
+            headers['If-Modified-Since'] = modified
+        status = None
+        deadline = time.monotonic() + self.timeout
+        for _ in range(self.max_redirects + 1):
+            response_status, response_headers, body = self._request(url, headers, deadline)
+            if response_status not in REDIRECT_CODES or 'location' not in response_headers:
+                break
+            # like urllib, the reported status is the redirect's and href is where it led
+            status = response_status
+            url = urljoin(url, response_headers['location'])
+        else:
+            raise urllib.error.URLError(f"more than {self.max_redirects} redirects")
+        result['headers'] = response_headers
+        if response_headers.get('etag'):
+            result['etag'] = response_headers['etag']
+        if response_headers.get('last-modified'):
+            result['modified'] = response_headers['last-modified']
+        result['href'] = url
+        result['status'] = status or response_status
+        return body
+
+    def _remaining(self, deadline):
+        """ seconds left before deadline, raises TimeoutError once it has passed """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"download took longer than {self.timeout} seconds")
+        return remaining
+
+    def _request(self, url, headers, deadline):
+        """ one GET, returns (status, lowercased headers, body); retried once on a fresh connection
+        when a reused one turns out to have been closed by the server """
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise urllib.error.URLError(f"unsupported url scheme {parts.scheme!r}")
+        try:
+            port = parts.port
+            if not parts.hostname:
+                raise ValueError(f"no host in {url!r}")
+            host = parts.hostname.encode('idna').decode('ascii')
+        except (ValueError, UnicodeError) as e:
+            raise urllib.error.URLError(e)
+        key = (parts.scheme, host, port)
+        target = quote(parts.path or '/', safe="/%:@!$&'()*+,;=~")
+        if parts.query:
+            target += '?' + quote(parts.query, safe="/%:@!$&'()*+,;=~?")
+        request_headers = dict(headers)
+        if parts.username:
+            credentials = f'{parts.username}:{parts.password or ""}'.encode('utf-8')
+            request_headers['Authorization'] = 'Basic ' + base64.b64encode(credentials).decode('ascii')
+        while True:
+            connection, reused = self._checkout(key)
+            try:
+                # every socket operation gets at most the time left for the whole download
+                connection.timeout = self._remaining(deadline)
+                if connection.sock is not None:
+                    connection.sock.settimeout(connection.timeout)
+                connection.request('GET', target, headers=request_headers)
+                sock = connection.sock  # the response keeps reading from it even once the connection lets go
+                response = connection.getresponse()
+            except STALE_CONNECTION_ERRORS as e:
+                connection.close()
+                if reused:
+                    logger.debug("Idle connection to %s was closed, reconnecting.", key[1])
+                    continue
+                raise urllib.error.URLError(e)
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                raise urllib.error.URLError(e)
+            break
+        with self._lock:
+            self.requests += 1
+        response_headers = {name.lower(): value for name, value in response.getheaders()}
+        try:
+            body = self._read_body(response, response_headers.get('content-encoding', ''), sock, deadline)
+        except (OSError, http.client.HTTPException, ResponseTooLarge, zlib.error) as e:
+            connection.close()
+            raise urllib.error.URLError(e)
+        if response.will_close:
+            connection.close()
+        else:
+            self._checkin(key, connection)
+        return response.status, response_headers, body
+
+    def _read_body(self, response, content_encoding, sock, deadline):
+        """ the whole body, decompressed a block at a time and never more than max_bytes """
+        length = response.getheader('content-length')
+        if length and length.isdigit() and int(length) > self.max_bytes:
+            raise ResponseTooLarge(f"response of {length} bytes is over the limit of {self.max_bytes}")
+        if 'gzip' in content_encoding:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif 'deflate' in content_encoding:
+            decompressor = None  # zlib wrapped or raw, told apart by the first block
+        else:
+            decompressor = False
+        blocks = []
+        size = 0
+        while True:
+            sock.settimeout(self._remaining(deadline))
+            # read1 returns whatever one receive brought, so the deadline is checked however slow the server
+            block = response.read1(65536)
+            if not block:
+                break
+            if decompressor is None:
+                # a zlib stream starts with a header whose first two bytes are a multiple of 31
+                wrapped = len(block) >= 2 and (block[0] & 0x0f) == 8 and int.from_bytes(block[:2], 'big') % 31 == 0
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS if wrapped else -zlib.MAX_WBITS)
+            if decompressor:
+                # bounded output, so a small compressed response cannot expand without limit
+                block = decompressor.decompress(block, self.max_bytes - size + 1)
+                if decompressor.unconsumed_tail:
+                    size = self.max_bytes + 1
+            size += len(block)
+            if size > self.max_bytes:
+                raise ResponseTooLarge(f"response is over the limit of {self.max_bytes} bytes")
+            blocks.append(block)
+        response.read()  # read1 leaves a response with a content-length open, this marks it done
+        if decompressor:
+            blocks.append(decompressor.flush())
+        return b''.join(blocks)
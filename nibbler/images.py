@@ -0,0 +1,166 @@
+"""Optional digest image stage: article images downloaded once, shrunk to the email size and cached on disk."""
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import io
+import json
+import logging
+import mimetypes
+import os
+import shutil
+import time
+import urllib.error
+
+from nibbler.feedcache import FeedCache
+
+try:
+    from PIL import Image
+except ImportError:
+    # without Pillow images are cached and sent as the publisher serves them
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def warn_without_pillow():
+    """ tell the operator once per process that images go out at full size """
+    logger.warning("Pillow is not installed, so images are sent at the size the publisher serves them. "
+                   "Install nibbler-rss[images] to scale them down.")
+
+
+class ImageCache(FeedCache):
+    """ Content addressed store of images ready for the email
+
+    bodies/ab/abcd....jpg holds each distinct image once, named by the sha256 of the stored bytes
+    with an extension for its type; urls/<sha256 of url>.json points an image url at it.
+    Eviction is FeedCache's: by age, then least recently used until the cache fits. """
+
+    def store_image(self, url, data, extension):
+        """ remember data as the image for url, returns its path """
+        name = hashlib.sha256(data).hexdigest() + extension
+        path = self._body_path(name)
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            self._write_atomic(path, data)
+        entry = {'url': url, 'sha256': name, 'stored_at': time.time()}
+        self._write_atomic(self._url_path(url), json.dumps(entry).encode('utf-8'))
+        return path
+
+    def image_path(self, url):
+        """ the path of the image stored for url, or None """
+        try:
+            with open(self._url_path(url), 'rb') as entry_file:
+                path = self._body_path(json.load(entry_file)['sha256'])
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return path
+
+
+class ImageFetcher():
+    """ Downloads images on a bounded pool of threads, each url at most once while it stays cached
+
+    with Pillow installed an image larger than max_size is scaled down to fit, keeping its
+    aspect ratio, and recompressed; animated images and images that would only grow are kept """
+
+    def __init__(self, cache, http_pool, max_workers=8, max_size=(480, 320), quality=80, agent=None):
+        self.cache = cache
+        self.http_pool = http_pool
+        self.max_workers = max_workers
+        self.max_size = max_size
+        self.quality = quality
+        self.agent = agent
+        if Image is None:
+            warn_without_pillow()
+
+    def fetch(self, urls):
+        """ {url: path} for every url that is cached or could be downloaded """
+        paths = {}
+        missing = []
+        for url in dict.fromkeys(urls):
+            path = self.cache.image_path(url)
+            if path is None:
+                missing.append(url)
+            else:
+                paths[url] = path
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(missing))) as executor:
+                for url, path in zip(missing, executor.map(self._download, missing)):
+                    if path is not None:
+                        paths[url] = path
+        return paths
+
+    def _download(self, url):
+        """ download, shrink and cache one image, None when it is not an image we can use """
+        response = {}
+        try:
+            data = self.http_pool.get(url, agent=self.agent, accept='image/*', result=response)
+        except urllib.error.URLError as e:
+            logger.warning("Could not download the image %s: %s", url, e.reason)
+            return None
+        content_type = response['headers'].get('content-type', '').split(';')[0].strip().lower()
+        if response['status'] >= 300 or not content_type.startswith('image/') or not data:
+            logger.warning("No image at %s, status %s and content type %r.", url, response['status'], content_type)
+            return None
+        data, content_type = self.shrink(data, content_type)
+        extension = mimetypes.guess_extension(content_type) or '.img'
+        return self.cache.store_image(url, data, extension)
+
+    def shrink(self, data, content_type):
+        """ (data, content_type) scaled down to max_size and recompressed, when Pillow is installed """
+        if Image is None:
+            return data, content_type
+        try:
+            image = Image.open(io.BytesIO(data))
+            if getattr(image, 'is_animated', False):
+                return data, content_type
+            resized = image.width > self.max_size[0] or image.height > self.max_size[1]
+            image.thumbnail(self.max_size)
+            out = io.BytesIO()
+            if image.mode in ('RGBA', 'LA', 'P'):
+                image.save(out, 'PNG', optimize=True)
+                shrunk_type = 'image/png'
+            else:
+                image.convert('RGB').save(out, 'JPEG', quality=self.quality, optimize=True)
+                shrunk_type = 'image/jpeg'
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            logger.warning("Could not resize an image, sending it as it is: %s", e)
+            return data, content_type
+        if not resized and out.tell() >= len(data):
+            return data, content_type
+        return out.getvalue(), shrunk_type
+
+
+class DigestImages():
+    """ Points the images of one newsletter at copies it controls
+
+    mode 'inline' attaches each image to the email once and refers to it by content id,
+    mode 'static' copies it into static_dir, which is served at static_url. Images that
+    could not be downloaded keep their original address. """
+
+    def __init__(self, fetcher, mode, attachments, static_dir=None, static_url=None):
+        self.fetcher = fetcher
+        self.mode = mode
+        self.attachments = attachments  # content id to path, read after the html is written
+        self.static_dir = static_dir
+        self.static_url = static_url.rstrip('/') if static_url else static_url
+
+    def sources(self, urls):
+        """ {url: new src} for the images among urls """
+        sources = {}
+        for url, path in self.fetcher.fetch([url for url in urls if url.startswith(('http://', 'https://'))]).items():
+            name = os.path.basename(path)
+            if self.mode == 'inline':
+                content_id = os.path.splitext(name)[0]
+                self.attachments[content_id] = path
+                sources[url] = f'cid:{content_id}'
+            else:
+                # named by content, so an image already published is never copied again;
+                # the copies are not evicted, old newsletters keep showing them
+                static_path = os.path.join(self.static_dir, name)
+                if not os.path.exists(static_path):
+                    shutil.copyfile(path, static_path)
+                sources[url] = f'{self.static_url}/{name}'
+        return sources
@@ -0,0 +1,132 @@
+"""Per-stage timings and counters of one nibbler run."""
+from contextlib import contextmanager
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RunMetrics():
+    """ Collects where a run spends its time
+
+    stages accumulate seconds and calls (fetch, parse, clean, db, render, send, ...),
+    counters count things (entries_seen, entries_new, feeds_failed, ...) and
+    feed_latency keeps the last fetch time of every feed. Recording is thread safe,
+    the fetch stages are timed on the worker threads.
+
+    A hook is any callable taking (name, value, labels); it is called for every
+    stage timing and counter increment, to forward them to another metrics system. """
+
+    def __init__(self):
+        self.started = time.time()
+        self.stage_seconds = {}
+        self.stage_calls = {}
+        self.counters = {}
+        self.feed_latency = {}
+        self.hooks = []
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """ call hook(name, value, labels) for everything recorded from now on """
+        self.hooks.append(hook)
+
+    def _notify(self, name, value, labels):
+        for hook in self.hooks:
+            try:
+                hook(name, value, labels)
+            except Exception:
+                logger.exception("Metrics hook %r failed.", hook)
+
+    def observe(self, stage, seconds, **labels):
+        """ add seconds spent in stage """
+        with self._lock:
+            self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+            self.stage_calls[stage] = self.stage_calls.get(stage, 0) + 1
+        self._notify(stage, seconds, labels)
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        """ time the body of a with block as one call of stage """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, **labels)
+
+    def count(self, name, amount=1, **labels):
+        """ add amount to a counter """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+        self._notify(name, amount, labels)
+
+    def feed_fetched(self, feed_id, seconds):
+        """ remember how long the latest fetch of a feed took """
+        with self._lock:
+            self.feed_latency[feed_id] = seconds
+        self._notify('feed_fetch', seconds, {'feed_id': feed_id})
+
+    def summary(self):
+        """ everything recorded so far as plain data """
+        with self._lock:
+            return {
+                'started': self.started,
+                'elapsed_seconds': time.time() - self.started,
+                'stages': {stage: {'seconds': seconds, 'calls': self.stage_calls[stage]}
+                           for stage, seconds in sorted(self.stage_seconds.items())},
+                'counters': dict(sorted(self.counters.items())),
+                'feed_latency': {str(feed_id): seconds for feed_id, seconds in sorted(self.feed_latency.items())},
+            }
+
+    def log_summary(self):
+        """ one log line per stage and counter, slowest feeds last """
+        summary = self.summary()
+        logger.info("Run took %.2fs.", summary['elapsed_seconds'])
+        for stage, values in summary['stages'].items():
+            logger.info("  %-10s %9.3fs in %s calls", stage, values['seconds'], values['calls'])
+        for name, value in summary['counters'].items():
+            logger.info("  %-20s %s", name, value)
+        slowest = sorted(summary['feed_latency'].items(), key=lambda item: item[1], reverse=True)[:5]
+        for feed_id, seconds in slowest:
+            logger.info("  slow feed %s took %.2fs", feed_id, seconds)
+
+    def to_prometheus(self):
+        """ the summary in the prometheus text exposition format, for the node exporter textfile collector """
+        summary = self.summary()
+        lines = ['# HELP nibbler_run_start_time_seconds When the run started.',
+                 '# TYPE nibbler_run_start_time_seconds gauge',
+                 f"nibbler_run_start_time_seconds {summary['started']}",
+                 '# HELP nibbler_run_duration_seconds How long the run has taken.',
+                 '# TYPE nibbler_run_duration_seconds gauge',
+                 f"nibbler_run_duration_seconds {summary['elapsed_seconds']}",
+                 '# HELP nibbler_stage_seconds_total Seconds spent in each stage.',
+                 '# TYPE nibbler_stage_seconds_total counter']
+        lines += [f'nibbler_stage_seconds_total{{stage="{stage}"}} {values["seconds"]}'
+                  for stage, values in summary['stages'].items()]
+        lines += ['# HELP nibbler_stage_calls_total Times each stage ran.',
+                  '# TYPE nibbler_stage_calls_total counter']
+        lines += [f'nibbler_stage_calls_total{{stage="{stage}"}} {values["calls"]}'
+                  for stage, values in summary['stages'].items()]
+        for name, value in summary['counters'].items():
+            lines += [f'# TYPE nibbler_{name}_total counter', f'nibbler_{name}_total {value}']
+        lines += ['# HELP nibbler_feed_fetch_seconds Duration of the latest fetch of each feed.',
+                  '# TYPE nibbler_feed_fetch_seconds gauge']
+        lines += [f'nibbler_feed_fetch_seconds{{feed_id="{feed_id}"}} {seconds}'
+                  for feed_id, seconds in summary['feed_latency'].items()]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        """ write the summary as prometheus text when filename ends in .prom, json otherwise
+        the file is replaced atomically so a collector never reads half of it """
+        if filename.endswith('.prom'):
+            data = self.to_prometheus()
+        else:
+            data = json.dumps(self.summary(), indent=2)
+        directory = os.path.dirname(os.path.abspath(filename))
+        handle, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, 'w') as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, filename)
@@ -3,40 +3,58 @@
 __author__ = 'Randall'
 
 # system imports
-from datetime import datetime
+from datetime import datetime, timedelta
+import base64
+import binascii
+import hashlib
+import io
 import logging
+import mimetypes
 import os
-import traceback
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
 import configparser
-# email imports
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
-from email import charset
+import functools
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import urllib.error
+from urllib.parse import urljoin, urlparse
 
 # Dependency Imports
-import feedparser
-# jinja2 imports
-from jinja2 import Environment, PackageLoader
-# lxml imports
-from lxml.html.clean import Cleaner
-import lxml.html
+# feedparser, jinja2, lxml, smtplib and the email package are imported in the stages that use them,
+# so a digest-only or report run never pays for the acquisition stack and the other way around
 # SqlAlchemy imports
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Date
-from sqlalchemy import ForeignKey
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import bindparam, create_engine, delete, event, func, inspect, literal, or_, select, text, true, update
+from sqlalchemy import Boolean, Column, Float, Integer, String, Date, DateTime
+from sqlalchemy import ForeignKey, Index, TypeDecorator
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import declarative_base, sessionmaker
 
 # Import python modules from the project
-from nibbler import opml
+from nibbler.feedcache import FeedCache
+from nibbler.metrics import RunMetrics
 
 logger = logging.getLogger(__name__)
 
-# figure out which posts to email
-posts_to_email = []
 base = declarative_base()
+# SQLite limits bound parameters per statement, so IN (...) lookups go out in chunks this size
+IN_CLAUSE_CHUNK = 500
+# the subscriber given on the command line; queued posts without a subscriber belong to it
+PRIMARY_SUBSCRIBER = 'primary'
+# indexes earlier releases created that no query uses any more, dropped from older databases
+RETIRED_INDEXES = {'nibbler_post': ('ix_nibbler_post_guid',)}
+# the setting holding the newest post_id compress_bodies has already scanned
+COMPRESSED_THROUGH_SETTING = 'compressed_bodies_through'
+
+
+def opml_setting_keys(subscriber_name):
+    """ the settings remembering the signature and sha256 of a subscriber's subscriptions.xml """
+    return f'opml_signature:{subscriber_name}', f'opml_sha256:{subscriber_name}'
 
 
 def ensure_dir(directory):
@@ -45,6 +63,37 @@ def ensure_dir(directory):
         os.makedirs(directory)
 
 
+def chunked(items, size=None):
+    """ split a list into lists of at most size items, IN_CLAUSE_CHUNK by default """
+    size = size or IN_CLAUSE_CHUNK
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class CompressedText(TypeDecorator):
+    """ Text stored zlib compressed, marked by a prefix so rows written before compression
+    was added, and short texts that do not get smaller, are still read back as they are """
+    impl = String
+    cache_ok = True
+    # zlib streams never start with NUL, so no legacy text value can look compressed
+    prefix = b'\x00nz1'
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        data = value.encode('utf-8')
+        compressed = self.prefix + zlib.compress(data)
+        # sqlite keeps bytes as a BLOB whatever the column's declared type
+        return compressed if len(compressed) < len(data) else value
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, bytes):
+            if value.startswith(self.prefix):
+                return zlib.decompress(value[len(self.prefix):]).decode('utf-8')
+            return value.decode('utf-8')
+        return value
+
+
 class Feed(base):
     """ Defines the table for a feed """
     __tablename__ = 'nibbler_feed'
@@ -52,6 +101,25 @@ class Feed(base):
     title = Column(String(64))
     xmlUrl = Column(String(256))
     description = Column(String(256))
+    # HTTP validators from the last fetch, sent back so unchanged feeds answer 304
+    etag = Column(String(256))
+    modified = Column(String(64))
+    last_status = Column(Integer)
+    last_fetched = Column(DateTime)
+    # polling schedule used by the long-running serve mode
+    ttl = Column(Integer)  # minutes, from the feed's own <ttl>
+    poll_interval = Column(Integer)  # seconds
+    next_poll = Column(DateTime)
+    # failure history, failing feeds back off and are eventually quarantined
+    error_count = Column(Integer, server_default='0')
+    consecutive_failures = Column(Integer, server_default='0')
+    avg_fetch_latency = Column(Float)  # seconds, moving average
+    backoff_until = Column(DateTime)
+    quarantined = Column(Boolean, server_default='0')
+    # false once the feed is no longer in subscriptions.xml
+    active = Column(Boolean, server_default='1')
+    # folder path of the feed in subscriptions.xml, like 'Tech/Blogs'
+    category = Column(String(256))
 
     def __init__(self, title, xmlUrl, description=None):
         self.title = title
@@ -65,68 +133,438 @@ class Feed(base):
 class Article(base):
     """ Defines the table for an article """
     __tablename__ = 'nibbler_post'
+    __table_args__ = (Index('ix_nibbler_post_feed_id_guid', 'feed_id', 'guid', unique=True),)
     post_id = Column(Integer, primary_key=True)
     feed_id = Column(Integer, ForeignKey("nibbler_feed.feed_id"))
+    # every guid lookup is per feed and goes through ix_nibbler_post_feed_id_guid
     guid = Column(String(64))
     title = Column(String(256))
     link = Column(String(256))
     pub_date = Column(String(128))
-    article_text = Column(String(65535))
+    article_text = Column(CompressedText(65535))
     time_stamp = Column(Date)
     # we need stuff on all instances, but not in the database.
     feed_title = None  # optional value
+    feed_category = None  # optional value
 
     def __repr__(self):
         return '<nibbler_post%r>' % (self.post_id)
 
 
+class Setting(base):
+    """ Defines a key/value table for small bits of state kept between runs """
+    __tablename__ = 'nibbler_setting'
+    key = Column(String(64), primary_key=True)
+    value = Column(String(256))
+
+    def __repr__(self):
+        return '<nibbler_setting%r>' % (self.key)
+
+
+class Subscriber(base):
+    """ Defines a reader who gets their own newsletter from their own subscriptions.xml """
+    __tablename__ = 'nibbler_subscriber'
+    subscriber_id = Column(Integer, primary_key=True)
+    name = Column(String(64), unique=True)
+    email = Column(String(256))
+    sub_file = Column(String(1024))
+
+    def __repr__(self):
+        return '<nibbler_subscriber%r>' % (self.subscriber_id)
+
+
+class Subscription(base):
+    """ Defines which feeds a subscriber reads, keyed by url like subscriptions.xml,
+    and the folder the subscriber keeps the feed in """
+    __tablename__ = 'nibbler_subscription'
+    __table_args__ = (Index('ix_nibbler_subscription_subscriber_id_xmlUrl', 'subscriber_id', 'xmlUrl', unique=True),)
+    subscription_id = Column(Integer, primary_key=True)
+    subscriber_id = Column(Integer, ForeignKey("nibbler_subscriber.subscriber_id"))
+    xmlUrl = Column(String(256), index=True)
+    title = Column(String(64))
+    category = Column(String(256))
+
+    def __repr__(self):
+        return '<nibbler_subscription%r>' % (self.subscription_id)
+
+
+class PendingDigest(base):
+    """ Defines the queue of stored posts that have not gone out in a newsletter yet,
+    one row for every subscriber of the post's feed """
+    __tablename__ = 'nibbler_digest_queue'
+    queue_id = Column(Integer, primary_key=True)
+    post_id = Column(Integer, ForeignKey("nibbler_post.post_id"), index=True)
+    queued_at = Column(DateTime)
+    # None for posts queued before there were subscribers, they go to the primary subscriber
+    subscriber_id = Column(Integer, ForeignKey("nibbler_subscriber.subscriber_id"), index=True)
+
+    def __repr__(self):
+        return '<nibbler_digest_queue%r>' % (self.queue_id)
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """ WAL lets readers work during a write and makes each commit an append instead of a journal rewrite """
+    cursor = dbapi_connection.cursor()
+    # only takes effect on a new database, an existing one is converted by its first compaction
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # with WAL, NORMAL only syncs at checkpoints and is still safe against corruption
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
 class DatabaseAccess():
     """ Handles interactions with the data model """
-    def __init__(self, connection_str):
+    def __init__(self, connection_str, batch_size=500):
         logger.debug("Creating Data Access")
+        self.batch_size = batch_size
         db_engine = None
         db_engine = create_engine(connection_str)
+        if db_engine.dialect.name == 'sqlite':
+            event.listen(db_engine, 'connect', set_sqlite_pragmas)
         # this line will try to make the tables in database, if they aren't there
         base.metadata.create_all(db_engine)
+        self.upgrade_schema(db_engine)
         logger.debug("Connected to: %s", connection_str)
+        self.engine = db_engine
         Session = sessionmaker(bind=db_engine)
         self.session = Session()
 
-    def get_post(self, guid):
-        """ get post from database by guid """
-        article = None
-        results = self.session.query(Article, Feed).filter(Article.feed_id == Feed.feed_id).\
-            filter(Article.guid == guid).all()
-        if not results:
-            logger.warning("Nibbler could not find a post with guid: %s", guid)
-        else:
-            # convert list of tuples into one article object
-            article_info = results[0]
-            article = article_info[0]
-            article.feed_title = article_info[1].title
-        return article
-
-    def store_post(self, post):
-        """ store post using the guid as the key """
-        logger.info("Inserting %s in the database", post.guid)
-        self.session.add(post)
+    def upgrade_schema(self, db_engine):
+        """ create_all skips existing tables, so add any model columns and indexes an older database is missing
+        and drop the indexes it has that are retired """
+        inspector = inspect(db_engine)
+        for table in base.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(db_engine.dialect)}'
+                if column.server_default is not None:
+                    ddl += f' DEFAULT {column.server_default.arg}'
+                logger.info("Upgrading schema: %s", ddl)
+                with db_engine.begin() as connection:
+                    connection.execute(text(ddl))
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing_indexes:
+                    continue
+                logger.info("Upgrading schema: creating index %s", index.name)
+                try:
+                    index.create(db_engine)
+                except IntegrityError as e:
+                    logger.error("Could not create index %s, existing rows violate it: %s", index.name, e)
+            for index_name in RETIRED_INDEXES.get(table.name, ()):
+                if index_name in existing_indexes:
+                    logger.info("Upgrading schema: dropping index %s", index_name)
+                    with db_engine.begin() as connection:
+                        connection.execute(text(f'DROP INDEX {index_name}'))
+
+    def fetchable_feeds(self, now):
+        """ query for the subscribed feeds that are neither quarantined nor backing off after failures """
+        return self.session.query(Feed).filter(or_(Feed.active.is_(None), Feed.active.is_(True)),
+                                               or_(Feed.quarantined.is_(None), Feed.quarantined.is_(False)),
+                                               or_(Feed.backoff_until.is_(None), Feed.backoff_until <= now))
+
+    def get_setting(self, key):
+        """ value stored under key, or None """
+        setting = self.session.get(Setting, key)
+        return None if setting is None else setting.value
+
+    def set_setting(self, key, value):
+        """ store value under key, committed with the caller's transaction """
+        self.session.merge(Setting(key=key, value=value))
+
+    def sync_feeds(self, subscribed):
+        """ make the feed table match a {xmlUrl: FeedOutline} dict of subscriptions in one transaction:
+        new urls are bulk inserted, missing ones marked inactive, returning ones reactivated and
+        moved ones get their new category; returns the counts of (added, removed, reactivated) """
+        existing = {url: (active, category) for url, active, category
+                    in self.session.execute(select(Feed.xmlUrl, Feed.active, Feed.category))}
+        additions = [{'title': outline.title, 'xmlUrl': url, 'category': outline.category}
+                     for url, outline in subscribed.items() if url not in existing]
+        removed = [url for url, (active, _) in existing.items() if url not in subscribed and active is not False]
+        returning = [url for url, (active, _) in existing.items() if url in subscribed and active is False]
+        moved = [{'url': url, 'new_category': subscribed[url].category} for url, (_, category) in existing.items()
+                 if url in subscribed and subscribed[url].category != category]
+        if additions:
+            self.session.execute(Feed.__table__.insert(), additions)
+        if moved:
+            feed_table = Feed.__table__
+            self.session.execute(feed_table.update().where(feed_table.c.xmlUrl == bindparam('url'))
+                                 .values(category=bindparam('new_category')), moved)
+        for chunk in chunked(removed):
+            self.session.execute(update(Feed).where(Feed.xmlUrl.in_(chunk)).values(active=False))
+        for chunk in chunked(returning):
+            # a resubscribed feed starts over with a clean failure history
+            self.session.execute(update(Feed).where(Feed.xmlUrl.in_(chunk))
+                                 .values(active=True, quarantined=False, consecutive_failures=0, backoff_until=None))
+        self.session.commit()
+        return len(additions), len(removed), len(returning)
+
+    def sync_subscribers(self, subscribers):
+        """ make the subscriber table match a list of (name, email, sub_file); subscribers no longer
+        listed are removed with their subscriptions and queue; returns (subscribers, removed count) """
+        existing = {subscriber.name: subscriber for subscriber in self.session.query(Subscriber)}
+        for name, email, sub_file in subscribers:
+            subscriber = existing.pop(name, None)
+            if subscriber is None:
+                self.session.add(Subscriber(name=name, email=email, sub_file=sub_file))
+            else:
+                subscriber.email = email
+                subscriber.sub_file = sub_file
+        for subscriber in existing.values():
+            logger.info("Removing subscriber %s.", subscriber.name)
+            self.session.execute(delete(Subscription).where(Subscription.subscriber_id == subscriber.subscriber_id))
+            self.session.execute(delete(PendingDigest).where(PendingDigest.subscriber_id == subscriber.subscriber_id))
+            # a subscriber added back under the same name must have their file read again
+            self.session.execute(delete(Setting).where(Setting.key.in_(opml_setting_keys(subscriber.name))))
+            self.session.delete(subscriber)
+        self.session.commit()
+        return self.subscribers(), len(existing)
+
+    def subscribers(self):
+        """ every subscriber, the primary one first """
+        return self.session.query(Subscriber).order_by(Subscriber.name != PRIMARY_SUBSCRIBER,
+                                                       Subscriber.subscriber_id).all()
+
+    def sync_subscriptions(self, subscriber_id, subscribed):
+        """ make one subscriber's subscriptions match a {xmlUrl: FeedOutline} dict in one transaction,
+        returns the counts of (added, removed) """
+        existing = {url: (title, category) for url, title, category
+                    in self.session.execute(select(Subscription.xmlUrl, Subscription.title, Subscription.category)
+                                            .where(Subscription.subscriber_id == subscriber_id))}
+        additions = [{'subscriber_id': subscriber_id, 'xmlUrl': url, 'title': outline.title,
+                      'category': outline.category} for url, outline in subscribed.items() if url not in existing]
+        removed = [url for url in existing if url not in subscribed]
+        changed = [{'url': url, 'new_title': subscribed[url].title, 'new_category': subscribed[url].category}
+                   for url, values in existing.items()
+                   if url in subscribed and (subscribed[url].title, subscribed[url].category) != values]
+        if additions:
+            self.session.execute(Subscription.__table__.insert(), additions)
+        if changed:
+            subscription_table = Subscription.__table__
+            self.session.execute(subscription_table.update()
+                                 .where(subscription_table.c.subscriber_id == subscriber_id,
+                                        subscription_table.c.xmlUrl == bindparam('url'))
+                                 .values(title=bindparam('new_title'), category=bindparam('new_category')), changed)
+        for chunk in chunked(removed):
+            self.session.execute(delete(Subscription).where(Subscription.subscriber_id == subscriber_id,
+                                                            Subscription.xmlUrl.in_(chunk)))
+        self.session.commit()
+        return len(additions), len(removed)
+
+    def subscribed_feeds(self):
+        """ {xmlUrl: FeedOutline} of every feed anyone subscribes to, for sync_feeds;
+        where subscribers file a feed differently, the primary subscriber's folder wins """
+        from nibbler.opml import FeedOutline
+        subscribed = {}
+        rows = self.session.execute(select(Subscription.title, Subscription.xmlUrl, Subscription.category)
+                                    .join(Subscriber, Subscriber.subscriber_id == Subscription.subscriber_id)
+                                    .order_by(Subscriber.name != PRIMARY_SUBSCRIBER, Subscriber.subscriber_id))
+        for title, url, category in rows:
+            subscribed.setdefault(url, FeedOutline(title, url, category))
+        return subscribed
+
+    def troubled_feeds(self):
+        """ feeds that are quarantined or whose last fetch failed, worst first """
+        return self.session.query(Feed).filter(or_(Feed.quarantined.is_(True), Feed.consecutive_failures > 0))\
+            .order_by(Feed.quarantined.desc(), Feed.consecutive_failures.desc()).all()
+
+    def _feed_category(self, subscriber):
+        """ the folder a feed is in: the subscriber's own, falling back to the one of the feed """
+        if subscriber is None:
+            return Feed.category
+        return func.coalesce(Subscription.category, Feed.category)
+
+    def _join_subscription(self, query, subscriber):
+        """ outer join the subscriber's subscription to a query that already has Feed """
+        if subscriber is None:
+            return query
+        return query.outerjoin(Subscription, (Subscription.xmlUrl == Feed.xmlUrl)
+                               & (Subscription.subscriber_id == subscriber.subscriber_id))
+
+    def _queued_for(self, subscriber):
+        """ where clause for the queue rows of a subscriber, None meaning every row """
+        if subscriber is None:
+            return true()
+        if subscriber.name == PRIMARY_SUBSCRIBER:
+            return or_(PendingDigest.subscriber_id == subscriber.subscriber_id, PendingDigest.subscriber_id.is_(None))
+        return PendingDigest.subscriber_id == subscriber.subscriber_id
+
+    def iter_posts_by_id(self, post_ids, subscriber=None):
+        """ yields the posts in the order of post_ids with feed_title and feed_category set,
+        the category as the subscriber files the feed when one is given
+        bodies are loaded a chunk at a time and detached from the session, so the caller
+        can change them and memory stays flat however many posts there are """
+        for chunk in chunked(post_ids):
+            query = select(Article, Feed.title, self._feed_category(subscriber))\
+                .join(Feed, Article.feed_id == Feed.feed_id)
+            results = self.session.execute(self._join_subscription(query, subscriber)
+                                           .where(Article.post_id.in_(chunk))).all()
+            by_id = {row[0].post_id: row for row in results}
+            for post_id in chunk:
+                if post_id not in by_id:
+                    continue
+                article, feed_title, feed_category = by_id[post_id]
+                self.session.expunge(article)
+                article.feed_title = feed_title
+                article.feed_category = feed_category
+                yield article
+
+    def pending_post_ids(self, subscriber=None):
+        """ ids of the posts waiting for the subscriber's next newsletter, or anyone's without a subscriber,
+        grouped by category then by feed in the order they were stored """
+        query = select(Article.post_id).distinct()\
+            .join(PendingDigest, PendingDigest.post_id == Article.post_id)\
+            .join(Feed, Article.feed_id == Feed.feed_id)
+        return list(self.session.execute(self._join_subscription(query, subscriber)
+                                         .where(self._queued_for(subscriber))
+                                         .order_by(func.coalesce(self._feed_category(subscriber), ''),
+                                                   Article.feed_id, Article.post_id)).scalars())
+
+    def clear_pending(self, post_ids, subscriber=None):
+        """ takes delivered posts off the subscriber's newsletter queue, or everyone's, in one transaction """
+        for chunk in chunked(post_ids):
+            self.session.execute(PendingDigest.__table__.delete().where(PendingDigest.post_id.in_(chunk),
+                                                                        self._queued_for(subscriber)))
         self.session.commit()
 
-    def is_post_in_db(self, guid):
-        """ returns true if a post exists with the guid """
-        logger.debug("determining if post %s is in the database", guid)
-        article = self.session.query(Article).filter_by(guid=guid).all()
-        if not article:
-            logger.debug("%s is NOT in the database", guid)
-            return False
-        logger.debug("%s is in the database", guid)
-        return True
+    def store_posts(self, posts):
+        """ store many posts, each batch goes in as one executemany and one commit """
+        columns = [column.key for column in Article.__table__.columns if column.key != 'post_id']
+        batch = []
+        stored = 0
+        for post in posts:
+            batch.append({column: getattr(post, column) for column in columns})
+            if len(batch) >= self.batch_size:
+                stored += self._insert_post_rows(batch)
+                batch = []
+        if batch:
+            stored += self._insert_post_rows(batch)
+        return stored
+
+    def _insert_post_rows(self, rows):
+        """ insert one batch of post rows and queue them for the newsletter in a single transaction """
+        logger.info("Inserting %s posts in the database", len(rows))
+        self.session.execute(Article.__table__.insert(), rows)
+        guids_by_feed = {}
+        for row in rows:
+            guids_by_feed.setdefault(row['feed_id'], []).append(row['guid'])
+        queued_at = datetime.now()
+        for feed_id, guids in guids_by_feed.items():
+            self._queue_posts(feed_id, guids, queued_at)
+        self.session.commit()
+        return len(rows)
+
+    def _queue_posts(self, feed_id, guids, queued_at):
+        """ queue just stored posts of a feed for each subscriber of the feed with one INSERT ... SELECT,
+        a feed nobody subscribes to through subscriptions.xml queues them without a subscriber """
+        # (feed_id, guid) is unique, so this finds exactly the rows just inserted
+        new_rows = select(Article.post_id, Subscription.subscriber_id, literal(queued_at))\
+            .join(Feed, Article.feed_id == Feed.feed_id)\
+            .outerjoin(Subscription, Subscription.xmlUrl == Feed.xmlUrl)\
+            .where(Article.feed_id == feed_id, Article.guid.in_(guids))
+        self.session.execute(PendingDigest.__table__.insert()
+                             .from_select(['post_id', 'subscriber_id', 'queued_at'], new_rows))
+
+    def prune_posts(self, feed_id, max_age_days=None, keep_count=None, now=None):
+        """ turns old posts of a feed into tombstones: the body, title, link and date are dropped but
+        the row and its guid stay, so find_new_guids still knows the post was seen
+        a post is old when it was acquired more than max_age_days ago or is not among the feed's
+        keep_count newest; posts still waiting for a newsletter are never pruned
+        returns the number of posts pruned """
+        conditions = []
+        if max_age_days is not None:
+            cutoff = (now or datetime.now()) - timedelta(days=max_age_days)
+            conditions.append(Article.time_stamp < cutoff.date())
+        if keep_count is not None:
+            newest = select(Article.post_id).where(Article.feed_id == feed_id)\
+                .order_by(Article.post_id.desc()).limit(keep_count)
+            conditions.append(Article.post_id.not_in(newest))
+        if not conditions:
+            return 0
+        result = self.session.execute(update(Article)
+                                      .where(Article.feed_id == feed_id, Article.article_text.is_not(None),
+                                             or_(*conditions),
+                                             Article.post_id.not_in(select(PendingDigest.post_id)))
+                                      .values(title=None, link=None, pub_date=None, article_text=None)
+                                      .execution_options(synchronize_session=False))
+        self.session.commit()
+        return result.rowcount
+
+    def compress_bodies(self, batch_size=None):
+        """ rewrites article bodies stored before compression was added, a batch per transaction
+        returns the number of bodies rewritten
+        posts stored since are compressed as they go in, so the posts already looked at are remembered
+        and the next run only scans posts stored after them """
+        batch_size = batch_size or self.batch_size
+        statement = Article.__table__.update().where(Article.post_id == bindparam('b_post_id'))\
+            .values(article_text=bindparam('b_article_text'))
+        compressed_text = Article.__table__.c.article_text.type
+        rewritten = 0
+        last_id = int(self.get_setting(COMPRESSED_THROUGH_SETTING) or 0)
+        # newer posts were stored compressed, the scan stops at the newest post there is now
+        high_water = self.session.execute(select(func.max(Article.post_id))).scalar() or 0
+        while last_id < high_water:
+            # plain text rows are the ones to rewrite, and walking by post_id passes each one once,
+            # including short bodies that stay text because compressing them does not pay
+            rows = self.session.execute(select(Article.post_id, Article.article_text)
+                                        .where(Article.post_id > last_id, Article.post_id <= high_water,
+                                               func.typeof(Article.article_text) == 'text')
+                                        .order_by(Article.post_id).limit(batch_size)).all()
+            last_id = rows[-1].post_id if len(rows) == batch_size else high_water
+            updates = [{'b_post_id': post_id, 'b_article_text': article_text} for post_id, article_text in rows
+                       if isinstance(compressed_text.process_bind_param(article_text, None), bytes)]
+            if updates:
+                self.session.execute(statement, updates)
+                rewritten += len(updates)
+                logger.info("Compressed %s article bodies.", rewritten)
+            # progress commits with the batch, an interrupted run picks up where it stopped
+            self.set_setting(COMPRESSED_THROUGH_SETTING, str(last_id))
+            self.session.commit()
+        return rewritten
+
+    def space_used(self):
+        """ bytes the sqlite database takes and how many of those are free pages """
+        page_size, page_count, free_pages = (self.session.execute(text(f'PRAGMA {name}')).scalar()
+                                             for name in ('page_size', 'page_count', 'freelist_count'))
+        return {'bytes': page_count * page_size, 'free_bytes': free_pages * page_size}
+
+    def vacuum(self, full=False):
+        """ gives free pages back to the file system
+        the incremental vacuum only releases pages that are entirely free, which is cheap but leaves
+        the half empty pages pruned posts sit on; full rebuilds the file with VACUUM and also switches
+        an older database to incremental vacuum """
+        self.session.commit()
+        with self.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            if not full and connection.exec_driver_sql('PRAGMA auto_vacuum').scalar() == 2:
+                logger.info("Running an incremental vacuum.")
+                # the sqlite3 module steps a statement without result columns only once, which frees a
+                # single page; executescript runs it to completion
+                connection.connection.driver_connection.executescript('PRAGMA incremental_vacuum;')
+            else:
+                logger.info("Running a full vacuum.")
+                connection.exec_driver_sql('PRAGMA auto_vacuum=INCREMENTAL')
+                connection.exec_driver_sql('VACUUM')
+            # fold the write ahead log back in, otherwise the reclaimed pages just move to the -wal file
+            connection.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+
+    def find_new_guids(self, feed_id, guids):
+        """ returns the set of guids not yet stored for the feed, checked with one indexed query per chunk """
+        new_guids = set(guids)
+        for chunk in chunked(list(new_guids)):
+            stored = self.session.execute(select(Article.guid).where(Article.feed_id == feed_id,
+                                                                     Article.guid.in_(chunk)))
+            new_guids.difference_update(stored.scalars())
+        return new_guids
 
 
 class HTMLNormalizer():
     """ HTML operations to remoe tags we aren't interested and normalize and enrich other tags """
 
     def __init__(self, appconfig):
+        from lxml.html.clean import Cleaner
         self.config = appconfig
         # setup lxml's html cleaner
         self.cleaner = Cleaner()
@@ -134,56 +572,199 @@ class HTMLNormalizer():
         self.cleaner.javascript = True  # activate the javascript filter
         self.cleaner.remove_tags = ['span']  # some spans have text inside we want to keep
         self.cleaner.kill_tags = ['br']  # just axe this tag altogether, including children nodes
+        self.cleaner.safe_attrs = self.cleaner.safe_attrs | {'srcset'}  # responsive images keep their candidates
+
+    # attributes dropped from every tag, email markup puts its own image sizes back later
+    stripped_attributes = ('class', 'id', 'style', 'width', 'height', 'border')
+    # attributes holding a url, per tag, that are made absolute
+    url_attributes = {'img': ('src', 'srcset'), 'source': ('src', 'srcset'), 'a': ('href',)}
+
+    def normalize(self, input_html, link=None, email_markup=False):
+        """ cleans html, strips attributes, makes image paths absolute and optionally adds email markup
+        with a single parse, a single walk over the tree and a single serialize """
+        import lxml.html
+        domhtml = lxml.html.fromstring(input_html)
+        self.cleaner(domhtml)
+        self._rewrite_tree(domhtml, strip=True, link=link, email_markup=email_markup)
+        return lxml.html.tostring(domhtml).decode("utf-8")
 
     def clean_html(self, input_html):
         """ removes several tags from html """
-        attributes = ['class', 'id', 'style', 'width', 'height', 'border']
-        cleaner_html = self.cleaner.clean_html(input_html)
-
-        domhtml = lxml.html.fromstring(cleaner_html)
-
-        for attribute in attributes:
-            # xpath for attribute looks like: '//*[@id]'
-            for tag in domhtml.xpath(f'//*[@{attribute}]'):
-                # For each element with a class attribute, remove that class attribute
-                tag.attrib.pop(attribute)
-        return lxml.html.tostring(domhtml).decode("utf-8")
+        return self.normalize(input_html)
 
     def add_full_image_path(self, article, link):
-        """ if relative path is in html, make it an absolute path """
+        """ make relative image and link urls in html absolute against link """
+        import lxml.html
         domarticle = lxml.html.fromstring(article.encode("utf-8"))
-        last_index = link.rindex('.')
-        last_index = last_index + 4
-        link_prefix = link[0: last_index]
-        for img in domarticle.xpath('//img'):
-            if 'http' not in img.attrib['src']:
-                img.attrib['src'] = link_prefix + img.attrib['src']
-
+        self._rewrite_tree(domarticle, link=link)
         return lxml.html.tostring(domarticle).decode("utf-8")
 
-    def add_email_markup(self, article):
-        """ standaridze sizes on images in html """
-        attrs = self.config.get_email_image_styles()
+    def add_email_markup(self, article, digest_images=None):
+        """ standaridze sizes on images in html
+        with digest_images the images are pointed at the newsletter's own copies """
+        import lxml.html
         domarticle = lxml.html.fromstring(article.encode("utf-8"))
-
-        for img in domarticle.xpath('//img'):
-            img.attrib['width'] = str(attrs['width'])
-            img.attrib['height'] = str(attrs['height'])
-            img.attrib['border'] = str(attrs['border'])
+        self._rewrite_tree(domarticle, email_markup=True)
+        if digest_images is not None:
+            images = [tag for tag in domarticle.iter('img') if tag.get('src')]
+            sources = digest_images.sources([tag.get('src') for tag in images])
+            for tag in images:
+                if tag.get('src') in sources:
+                    tag.set('src', sources[tag.get('src')])
+                    tag.attrib.pop('srcset', None)  # would point the client back at the publisher
         return lxml.html.tostring(domarticle).decode("utf-8")
 
+    def _rewrite_tree(self, domhtml, strip=False, link=None, email_markup=False):
+        """ applies every per-tag rewrite in one pass over an already parsed tree
+        link is the url relative links and images resolve against """
+        url_base = _http_base(link) if link else None
+        if email_markup:
+            attrs = self.config.get_email_image_styles()
+            image_markup = [(name, str(attrs[name])) for name in ('width', 'height', 'border')]
+
+        for tag in domhtml.iter():
+            if not isinstance(tag.tag, str):
+                continue  # comments and processing instructions have no attributes
+            if strip:
+                for attribute in self.stripped_attributes:
+                    tag.attrib.pop(attribute, None)
+            if url_base is not None:
+                for attribute in self.url_attributes.get(tag.tag, ()):
+                    value = tag.get(attribute)
+                    if value:
+                        tag.set(attribute, resolve_srcset(url_base, value) if attribute == 'srcset'
+                                else resolve_url(url_base, value))
+            if email_markup and tag.tag == 'img':
+                for name, value in image_markup:
+                    tag.attrib[name] = value
+
+
+# a url that starts with a scheme (http:, mailto:, data:, cid:, ...) is already absolute
+ABSOLUTE_URL = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*:')
+
+
+@functools.lru_cache(maxsize=1024)
+def _http_base(url):
+    """ url when it is an absolute http(s) url relative urls can resolve against, otherwise None
+    cached, since every post of a feed, and every url in it, resolves against the same few bases """
+    parts = urlparse(url)
+    return url if parts.scheme in ('http', 'https') and parts.netloc else None
+
+
+def resolve_url(url_base, url):
+    """ url made absolute against url_base, urls that already are absolute are left alone """
+    url = url.strip()
+    if ABSOLUTE_URL.match(url):
+        return url
+    return urljoin(url_base, url)
+
+
+def resolve_srcset(url_base, srcset):
+    """ every candidate url in a srcset made absolute, keeping its width or density descriptor """
+    candidates = []
+    position = 0
+    while True:
+        # candidates are separated by commas; a url is a run of non-space that may itself contain commas
+        while position < len(srcset) and (srcset[position].isspace() or srcset[position] == ','):
+            position += 1
+        if position >= len(srcset):
+            break
+        end = position
+        while end < len(srcset) and not srcset[end].isspace():
+            end += 1
+        url = srcset[position:end]
+        descriptor = ''
+        if url.endswith(','):
+            url = url.rstrip(',')
+            position = end
+        else:
+            comma = srcset.find(',', end)
+            comma = len(srcset) if comma == -1 else comma
+            descriptor = srcset[end:comma].strip()
+            position = comma + 1
+        candidates.append(f'{resolve_url(url_base, url)} {descriptor}'.rstrip())
+    return ', '.join(candidates)
+
+
+def entry_base(post, link):
+    """ the url relative links in an entry resolve against: the xml:base feedparser
+    reports for its content, else the article link """
+    detail = post.content[0] if "content" in post else post.get("summary_detail")
+    url_base = detail.get("base") if detail else None
+    return url_base if url_base and _http_base(url_base) else link
+
+
+def entry_html(post):
+    """ pulls the raw html out of a feed entry as plain data: a source of
+    'content', 'description' or None, and the html itself """
+    if "content" in post:
+        return "content", post.content[0].value
+    if "description" in post:
+        return "description", post.description
+    return None, None
+
+
+def normalize_entry_html(normalizer, source, html, link):
+    """ turns the raw html of an entry into the article text we store
+    link is the url its relative links resolve against, see entry_base """
+    if source == "content":
+        if not html:
+            return normalizer.add_full_image_path("No Content Provided in this article.", link)
+        return normalizer.normalize(html, link)
+    if source == "description":
+        return normalizer.normalize(html, link)
+    return "No article text is available. Go to the site to read this article."
+
+
+# each process in the cleaning pool builds one normalizer, lxml's Cleaner does not pickle
+_process_normalizer = None
+
+
+def _init_clean_process():
+    """ initializer for the cleaning process pool """
+    global _process_normalizer
+    _process_normalizer = HTMLNormalizer(None)
+
+
+def _normalize_in_process(source, html, link):
+    """ normalize_entry_html for plain data sent to the cleaning process pool """
+    return normalize_entry_html(_process_normalizer, source, html, link)
+
 
 class FeedAcquirer():
     """ Parses rss feed and stores new posts """
 
-    def __init__(self, dal, appconfig):
+    def __init__(self, dal, appconfig, metrics=None):
         self.dal = dal
         self.config = appconfig
+        self.metrics = metrics if metrics is not None else RunMetrics()
         # move this to dependency injection?
         self.cleaner = HTMLNormalizer(appconfig)
+        # first wait after a failure, doubled for each failure in a row
+        self.backoff_base = timedelta(hours=1)
+        self.backoff_max = timedelta(days=7)
+        # one semaphore per host so a single site never gets hammered by the worker pool
+        self._host_slots = {}
+        self._host_lock = threading.Lock()
+        # created on the first batch big enough to be worth the process startup
+        self._clean_executor = None
+        self.feed_cache = None
+        if appconfig.get_cache_dir() is not None:
+            self.feed_cache = FeedCache(appconfig.get_cache_dir(), appconfig.get_cache_max_mb() * 1024 * 1024,
+                                        appconfig.get_cache_max_days() * 24 * 3600)
+        # keep-alive connections shared by the worker threads, made on the first download
+        self.http_pool = None
+        self._http_pool_lock = threading.Lock()
 
     def parse_rss_post(self, post):
         """ parses rss feed for information this aggregator requires """
+        article = self.extract_post_identity(post)
+        if article is not None:
+            self.normalize_post_content(article, post)
+        return article
+
+    def extract_post_identity(self, post):
+        """ cheap first stage: reads link, title, guid and dates without touching the html content """
         article = Article()
 
         # Assume that all rss feeds have link populated
@@ -216,59 +797,325 @@ class FeedAcquirer():
             article.pub_date = post.published
         else:
             article.pub_date = datetime.now().strftime("%Y%m%d")
-
-        if "content" in post:
-            if not post.content[0].value:
-                article.article_text = "No Content Provided in this article."
-            else:
-                article.article_text = self.cleaner.clean_html(post.content[0].value)
-            article.article_text = self.cleaner.add_full_image_path(article.article_text, article.link)
-        else:
-            if "description" in post:
-                article.article_text = self.cleaner.clean_html(post.description)
-            else:
-                article.article_text = \
-                    "No article text is available. Go to the site to read this article."
         return article
 
-    def store_new_content(self, feed):
-        """ stores new posts in our database, so we will never send an email with them again """
-        # get the feed data from the url
-        rss_feed = feedparser.parse(feed.xmlUrl)
+    def normalize_post_content(self, article, post):
+        """ expensive second stage: cleans the html content, only worth running for new posts """
+        article.article_text = normalize_entry_html(self.cleaner, *entry_html(post), entry_base(post, article.link))
+
+    def normalize_posts(self, posts):
+        """ runs the second stage for a list of (article, entry) pairs,
+        fanning out to the cleaning process pool when the batch is large enough """
+        pool = self._clean_pool(len(posts))
+        if pool is None:
+            for article, entry in posts:
+                self.normalize_post_content(article, entry)
+            return
+        jobs = [entry_html(entry) + (entry_base(entry, article.link),) for article, entry in posts]
+        chunksize = max(1, len(jobs) // (self.config.get_clean_processes() * 4))
+        article_texts = pool.map(_normalize_in_process, *zip(*jobs), chunksize=chunksize)
+        for (article, _), article_text in zip(posts, article_texts):
+            article.article_text = article_text
+
+    def _clean_pool(self, job_count):
+        """ returns the cleaning process pool, or None when the batch should be cleaned in this process """
+        processes = self.config.get_clean_processes()
+        if processes <= 1 or job_count < self.config.get_clean_threshold():
+            return None
+        if self._clean_executor is None:
+            logger.info("Starting %s processes to clean html.", processes)
+            from concurrent.futures import ProcessPoolExecutor
+            import multiprocessing
+            # spawn, not fork: the fetch threads may hold locks a forked child would inherit
+            self._clean_executor = ProcessPoolExecutor(max_workers=processes,
+                                                       mp_context=multiprocessing.get_context('spawn'),
+                                                       initializer=_init_clean_process)
+        return self._clean_executor
+
+    def shutdown_clean_pool(self):
+        """ stops the cleaning processes, the next large batch starts a new pool """
+        if self._clean_executor is not None:
+            self._clean_executor.shutdown()
+            self._clean_executor = None
+
+    def _timed_fetch(self, xml_url, etag, modified):
+        """ fetch_feed plus the seconds it took """
+        start = time.monotonic()
+        rss_feed = self.fetch_feed(xml_url, etag, modified)
+        return rss_feed, time.monotonic() - start
+
+    def fetch_feed(self, xml_url, etag=None, modified=None):
+        """ downloads and parses a feed, touches no database state so it is safe on a worker thread
+        etag and modified make the request conditional, an unchanged feed comes back as a 304 without entries """
+        import http.client
+        import feedparser
+        import feedparser.http
+        if self.config.get_replay():
+            with self.metrics.timer('parse'):
+                return self.replay_feed(xml_url)
+        if urlparse(xml_url).scheme not in ('http', 'https'):
+            # local files and inline documents have no response worth caching
+            with self.metrics.timer('parse'):
+                return feedparser.parse(xml_url, etag=etag, modified=modified)
+        response = feedparser.FeedParserDict(bozo=False, entries=[], feed=feedparser.FeedParserDict(), headers={})
+        with self._host_slot(xml_url), self.metrics.timer('download'):
+            try:
+                http_pool = self._http_pool()
+                if http_pool is not None:
+                    body = http_pool.get(xml_url, etag, modified, feedparser.USER_AGENT,
+                                         feedparser.http.ACCEPT_HEADER, result=response)
+                else:
+                    body = feedparser.http.get(xml_url, etag, modified, result=response)
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                # the same bozo result feedparser.parse gives for a failed download; feedparser's own
+                # download lets timeouts and broken responses through, wrapped they count as a failed fetch
+                if not isinstance(e, urllib.error.URLError):
+                    e = urllib.error.URLError(e)
+                response.update(bozo=True, bozo_exception=e)
+                return response
+        if self.feed_cache is not None and body and response.get('status', 200) < 300:
+            self.feed_cache.store(xml_url, body, self._replay_headers(response))
+        with self.metrics.timer('parse'):
+            return self.parse_response(body, response)
+
+    def _http_pool(self):
+        """ the shared connection pool, or None when a proxy is configured in the environment:
+        feedparser's own urllib download honours the proxy, the pool does not """
+        with self._http_pool_lock:
+            if self.http_pool is None:
+                import urllib.request
+                if urllib.request.getproxies():
+                    return None
+                from nibbler.httpclient import HttpConnectionPool
+                self.http_pool = HttpConnectionPool(self.config.get_feed_timeout(), self.config.get_per_host_limit(),
+                                                    self.config.get_feed_max_mb() * 1024 * 1024)
+            return self.http_pool
+
+    def _replay_headers(self, response):
+        """ the response headers parse_response needs to parse a cached body the same way again """
+        headers = dict(response['headers'])
+        headers.pop('content-encoding', None)  # the cached body is already decompressed
+        headers.setdefault('content-location', response.get('href', ''))
+        return headers
+
+    def parse_response(self, body, response):
+        """ parses a downloaded body, keeping the status and validators of the response it came in """
+        import feedparser
+        if not body:
+            return response
+        rss_feed = feedparser.parse(body, response_headers=self._replay_headers(response))
+        for key in ('status', 'href', 'etag', 'modified'):
+            if key in response:
+                rss_feed[key] = response[key]
+        return rss_feed
+
+    def replay_feed(self, xml_url):
+        """ parses the last body cached for xml_url instead of going to the network
+        the result has no status, so a replay never overwrites validators or counts as a failed fetch """
+        import feedparser
+        cached = self.feed_cache.load(xml_url)
+        if cached is None:
+            logger.warning("No cached response for %s to replay.", xml_url)
+            return feedparser.FeedParserDict(bozo=True, bozo_exception=LookupError(f"{xml_url} is not cached"),
+                                             entries=[], feed=feedparser.FeedParserDict(), headers={})
+        body, headers = cached
+        return self.parse_response(body, feedparser.FeedParserDict(headers=headers))
+
+    def _host_slot(self, xml_url):
+        """ returns the semaphore that caps concurrent requests to the host of xml_url """
+        host = urlparse(xml_url).netloc
+        with self._host_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.config.get_per_host_limit())
+            return self._host_slots[host]
+
+    def fetch_failed(self, rss_feed):
+        """ true when the fetch got an http error or no response at all """
+        status = rss_feed.get('status')
+        if status is not None:
+            return status >= 400
+        # feedparser reports dns failures, refused connections and timeouts as a bozo URLError
+        return isinstance(rss_feed.get('bozo_exception'), OSError)
+
+    def record_failure(self, feed, now):
+        """ count a failed fetch, back off exponentially and quarantine the feed past the threshold """
+        feed.error_count = (feed.error_count or 0) + 1
+        feed.consecutive_failures = (feed.consecutive_failures or 0) + 1
+        backoff = min(self.backoff_base * 2 ** (feed.consecutive_failures - 1), self.backoff_max)
+        feed.backoff_until = now + backoff
+        logger.warning("Fetching feed %s failed %s times in a row, next try after %s.",
+                       feed.feed_id, feed.consecutive_failures, feed.backoff_until)
+        if feed.consecutive_failures >= self.config.get_quarantine_after():
+            logger.warning("Quarantining feed %s at %s.", feed.feed_id, feed.xmlUrl)
+            feed.quarantined = True
+
+    def store_entries(self, feed, rss_feed, latency=None):
+        """ stores the new posts of an already parsed feed, must run on the database thread
+        latency is how many seconds the fetch took, when it was measured """
+        status = rss_feed.get('status')
+        feed.last_status = status
+        feed.last_fetched = datetime.now()
+        if latency is not None:
+            if feed.avg_fetch_latency is None:
+                feed.avg_fetch_latency = latency
+            else:
+                feed.avg_fetch_latency = 0.8 * feed.avg_fetch_latency + 0.2 * latency
+        if self.fetch_failed(rss_feed):
+            self.metrics.count('feeds_failed')
+            self.record_failure(feed, feed.last_fetched)
+            self.dal.session.commit()
+            return []
+        feed.consecutive_failures = 0
+        feed.backoff_until = None
+        if status == 304:
+            self.metrics.count('feeds_not_modified')
+            logger.info("Feed %s is not modified since the last fetch.", feed.feed_id)
+            self.dal.session.commit()
+            return []
+        if status is not None and status < 300:
+            # only a successful response carries validators worth remembering
+            feed.etag = rss_feed.get('etag')
+            feed.modified = rss_feed.get('modified')
+            ttl = rss_feed.get('feed', {}).get('ttl')
+            feed.ttl = int(ttl) if ttl and ttl.isdigit() else None
 
+        articles = []
         for entry in rss_feed.entries:
-            article = self.parse_rss_post(entry)
+            article = self.extract_post_identity(entry)
             if article is not None:  # article comes back none if there is an error
                 article.feed_id = feed.feed_id
-                # if post is already in the database, skip it
-                if not self.dal.is_post_in_db(article.guid):
-                    posts_to_email.append(article.guid)
-                    self.dal.store_post(article)
+                articles.append((article, entry))
             else:
                 logger.warning("Could not parse an article in feed %s so skipped it.", feed.feed_id)
-        return posts_to_email
+
+        # if post is already in the database, skip it before paying for the html cleaning
+        with self.metrics.timer('db'):
+            new_guids = self.dal.find_new_guids(feed.feed_id, [article.guid for article, _ in articles])
+        new_posts = []
+        for article, entry in articles:
+            # a feed can repeat a guid, only its first entry is stored
+            if article.guid in new_guids:
+                new_guids.discard(article.guid)
+                new_posts.append((article, entry))
+        self.metrics.count('entries_seen', len(articles))
+        self.metrics.count('entries_new', len(new_posts))
+        with self.metrics.timer('clean'):
+            self.normalize_posts(new_posts)
+        new_articles = [article for article, _ in new_posts]
+        with self.metrics.timer('db'):
+            if new_articles:
+                # store_posts also puts them on the queue for the next newsletter
+                self.dal.store_posts(new_articles)
+            self.dal.session.commit()
+        return [article.guid for article in new_articles]
+
+    def store_new_content(self, feed):
+        """ stores new posts in our database, so we will never send an email with them again """
+        # get the feed data from the url
+        rss_feed = self.fetch_feed(feed.xmlUrl, feed.etag, feed.modified)
+        return self.store_entries(feed, rss_feed)
+
+    def acquire_feeds(self, feeds):
+        """ fetch and parse feeds on a pool of worker threads while this thread does every database write
+        returns the guids stored for each feed that was fetched """
+        stored = {}
+        previous_timeout = socket.getdefaulttimeout()
+        # the connection pool enforces the timeout on the whole download, but feedparser's download
+        # used behind a proxy has no timeout argument, so there it only bounds each socket operation
+        socket.setdefaulttimeout(self.config.get_feed_timeout())
+        try:
+            with ThreadPoolExecutor(max_workers=self.config.get_max_workers()) as executor:
+                futures = {}
+                for feed in feeds:
+                    logger.info("Getting content for feed_id %s from %s.", feed.feed_id, feed.xmlUrl)
+                    futures[executor.submit(self._timed_fetch, feed.xmlUrl, feed.etag, feed.modified)] = feed
+                for future in as_completed(futures):
+                    feed = futures[future]
+                    try:
+                        rss_feed, latency = future.result()
+                    except Exception as e:
+                        self.metrics.count('fetch_errors')
+                        logger.error("Fetching feed_id %s failed with error: %s", feed.feed_id, e)
+                        # backs off like any failed fetch, a feed that breaks the fetch is not retried every pass
+                        feed.last_fetched = datetime.now()
+                        self.record_failure(feed, feed.last_fetched)
+                        self.dal.session.commit()
+                        continue
+                    self.metrics.count('feeds_fetched')
+                    self.metrics.feed_fetched(feed.feed_id, latency)
+                    stored[feed] = self.store_entries(feed, rss_feed, latency)
+        finally:
+            socket.setdefaulttimeout(previous_timeout)
+            self.shutdown_clean_pool()
+            self.close_http_pool()
+        if self.feed_cache is not None and not self.config.get_replay():
+            self.feed_cache.evict()
+        return stored
+
+    def close_http_pool(self):
+        """ close the idle feed connections and count the connections and requests of this pass """
+        if self.http_pool is None:
+            return
+        self.http_pool.close()
+        connects, requests = self.http_pool.connects, self.http_pool.requests
+        self.http_pool.connects = self.http_pool.requests = 0
+        self.metrics.count('http_connections', connects)
+        self.metrics.count('http_requests', requests)
 
     def load_new_feeds(self):
-        """ go through feeds to which we subscribe and add any new feeds to our database """
-        sub_file = os.path.join(self.config.sub_dir, 'subscriptions.xml')
-        outline = opml.parse(sub_file)
-        # if there are feeds in subscription.xml that are not in the database, add them
-        for feed in outline:
-            if not self.dal.session.query(Feed).filter(Feed.xmlUrl == feed.xmlUrl).all():
-                self.dal.session.add(Feed(feed.text, feed.xmlUrl))
-                self.dal.session.commit()
+        """ go through the subscriptions.xml of every subscriber and sync our database with them,
+        a feed is fetched once however many subscribers read it
+        a subscriber whose file is unchanged since the last sync is skipped entirely """
+        from lxml.etree import XMLSyntaxError
+        subscribers, removed = self.dal.sync_subscribers(self.config.get_subscribers())
+        changed = removed > 0
+        for subscriber in subscribers:
+            try:
+                changed = self.load_subscriptions(subscriber) or changed
+            except (OSError, XMLSyntaxError) as e:
+                # one missing or broken file keeps that subscriber's last subscriptions, the rest go on
+                self.dal.session.rollback()
+                logger.error("Could not read the subscriptions of %s: %s", subscriber.name, e)
+        if changed:
+            added, removed, returning = self.dal.sync_feeds(self.dal.subscribed_feeds())
+            logger.info("Synced feeds: %s added, %s removed, %s resubscribed.", added, removed, returning)
+
+    def load_subscriptions(self, subscriber):
+        """ sync one subscriber's subscriptions with their subscriptions.xml, returns True if they changed """
+        signature_key, digest_key = opml_setting_keys(subscriber.name)
+        stat = os.stat(subscriber.sub_file)
+        signature = f"{stat.st_mtime_ns}:{stat.st_size}"
+        if self.dal.get_setting(signature_key) == signature:
+            logger.debug("%s is unchanged, skipping the subscription sync", subscriber.sub_file)
+            return False
+        with open(subscriber.sub_file, 'rb') as opml_file:
+            opml_bytes = opml_file.read()
+        digest = hashlib.sha256(opml_bytes).hexdigest()
+        changed = self.dal.get_setting(digest_key) != digest
+        if changed:
+            from nibbler import opml
+            subscribed = {}
+            # every feed in the file, including those inside folders
+            for outline in opml.iter_feeds(io.BytesIO(opml_bytes)):
+                subscribed.setdefault(outline.xmlUrl, outline)
+            self.dal.set_setting(digest_key, digest)
+            added, removed = self.dal.sync_subscriptions(subscriber.subscriber_id, subscribed)
+            logger.info("Synced subscriptions of %s: %s added, %s removed.", subscriber.name, added, removed)
+        # touched but identical files only need the new signature remembered
+        self.dal.set_setting(signature_key, signature)
+        self.dal.session.commit()
+        return changed
 
     def main(self):
         """ Workflow for the acquring feeds """
         logger.info("Starting to Acquire Content.")
 
-        self.load_new_feeds()
-        # get all the feeds to aggregate
-        feeds = self.dal.session.query(Feed).all()
+        with self.metrics.timer('acquire'):
+            self.load_new_feeds()
+            # get all the feeds to aggregate
+            feeds = self.dal.fetchable_feeds(datetime.now()).all()
 
-        for feed in feeds:
-            logger.info("Getting content for feed_id %s from %s.", feed.feed_id, feed.xmlUrl)
-            self.store_new_content(feed)
+            self.acquire_feeds(feeds)
 
         logger.info("Finished Acquiring Content.")
 
@@ -279,77 +1126,65 @@ class EmailService():
     def __init__(self):
         logger.info("Init for EmailService")
 
-    def write_email_to_file(self, filename, email_msg):
-        """write the email out to a file"""
-        text = email_msg.as_string()
-        logger.info("Writing the file: %s ", filename)
-        file = open(filename, "w")
-        for line in text:
-            file.write(line)
-        file.close()
-
-    def build_html_email(self, from_email, to_email, subject, text, html, images):
-        """generic method to build an email, should work for any input"""
-        logger.info("Creating an html email file. ")
-        # couldn't figure out how to get the email to display so that it wasn't base64 encoded
-        # this post on the interweb pointed out this line
-        # http://bugs.python.org/issue12552
-        charset.add_charset('utf-8', charset.SHORTEST, charset.QP)
-
-        # Create message container - the correct MIME type is multipart/alternative.
-        msg_root = MIMEMultipart('alternative')
-        msg_root['Subject'] = subject
-        msg_root['From'] = from_email
-        msg_root['To'] = to_email
-
-        # Record the MIME types of both parts - text/plain and text/html.
-        plain_text = MIMEText(text, 'plain')
-        html_text = MIMEText(html, 'html')
-
-        logger.info("Added headers.")
-
-        # Attach parts into message container.
-        # According to RFC 2046, the last part of a multipart message, in this case
-        # the HTML message, is best and preferred.
-        msg_root.attach(plain_text)
-        msg_root.attach(html_text)
-        logger.info("Added body.")
-
-        for image_id in images:
-            logger.info("Added image: %s ", image_id)
-            # This example assumes the image is in the current directory
-            image_path = images[image_id]
-            try:
-                fp = open(image_path, 'rb')
-                msg_image = MIMEImage(fp.read())
-                fp.close()
-            except FileNotFoundError:
-                logger.error("Could not attach image file %s", image_path)
-                logger.error(traceback.format_exc())
-
-            # Define the image's ID as referenced above
-            msg_image.add_header('Content-ID', f'<{image_id}>')
-            msg_root.attach(msg_image)
-
-        return msg_root
-
-    def send_smtp_email(self, sender, recipient, msg, host, port, smtp_username, smtp_password):
-        """send any email using smtp"""
-        # Try to send the message.
-        try:
-            server = smtplib.SMTP(host, port)
-            server.ehlo()
-            server.starttls()
-            # stmplib docs recommend calling ehlo() before & after starttls()
-            server.ehlo()
-            server.login(smtp_username, smtp_password)
-            server.sendmail(sender, recipient, msg.as_string())
-            server.close()
-        # Display an error message if something goes wrong.
-        except Exception as e:
-            logger.error("Send email message failed with error: %s", e)
-        else:
-            logger.info("Send email message to: %s", recipient)
+    def write_html_email_file(self, filename, from_email, to_email, subject, text, html_chunks, images):
+        """stream a multipart/alternative email straight to a file
+        html_chunks can be any iterable of strings, like a jinja2 template stream, so the
+        html is encoded a line at a time and never held in memory as one string"""
+        from email.header import Header
+        logger.info("Streaming an html email to the file: %s ", filename)
+        boundary = f"==============={uuid.uuid4().hex}=="
+        with open(filename, "wb") as out:
+            out.write(f'Content-Type: multipart/alternative; boundary="{boundary}"\n'
+                      'MIME-Version: 1.0\n'
+                      f'Subject: {Header(subject).encode()}\n'
+                      f'From: {from_email}\n'
+                      f'To: {to_email}\n\n'.encode("ascii"))
+            for subtype, chunks in (('plain', [text]), ('html', html_chunks)):
+                out.write(f'--{boundary}\n'
+                          f'Content-Type: text/{subtype}; charset="utf-8"\n'
+                          'MIME-Version: 1.0\n'
+                          'Content-Transfer-Encoding: quoted-printable\n\n'.encode("ascii"))
+                self._write_quoted_printable(out, chunks)
+            for image_id, image_path in images.items():
+                logger.info("Added image: %s ", image_id)
+                mime_type = mimetypes.guess_type(image_path)[0] or 'application/octet-stream'
+                try:
+                    image_file = open(image_path, 'rb')
+                except FileNotFoundError:
+                    logger.error("Could not attach image file %s", image_path)
+                    continue
+                with image_file:
+                    out.write(f'--{boundary}\n'
+                              f'Content-Type: {mime_type}\n'
+                              'MIME-Version: 1.0\n'
+                              'Content-Transfer-Encoding: base64\n'
+                              f'Content-ID: <{image_id}>\n\n'.encode("ascii"))
+                    # a multiple of 57 bytes encodes to whole 76 character lines
+                    for block in iter(lambda: image_file.read(57 * 1024), b''):
+                        out.write(base64.encodebytes(block))
+            out.write(f'--{boundary}--\n'.encode("ascii"))
+
+    def _write_quoted_printable(self, out, chunks):
+        """encode text chunks as quoted-printable, a complete line at a time"""
+        pending = b''
+        for chunk in chunks:
+            pending += chunk.encode("utf-8")
+            lines = pending.split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                out.write(binascii.b2a_qp(line.rstrip(b'\r'), istext=True) + b'\n')
+        out.write(binascii.b2a_qp(pending, istext=True) + b'\n')
+
+
+@functools.lru_cache(maxsize=None)
+def template_environment(bytecode_dir=None):
+    """ one jinja2 environment per process, its compiled templates also cached on disk so a new
+    process skips compiling them; bytecode_dir None uses jinja2's private directory in the temp dir """
+    from jinja2 import Environment, FileSystemBytecodeCache, PackageLoader
+    if bytecode_dir is not None:
+        ensure_dir(bytecode_dir)
+    return Environment(loader=PackageLoader('nibbler', 'templates'),
+                       bytecode_cache=FileSystemBytecodeCache(bytecode_dir))
 
 
 class NibblerNewsletter():
@@ -357,63 +1192,246 @@ class NibblerNewsletter():
     The idea is that another class could be made for a different email
     with entirely different rules to make an email"""
 
-    def __init__(self, dal, appconfig):
+    def __init__(self, dal, appconfig, metrics=None):
         logger.info("Init for BuildNibblerNewsletter")
         self.config = appconfig
+        self.metrics = metrics if metrics is not None else RunMetrics()
         self.resource_dir = os.path.join(self.config.work_dir, "resources")
         self.email = EmailService()
         self.dal = dal
+        # made on the first newsletter with images, shared by every subscriber's newsletter of the run
+        self.image_fetcher = None
 
         # move this to dependency injection?
         self.cleaner = HTMLNormalizer(appconfig)
 
-    def build_nibbler_newsletter(self, articles):
-        """copy/images that are nibbler specific are added to email"""
-        subject = f"Today's News Nibble -- {datetime.now().ctime()}"
-        env = Environment(loader=PackageLoader('nibbler', 'templates'))
-        template = env.get_template('nibble.html')
-        html = template.render(articles=articles)
-        text = "Today's News Nibble"
-        images = {"image1": os.path.join(self.resource_dir, "system.png"),
-                  "image2": os.path.join(self.resource_dir, "GitHub-Mark-Light-32px.png")}
-
-        return self.email.build_html_email(self.config.from_email, self.config.to_email, subject, text, html, images)
+    def write_nibbler_newsletter(self, articles, filename, to_email=None, images=None):
+        """stream the newsletter to a file, articles can be a generator and are rendered one at a time
+        images, by default the template's own, is read once the html is written so the articles can add to it"""
+        html_chunks = self._template().generate(articles=articles)
+        self.email.write_html_email_file(filename, self.config.from_email, to_email or self.config.to_email,
+                                         self._subject(), self._text(), html_chunks,
+                                         self._images() if images is None else images)
+
+    def _template(self):
+        """the jinja2 template for the newsletter body"""
+        bytecode_dir = None
+        if self.config.get_cache_dir() is not None:
+            bytecode_dir = os.path.join(self.config.get_cache_dir(), 'templates')
+        return template_environment(bytecode_dir).get_template('nibble.html')
+
+    def _subject(self):
+        """subject line with today's date"""
+        return f"Today's News Nibble -- {datetime.now().ctime()}"
+
+    def _text(self):
+        """plain text alternative for clients that do not show html"""
+        return "Today's News Nibble"
+
+    def _images(self):
+        """images referenced by content id in the base template"""
+        return {"image1": os.path.join(self.resource_dir, "system.png"),
+                "image2": os.path.join(self.resource_dir, "GitHub-Mark-Light-32px.png")}
+
+    def email_articles(self, post_ids, subscriber=None, digest_images=None):
+        """yield the articles for the newsletter with email markup, one at a time"""
+        # the articles come back detached, so the email markup is never flushed to the database
+        for article in self.dal.iter_posts_by_id(post_ids, subscriber):
+            article.article_text = self.cleaner.add_email_markup(article.article_text, digest_images)
+            logger.debug("Get content for %s from feed %s.", article.title, article.feed_title)
+            yield article
 
     def main(self):
         """Steps to build an email for nibbler. """
         logger.info("Starting to Build and Send the Nibbler Newsletter.")
-        articles = []
 
-        if posts_to_email:
-            for guid in posts_to_email:
-                article = self.dal.get_post(guid)
-                email_html = self.cleaner.add_email_markup(article.article_text)
-                article.article_text = email_html
-                articles.append(article)
-                logger.info("Get content for %s from feed %s.", article.title, article.feed_title)
-
-            msg = self.build_nibbler_newsletter(articles)
-            smtp = self.config.get_smtp_config()
-            email_filename = os.path.join(self.config.get_email_dir(),
-                                          f"nibbler_{datetime.now().strftime('%Y%m%d')}.eml")
-            if smtp is None:
-                # if no smtp is configured, still make some outut so put it on the file system
-                self.email.write_email_to_file(email_filename, msg)
-            else:
-                # SMTP is configured, but if email_dir is also configured,
-                # the let's also output to the file system
-                self.email.send_smtp_email(self.config.from_email, self.config.to_email, msg, smtp['host'], smtp['port'], smtp['username'], smtp['password'])
-                if self.config._email_dir is not None:
-                    self.email.write_email_to_file(email_filename, msg)
+        # the subscribers as configured for this run, a digest run need not follow an acquisition
+        subscribers, _ = self.dal.sync_subscribers(self.config.get_subscribers())
+        self.send_newsletters(subscribers)
 
         logger.info("Finished the Newsletter.")
 
+    def send_newsletter(self, subscriber=None):
+        """build and send one subscriber's newsletter from the posts queued for them"""
+        self.send_newsletters([subscriber])
+
+    def send_newsletters(self, subscribers):
+        """build every subscriber's newsletter, then hand them all to the smtp server in one batch
+        so the connections and their TLS handshakes and logins are shared between the messages"""
+        smtp = self.config.get_smtp_config()
+        # the message is always streamed to a file; when it is only being sent, that file is temporary
+        # (checked before get_email_dir, which fills in a default)
+        keep_files = smtp is None or self.config._email_dir is not None
+        digests = []
+        try:
+            for subscriber in subscribers:
+                # a snapshot of the queue; anything acquired while this runs waits for the next newsletter
+                post_ids = self.dal.pending_post_ids(subscriber)
+                if not post_ids:
+                    continue
+                to_email = self.config.to_email if subscriber is None else subscriber.email
+                name = '' if subscriber is None or subscriber.name == PRIMARY_SUBSCRIBER else f"{subscriber.name}_"
+                email_filename = os.path.join(self.config.get_email_dir(),
+                                              f"nibbler_{name}{datetime.now().strftime('%Y%m%d')}.eml")
+                if not keep_files:
+                    handle, email_filename = tempfile.mkstemp(suffix=".eml")
+                    os.close(handle)
+                digests.append((subscriber, to_email, post_ids, email_filename))
+                images = self._images()
+                digest_images = self._digest_images(images)
+                with self.metrics.timer('render'):
+                    self.write_nibbler_newsletter(self.email_articles(post_ids, subscriber, digest_images),
+                                                  email_filename, to_email, images)
+            delivered = [True] * len(digests)
+            if smtp is not None:
+                with self.metrics.timer('send'):
+                    delivered = self.deliver([(self.config.from_email, to_email, email_filename)
+                                              for _, to_email, _, email_filename in digests], smtp)
+        finally:
+            if not keep_files:
+                for *_, email_filename in digests:
+                    os.remove(email_filename)
+            self.close_image_fetcher()
+        for (subscriber, to_email, post_ids, _), accepted in zip(digests, delivered):
+            if accepted:
+                self.metrics.count('posts_delivered', len(post_ids))
+                self.dal.clear_pending(post_ids, subscriber)
+            else:
+                logger.warning("Newsletter to %s was not delivered, %s posts stay queued for the next one.",
+                               to_email, len(post_ids))
+
+    def _digest_images(self, attachments):
+        """the image stage for one newsletter, None unless an image mode is configured"""
+        mode = self.config.get_image_mode()
+        if mode is None:
+            return None
+        from nibbler.images import DigestImages
+        if self.image_fetcher is None:
+            import feedparser
+            from nibbler.httpclient import HttpConnectionPool
+            from nibbler.images import ImageCache, ImageFetcher
+            cache = ImageCache(os.path.join(self.config.get_cache_dir(), 'images'),
+                               self.config.get_image_cache_mb() * 1024 * 1024,
+                               self.config.get_cache_max_days() * 24 * 3600)
+            http_pool = HttpConnectionPool(self.config.get_feed_timeout(), self.config.get_per_host_limit(),
+                                           self.config.get_feed_max_mb() * 1024 * 1024)
+            styles = self.config.get_email_image_styles()
+            self.image_fetcher = ImageFetcher(cache, http_pool, self.config.get_image_workers(),
+                                              (styles['width'], styles['height']), agent=feedparser.USER_AGENT)
+        static_dir = self.config.get_image_static_dir()
+        if static_dir is not None:
+            ensure_dir(static_dir)
+        return DigestImages(self.image_fetcher, mode, attachments, static_dir, self.config.get_image_static_url())
+
+    def close_image_fetcher(self):
+        """close the image downloads' connections and trim the image cache"""
+        if self.image_fetcher is None:
+            return
+        self.image_fetcher.http_pool.close()
+        self.image_fetcher.cache.evict()
+        self.image_fetcher = None
+
+    def deliver(self, messages, smtp):
+        """send (sender, recipient, filename) messages over pooled connections, returns which were accepted;
+        with an outbox directory, accepted means queued there, and messages left from earlier runs go out too"""
+        from nibbler.delivery import DeliveryService
+        with DeliveryService(smtp, self.config.get_smtp_connections(), self.config.get_smtp_rate(),
+                             self.config.get_outbox_dir()) as delivery:
+            if not messages and delivery.outbox is not None:
+                delivery.flush()
+            delivered = delivery.deliver(messages) if messages else []
+        self.metrics.count('emails_accepted', sum(delivered))
+        return delivered
+
+
+class NibblerScheduler():
+    """Long-running mode: one warm database session, each feed polled on its own
+    interval and the newsletter built once a day"""
+
+    # longest sleep between checks, so new subscriptions are noticed reasonably soon
+    max_sleep = 300
+
+    def __init__(self, dal, appconfig, metrics=None):
+        logger.info("Init for NibblerScheduler")
+        self.dal = dal
+        self.config = appconfig
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self.acquirer = FeedAcquirer(dal, appconfig, self.metrics)
+        self.newsletter = NibblerNewsletter(dal, appconfig, self.metrics)
+        self.next_digest = self.next_digest_time(datetime.now())
+
+    def next_digest_time(self, now):
+        """the next time the clock reaches the configured digest hour"""
+        digest_time = now.replace(hour=self.config.get_digest_hour(), minute=0, second=0, microsecond=0)
+        if digest_time <= now:
+            digest_time += timedelta(days=1)
+        return digest_time
+
+    def schedule_feed(self, feed, new_posts, now):
+        """adapt the feed's interval to how often it publishes and set its next poll
+        the interval halves after new posts and grows by half after none, within the configured
+        bounds and never below the ttl the feed asks for"""
+        interval = feed.poll_interval or self.config.get_poll_min_minutes() * 60
+        interval = interval / 2 if new_posts else interval * 1.5
+        interval = max(self.config.get_poll_min_minutes() * 60, min(interval, self.config.get_poll_max_minutes() * 60))
+        if feed.ttl:
+            interval = max(interval, feed.ttl * 60)
+        feed.poll_interval = int(interval)
+        feed.next_poll = now + timedelta(seconds=feed.poll_interval)
+
+    def tick(self, now):
+        """poll the feeds that are due and build the newsletter if it is time,
+        returns the seconds to sleep before the next tick"""
+        self.acquirer.load_new_feeds()
+        feeds = self.dal.fetchable_feeds(now).filter(or_(Feed.next_poll.is_(None), Feed.next_poll <= now)).all()
+        if feeds:
+            logger.info("Polling %s feeds that are due.", len(feeds))
+            stored = self.acquirer.acquire_feeds(feeds)
+            for feed in feeds:
+                self.schedule_feed(feed, stored.get(feed), now)
+            self.dal.session.commit()
+        if now >= self.next_digest:
+            self.newsletter.main()
+            if self.config.has_retention():
+                # once a day, right after the digest has taken what it needs from the queue
+                NibblerCompactor(self.dal, self.config).main(full_vacuum=False)
+            self.next_digest = self.next_digest_time(now)
+
+        wake = self.next_digest
+        next_poll = self.dal.session.query(func.min(Feed.next_poll)).scalar()
+        if next_poll is not None:
+            wake = min(wake, next_poll)
+        return max(1, min((wake - datetime.now()).total_seconds(), self.max_sleep))
+
+    def serve(self):
+        """run until interrupted"""
+        logger.info("Starting the Nibbler scheduler.")
+        while True:
+            try:
+                delay = self.tick(datetime.now())
+            except Exception:
+                logger.exception("Scheduler tick failed, trying again later.")
+                self.dal.session.rollback()
+                delay = self.max_sleep
+            if self.config.get_metrics_file() is not None:
+                # totals since the scheduler started, as counters a collector can rate()
+                self.metrics.write(self.config.get_metrics_file())
+            time.sleep(delay)
+
 
 class NibblerConfig():
     """Processes configuration for Nibbler,
     current implementaton is to handle it as options on command line"""
 
-    def __init__(self, to_email, from_email, sub_dir, log_dir=None, smtp_ini=None, db_dir=None, email_dir=None):
+    def __init__(self, to_email, from_email, sub_dir, log_dir=None, smtp_ini=None, db_dir=None, email_dir=None,
+                 max_workers=None, per_host_limit=None, feed_timeout=None, db_batch_size=None,
+                 clean_processes=None, clean_threshold=None, mode=None,
+                 poll_min_minutes=None, poll_max_minutes=None, digest_hour=None, quarantine_after=None,
+                 cache_dir=None, cache_max_mb=None, cache_max_days=None, replay=None,
+                 log_level=None, metrics_file=None, retention_days=None, retention_count=None, retention_ini=None,
+                 subscribers_ini=None, smtp_connections=None, smtp_rate=None, outbox_dir=None,
+                 feed_max_mb=None, image_mode=None, image_static_dir=None, image_static_url=None,
+                 image_workers=None, image_cache_mb=None):
         logger.info("Initializing configuration")
         # Load configuration
         # work_dir is where nibbler executable is contained, need this path to find resources
@@ -426,6 +1444,37 @@ class NibblerConfig():
         self._db_dir = db_dir
         self._email_dir = email_dir
         self._smtp_ini = smtp_ini
+        self._max_workers = max_workers
+        self._per_host_limit = per_host_limit
+        self._feed_timeout = feed_timeout
+        self._db_batch_size = db_batch_size
+        self._clean_processes = clean_processes
+        self._clean_threshold = clean_threshold
+        self._mode = mode
+        self._poll_min_minutes = poll_min_minutes
+        self._poll_max_minutes = poll_max_minutes
+        self._digest_hour = digest_hour
+        self._quarantine_after = quarantine_after
+        self._cache_dir = cache_dir
+        self._cache_max_mb = cache_max_mb
+        self._cache_max_days = cache_max_days
+        self._replay = replay
+        self._log_level = log_level
+        self._metrics_file = metrics_file
+        self._retention_days = retention_days
+        self._retention_count = retention_count
+        self._retention_ini = retention_ini
+        self._feed_retention = None
+        self._subscribers_ini = subscribers_ini
+        self._smtp_connections = smtp_connections
+        self._smtp_rate = smtp_rate
+        self._outbox_dir = outbox_dir
+        self._feed_max_mb = feed_max_mb
+        self._image_mode = image_mode
+        self._image_static_dir = image_static_dir
+        self._image_static_url = image_static_url
+        self._image_workers = image_workers
+        self._image_cache_mb = image_cache_mb
 
     def get_log_dir(self):
         """Get log dir from config or set a default"""
@@ -441,6 +1490,145 @@ class NibblerConfig():
         logger.debug("email_dir: %s", self._email_dir)
         return self._email_dir
 
+    def get_max_workers(self):
+        """Number of feeds fetched at the same time"""
+        if self._max_workers is None:
+            self._max_workers = 8
+        return self._max_workers
+
+    def get_per_host_limit(self):
+        """Number of feeds fetched at the same time from any one host"""
+        if self._per_host_limit is None:
+            self._per_host_limit = 2
+        return self._per_host_limit
+
+    def get_feed_timeout(self):
+        """Seconds a whole feed download may take before it is abandoned"""
+        if self._feed_timeout is None:
+            self._feed_timeout = 30
+        return self._feed_timeout
+
+    def get_feed_max_mb(self):
+        """Largest feed download, after decompression, that is parsed"""
+        if self._feed_max_mb is None:
+            self._feed_max_mb = 16
+        return self._feed_max_mb
+
+    def get_db_batch_size(self):
+        """Number of new posts written per database transaction"""
+        if self._db_batch_size is None:
+            self._db_batch_size = 500
+        return self._db_batch_size
+
+    def get_clean_processes(self):
+        """Number of processes cleaning html, 1 keeps the cleaning in the main process"""
+        if self._clean_processes is None:
+            self._clean_processes = 1
+        return self._clean_processes
+
+    def get_clean_threshold(self):
+        """Smallest batch of new posts that is sent to the cleaning processes"""
+        if self._clean_threshold is None:
+            self._clean_threshold = 50
+        return self._clean_threshold
+
+    def get_mode(self):
+        """Which steps to run: acquire, digest, all, serve or report"""
+        if self._mode is None:
+            self._mode = 'all'
+        return self._mode
+
+    def get_poll_min_minutes(self):
+        """Shortest time between polls of one feed in serve mode"""
+        if self._poll_min_minutes is None:
+            self._poll_min_minutes = 15
+        return self._poll_min_minutes
+
+    def get_poll_max_minutes(self):
+        """Longest time between polls of one feed in serve mode"""
+        if self._poll_max_minutes is None:
+            self._poll_max_minutes = 24 * 60
+        return self._poll_max_minutes
+
+    def get_digest_hour(self):
+        """Hour of the day the newsletter is built in serve mode"""
+        if self._digest_hour is None:
+            self._digest_hour = 6
+        return self._digest_hour
+
+    def get_quarantine_after(self):
+        """Failures in a row before a feed is no longer fetched"""
+        if self._quarantine_after is None:
+            self._quarantine_after = 10
+        return self._quarantine_after
+
+    def get_cache_dir(self):
+        """Directory raw feed downloads are cached in, None turns the cache off"""
+        return self._cache_dir
+
+    def get_cache_max_mb(self):
+        """Size the feed cache is trimmed to after each acquisition"""
+        if self._cache_max_mb is None:
+            self._cache_max_mb = 512
+        return self._cache_max_mb
+
+    def get_cache_max_days(self):
+        """Age after which a cached feed download is evicted"""
+        if self._cache_max_days is None:
+            self._cache_max_days = 30
+        return self._cache_max_days
+
+    def get_replay(self):
+        """Parse feeds from the cache instead of the network"""
+        return bool(self._replay)
+
+    def get_log_level(self):
+        """Lowest level written to the log file"""
+        if self._log_level is None:
+            self._log_level = 'INFO'
+        return self._log_level
+
+    def get_metrics_file(self):
+        """File the run's timings are written to, as json or prometheus text for a .prom file"""
+        return self._metrics_file
+
+    def get_retention(self, xml_url):
+        """(max_age_days, keep_count) for a feed, None meaning no limit
+        a section named after the feed url in the retention ini overrides the global limits,
+        an empty value there lifts that limit for the feed"""
+        if self._feed_retention is None:
+            self._feed_retention = {}
+            if self._retention_ini is not None:
+                retention_config = configparser.ConfigParser(interpolation=None)
+                retention_config.read(self._retention_ini)
+                for section in retention_config.sections():
+                    self._feed_retention[section] = {key: int(value) if value.strip() else None
+                                                     for key, value in retention_config[section].items()
+                                                     if key in ('days', 'count')}
+        overrides = self._feed_retention.get(xml_url, {})
+        return overrides.get('days', self._retention_days), overrides.get('count', self._retention_count)
+
+    def has_retention(self):
+        """True when any retention limit is configured"""
+        return any(value is not None for value in (self._retention_days, self._retention_count, self._retention_ini))
+
+    def get_subscribers(self):
+        """(name, email, subscriptions file) of everyone who gets a newsletter: the primary subscriber
+        from the command line, then one per section of the subscribers ini file"""
+        subscribers = [(PRIMARY_SUBSCRIBER, self.to_email, os.path.join(self.sub_dir, 'subscriptions.xml'))]
+        if self._subscribers_ini is not None:
+            subscribers_config = configparser.ConfigParser(interpolation=None)
+            subscribers_config.read(self._subscribers_ini)
+            ini_dir = os.path.dirname(os.path.abspath(self._subscribers_ini))
+            for name in subscribers_config.sections():
+                if name == PRIMARY_SUBSCRIBER:
+                    raise ValueError(f"'{PRIMARY_SUBSCRIBER}' is the subscriber from the command line, "
+                                     f"rename that section of {self._subscribers_ini}")
+                section = subscribers_config[name]
+                # a relative subscriptions path is relative to the ini file
+                subscribers.append((name, section['email'], os.path.join(ini_dir, section['subscriptions'])))
+        return subscribers
+
     def get_smtp_config(self):
         """parse a smpt ini file if provided"""
         smtp_values = None
@@ -453,8 +1641,48 @@ class NibblerConfig():
             smtp_values["password"] = smtp_config['smtp']['password']
             smtp_values["host"] = smtp_config['smtp']['host']
             smtp_values["port"] = smtp_config['smtp']['port']
+            smtp_values["starttls"] = smtp_config['smtp'].getboolean('starttls', fallback=True)
         return smtp_values
 
+    def get_smtp_connections(self):
+        """Smtp connections kept open to send newsletters concurrently"""
+        if self._smtp_connections is None:
+            self._smtp_connections = 2
+        return self._smtp_connections
+
+    def get_smtp_rate(self):
+        """Most messages sent per second, None for no limit"""
+        return self._smtp_rate
+
+    def get_outbox_dir(self):
+        """Directory messages wait in until the smtp server takes them, None to not retry"""
+        return self._outbox_dir
+
+    def get_image_mode(self):
+        """How article images reach the newsletter: None links the originals, 'inline' attaches
+        cached copies, 'static' copies them to the static dir"""
+        return self._image_mode
+
+    def get_image_static_dir(self):
+        """Directory images are copied to in static image mode"""
+        return self._image_static_dir
+
+    def get_image_static_url(self):
+        """Url the static image directory is served at"""
+        return self._image_static_url
+
+    def get_image_workers(self):
+        """Number of images downloaded at the same time"""
+        if self._image_workers is None:
+            self._image_workers = 8
+        return self._image_workers
+
+    def get_image_cache_mb(self):
+        """Size the image cache is trimmed to"""
+        if self._image_cache_mb is None:
+            self._image_cache_mb = 256
+        return self._image_cache_mb
+
     def get_email_image_styles(self):
         """Default images sizes"""
         key_values = {}
@@ -475,6 +1703,64 @@ class NibblerConfig():
         return connection_str
 
 
+class NibblerCompactor():
+    """Applies the retention policy: prunes old posts to tombstones and vacuums the database"""
+
+    def __init__(self, dal, appconfig):
+        self.dal = dal
+        self.config = appconfig
+
+    def prune(self, now=None):
+        """prune every feed to its retention limits, returns the number of posts pruned"""
+        pruned = 0
+        for feed in self.dal.session.query(Feed).all():
+            max_age_days, keep_count = self.config.get_retention(feed.xmlUrl)
+            count = self.dal.prune_posts(feed.feed_id, max_age_days, keep_count, now)
+            if count:
+                logger.info("Pruned %s posts of feed %s.", count, feed.feed_id)
+            pruned += count
+        return pruned
+
+    def main(self, full_vacuum=True):
+        """prune, vacuum and report how much space was given back
+        without full_vacuum only whole free pages are released, cheap enough to run every day"""
+        logger.info("Starting to Compact the Database.")
+        before = self.dal.space_used()
+        pruned = self.prune()
+        # bodies stored before compression was added
+        compressed = self.dal.compress_bodies()
+        if self.dal.engine.dialect.name == 'sqlite':
+            self.dal.vacuum(full_vacuum)
+        after = self.dal.space_used()
+        report = {'posts_pruned': pruned, 'bodies_compressed': compressed, 'bytes_before': before['bytes'],
+                  'bytes_after': after['bytes'], 'bytes_reclaimed': before['bytes'] - after['bytes']}
+        logger.info("Finished Compacting: %s posts pruned, %s bytes reclaimed.", pruned, report['bytes_reclaimed'])
+        return report
+
+
+def print_compaction_report(report, out=sys.stdout):
+    """what a compaction pruned and the space it gave back"""
+    print(f"posts pruned     {report['posts_pruned']:>12}", file=out)
+    print(f"bodies compressed{report['bodies_compressed']:>12}", file=out)
+    print(f"database before  {report['bytes_before'] / 1024:>10.0f} KiB", file=out)
+    print(f"database after   {report['bytes_after'] / 1024:>10.0f} KiB", file=out)
+    print(f"reclaimed        {report['bytes_reclaimed'] / 1024:>10.0f} KiB", file=out)
+
+
+def print_feed_report(dal, out=sys.stdout):
+    """list quarantined and failing feeds with their failure history"""
+    feeds = dal.troubled_feeds()
+    if not feeds:
+        print("All feeds are fetching normally.", file=out)
+        return
+    print(f"{'state':<12} {'feed_id':>7} {'failures':>8} {'total':>6} {'status':>6} {'latency':>8}  url", file=out)
+    for feed in feeds:
+        state = "quarantined" if feed.quarantined else "backing off"
+        latency = f"{feed.avg_fetch_latency:.1f}s" if feed.avg_fetch_latency is not None else "-"
+        print(f"{state:<12} {feed.feed_id:>7} {feed.consecutive_failures or 0:>8} {feed.error_count or 0:>6} "
+              f"{feed.last_status or '-':>6} {latency:>8}  {feed.xmlUrl}", file=out)
+
+
 def run_nibbler(args):
     """steps to run nibbler"""
     # Initialize configuration
@@ -485,13 +1771,30 @@ def run_nibbler(args):
     ensure_dir(config.get_log_dir())
     logfile = os.path.join(config.get_log_dir(), f"nibbler_{datetime.now().strftime('%Y%m%d')}.log")
     logging.basicConfig(filename=logfile,
-                        level=logging.DEBUG,
+                        level=config.get_log_level(),
                         format='%(asctime)s %(levelname)s %(module)s %(message)s')
 
-    dal = DatabaseAccess(config.get_database_connection())
+    dal = DatabaseAccess(config.get_database_connection(), config.get_db_batch_size())
+    metrics = RunMetrics()
+
+    if config.get_mode() == 'serve':
+        NibblerScheduler(dal, config, metrics).serve()
+        return
+    if config.get_mode() == 'report':
+        print_feed_report(dal)
+        return
+    if config.get_mode() == 'compact':
+        print_compaction_report(NibblerCompactor(dal, config).main())
+        return
 
     # Get articles
-    FeedAcquirer(dal, config).main()
+    if config.get_mode() in ('all', 'acquire'):
+        FeedAcquirer(dal, config, metrics).main()
 
     # Send Newsletter
-    NibblerNewsletter(dal, config).main()
+    if config.get_mode() in ('all', 'digest'):
+        NibblerNewsletter(dal, config, metrics).main()
+
+    metrics.log_summary()
+    if config.get_metrics_file() is not None:
+        metrics.write(config.get_metrics_file())
@@ -1,5 +1,26 @@
+import collections
+
 import lxml.etree
 
+# one subscribed feed from an OPML file, category is the path of the folders
+# it sits in joined with '/', or None for a top-level feed
+FeedOutline = collections.namedtuple('FeedOutline', ['title', 'xmlUrl', 'category'])
+
+
+def _feed_outlines(events):
+    """Turn start/end events for <outline> elements into FeedOutline records."""
+
+    path = []
+    for event, element in events:
+        if event == 'start':
+            title = element.get('text') or element.get('title')
+            xml_url = element.get('xmlUrl')
+            if xml_url:
+                yield FeedOutline(title or xml_url, xml_url, '/'.join(path) or None)
+            path.append(title or '')
+        else:
+            path.pop()
+
 class OutlineElement(object):
     """A single outline object."""
 
@@ -7,6 +28,7 @@ class OutlineElement(object):
         """Initialize from the root <outline> node."""
 
         self._root = root
+        self._outline_cache = None
 
     def __getattr__(self, attr):
 
@@ -19,7 +41,10 @@ class OutlineElement(object):
     def _outlines(self):
         """Return the available sub-outline objects as a seqeunce."""
 
-        return [OutlineElement(n) for n in self._root.xpath('./outline')]
+        # built once, indexing used to rerun the xpath for every item
+        if self._outline_cache is None:
+            self._outline_cache = [OutlineElement(n) for n in self._root.xpath('./outline')]
+        return self._outline_cache
 
     def __len__(self):
         return len(self._outlines)
@@ -34,6 +59,8 @@ class Opml(object):
         """Initialize the object using the parsed XML tree."""
 
         self._tree = xml_tree
+        self._outline_cache = None
+        self._feed_cache = None
 
     def __getattr__(self, attr):
         """Fall back attribute handler -- attempt to find the attribute in 
@@ -49,8 +76,10 @@ class Opml(object):
     def _outlines(self):
         """Return the available sub-outline objects as a seqeunce."""
 
-        return [OutlineElement(n) for n in self._tree.xpath(
+        if self._outline_cache is None:
+            self._outline_cache = [OutlineElement(n) for n in self._tree.xpath(
                 '/opml/body/outline')]
+        return self._outline_cache
 
     def __len__(self):
         return len(self._outlines)
@@ -58,6 +87,34 @@ class Opml(object):
     def __getitem__(self, index):
         return self._outlines[index]
 
+    @property
+    def feeds(self):
+        """Every feed in the document, folders at any depth included, as
+        FeedOutline records. Walked once and cached."""
+
+        if self._feed_cache is None:
+            self._feed_cache = list(_feed_outlines(
+                lxml.etree.iterwalk(self._tree, events=('start', 'end'), tag='outline')))
+        return self._feed_cache
+
+def iter_feeds(source):
+    """Stream the FeedOutline records of an OPML file or file-like object
+    without building the whole tree, for large exports."""
+
+    events = lxml.etree.iterparse(source, events=('start', 'end'), tag='outline')
+    for record in _feed_outlines(_released(events)):
+        yield record
+
+def _released(events):
+    """Pass events through, freeing each element once its subtree is done."""
+
+    for event, element in events:
+        yield event, element
+        if event == 'end':
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
 def from_string(opml_text):
 
     return Opml(lxml.etree.fromstring(opml_text))
@@ -0,0 +1,211 @@
+"""Test pooled smtp delivery and the outbox against a stand-in smtp server."""
+# python3 library
+from datetime import datetime, timedelta
+import email
+import os
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+
+# nibbler imports
+from nibbler.delivery import DeliveryService, Outbox, Throttle
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    """just enough of an smtp server: EHLO, AUTH PLAIN, MAIL, RCPT, DATA, RSET, NOOP and QUIT
+    recipients containing 'refused' are rejected, and with drop_after set the connection is
+    closed after that many messages, the way a server drops an idle or long lived client"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply('220 stand-in ready')
+        recipients = []
+        messages = 0
+        for raw in self.rfile:
+            command = raw.decode('ascii').strip()
+            verb = command.split(' ')[0].upper()
+            if verb == 'EHLO':
+                extensions = ['PIPELINING'] if server.pipelining else []
+                for extension in ['stand-in'] + extensions:
+                    self.reply(f'250-{extension}')
+                self.reply('250 AUTH PLAIN')
+            elif verb == 'AUTH':
+                self.reply('235 ok')
+            elif verb == 'MAIL':
+                recipients = []
+                self.reply('250 ok')
+            elif verb == 'RCPT':
+                if 'refused' in command:
+                    self.reply('550 no such user')
+                else:
+                    recipients.append(command.split(':', 1)[1].strip('<>'))
+                    self.reply('250 ok')
+            elif verb == 'DATA':
+                if not recipients:
+                    self.reply('503 no valid recipients')
+                    continue
+                self.reply('354 go ahead')
+                lines = []
+                for line in self.rfile:
+                    if line == b'.\r\n':
+                        break
+                    lines.append(line[1:] if line.startswith(b'..') else line)
+                with server.lock:
+                    server.messages.append((recipients, b''.join(lines)))
+                self.reply('250 queued')
+                messages += 1
+                if server.drop_after and messages >= server.drop_after:
+                    return
+            elif verb in ('RSET', 'NOOP'):
+                self.reply('250 ok')
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('500 unknown command')
+
+
+class StandInSmtpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self, pipelining=True, drop_after=None):
+        super().__init__(('127.0.0.1', 0), SmtpHandler)
+        self.pipelining = pipelining
+        self.drop_after = drop_after
+        self.connections = 0
+        self.messages = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def config(self):
+        return {'host': '127.0.0.1', 'port': str(self.server_address[1]), 'username': 'user',
+                'password': 'secret', 'starttls': False}
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+class TestDeliveryService(unittest.TestCase):
+    """Test the DeliveryService class."""
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+    def message(self, recipient, body='hello'):
+        filename = os.path.join(self.work_dir.name, f'{recipient}.eml')
+        with open(filename, 'w') as message_file:
+            message_file.write(f'From: nibbler@example.com\nTo: {recipient}\nSubject: news\n\n{body}\n.starts with a dot\n')
+        return ('nibbler@example.com', recipient, filename)
+
+    def test_one_connection_for_many_messages(self):
+        """every message goes over the same logged in connection, dots survive the transfer"""
+        for pipelining in (True, False):
+            with StandInSmtpServer(pipelining=pipelining) as server:
+                messages = [self.message(f'reader{number}@example.com') for number in range(5)]
+                with DeliveryService(server.config(), connections=1) as delivery:
+                    self.assertEqual([True] * 5, delivery.deliver(messages))
+                    self.assertEqual(1, delivery.pool.connects)
+                self.assertEqual(1, server.connections)
+                self.assertEqual(sorted([recipient] for _, recipient, _ in messages),
+                                 sorted(recipients for recipients, _ in server.messages))
+                received = email.message_from_bytes(server.messages[0][1])
+                self.assertEqual('news', received['Subject'])
+                self.assertIn('\r\n.starts with a dot', received.get_payload())
+
+    def test_refused_recipient_keeps_the_connection(self):
+        """a refused message is reported and the connection is reset and reused for the next"""
+        with StandInSmtpServer() as server:
+            messages = [self.message('a@example.com'), self.message('refused@example.com'),
+                        self.message('b@example.com')]
+            with DeliveryService(server.config(), connections=1) as delivery:
+                self.assertEqual([True, False, True], delivery.deliver(messages))
+            self.assertEqual(1, server.connections)
+            self.assertEqual(2, len(server.messages))
+
+    def test_reconnects_when_the_server_drops_the_connection(self):
+        """a message on a connection the server closed is sent again on a new one"""
+        with StandInSmtpServer(drop_after=2) as server:
+            messages = [self.message(f'reader{number}@example.com') for number in range(5)]
+            with DeliveryService(server.config(), connections=1) as delivery:
+                self.assertEqual([True] * 5, delivery.deliver(messages))
+            self.assertEqual(5, len(server.messages))
+            self.assertEqual(3, server.connections)
+
+    def test_concurrent_connections(self):
+        """the pool never opens more connections than its size"""
+        with StandInSmtpServer() as server:
+            messages = [self.message(f'reader{number}@example.com') for number in range(20)]
+            with DeliveryService(server.config(), connections=3) as delivery:
+                self.assertEqual([True] * 20, delivery.deliver(messages))
+                self.assertLessEqual(delivery.pool.connects, 3)
+            self.assertEqual(20, len(server.messages))
+
+    def test_outbox_retries_and_gives_up(self):
+        """failed messages stay in the outbox, back off, and finally move to dead/"""
+        outbox_dir = os.path.join(self.work_dir.name, 'outbox')
+        with StandInSmtpServer() as server:
+            with DeliveryService(server.config(), outbox_dir=outbox_dir) as delivery:
+                # queued counts as accepted, the refused one is retried later
+                self.assertEqual([True, True], delivery.deliver([self.message('a@example.com'),
+                                                                 self.message('refused@example.com')]))
+                self.assertEqual(1, len(server.messages))
+                outbox = delivery.outbox
+                self.assertEqual([], outbox.pending())
+                [state] = outbox.pending(datetime.now() + timedelta(minutes=6))
+                self.assertEqual(('refused@example.com', 1), (state['recipient'], state['attempts']))
+                self.assertIn('no such user', state['last_error'])
+                now = datetime.now()
+                for attempt in range(outbox.max_attempts - 1):
+                    now += timedelta(days=1)
+                    self.assertEqual(0, delivery.flush(now))
+            self.assertEqual([], outbox.pending(now + timedelta(days=30)))
+            self.assertEqual(2, len(os.listdir(outbox.dead_dir)))
+
+    def test_outbox_keeps_messages_while_the_server_is_down(self):
+        """nothing is lost when there is no server, a later run sends it"""
+        outbox_dir = os.path.join(self.work_dir.name, 'outbox')
+        with StandInSmtpServer() as server:
+            config = server.config()
+        with DeliveryService(config, outbox_dir=outbox_dir) as delivery:
+            self.assertEqual([True], delivery.deliver([self.message('a@example.com')]))
+        later = datetime.now() + timedelta(hours=1)
+        with StandInSmtpServer() as server:
+            with DeliveryService(server.config(), outbox_dir=outbox_dir) as delivery:
+                self.assertEqual(1, delivery.flush(later))
+            self.assertEqual([['a@example.com']], [recipients for recipients, _ in server.messages])
+        self.assertEqual([], Outbox(outbox_dir).pending(later))
+
+
+class TestThrottle(unittest.TestCase):
+    """Test the Throttle class."""
+
+    def test_spaces_calls(self):
+        """calls are spread out to the rate, no rate means no wait"""
+        throttle = Throttle(50)
+        start = time.monotonic()
+        for _ in range(6):
+            throttle.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        start = time.monotonic()
+        for _ in range(100):
+            Throttle().wait()
+        self.assertLess(time.monotonic() - start, 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+"""Test the raw feed cache and replaying acquisition from it."""
+# python3 library
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import Mock
+
+# nibbler imports
+from nibbler.feedcache import FeedCache
+from nibbler.nibbler import FeedAcquirer, NibblerConfig
+
+RSS = b"""<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0"><channel>
+<title>Cached</title><link>http://example.com/</link>
+<item><title>First</title><link>http://example.com/1</link><guid>http://example.com/1</guid>
+<description>&lt;p&gt;hello&lt;/p&gt;</description></item>
+</channel></rss>"""
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    """serves RSS with an etag and honours If-None-Match"""
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/rss+xml; charset=utf-8')
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(RSS)))
+        self.end_headers()
+        self.wfile.write(RSS)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestFeedCache(unittest.TestCase):
+    """Test the FeedCache class."""
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.cache = FeedCache(self.cache_dir.name)
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def body_files(self):
+        return [name for _, _, names in os.walk(self.cache.body_dir) for name in names]
+
+    def test_store_and_load(self):
+        """a stored body comes back with its headers, unknown urls give None"""
+        self.cache.store('http://a.example/feed', b'<rss/>', {'content-type': 'text/xml'})
+        self.assertEqual(self.cache.load('http://a.example/feed'), (b'<rss/>', {'content-type': 'text/xml'}))
+        self.assertIsNone(self.cache.load('http://b.example/feed'))
+
+    def test_identical_bodies_are_stored_once(self):
+        """two urls returning the same bytes share one body file"""
+        self.cache.store('http://a.example/feed', b'<rss/>', {})
+        self.cache.store('http://b.example/feed', b'<rss/>', {})
+        self.assertEqual(len(self.body_files()), 1)
+
+    def test_evict_by_size_drops_least_recently_used(self):
+        """the oldest bodies go first until the cache fits"""
+        self.cache.max_bytes = 150
+        for number in range(3):
+            digest = self.cache.store(f'http://{number}.example/feed', bytes([number]) * 100, {})
+            used = time.time() - 100 + number
+            os.utime(self.cache._body_path(digest), (used, used))
+        self.assertEqual(self.cache.evict(), 200)
+        self.assertIsNone(self.cache.load('http://0.example/feed'))
+        self.assertIsNone(self.cache.load('http://1.example/feed'))
+        self.assertIsNotNone(self.cache.load('http://2.example/feed'))
+
+    def test_evict_by_age(self):
+        """bodies and url entries older than max_age are removed"""
+        self.cache.max_age = 60
+        self.cache.store('http://a.example/feed', b'<rss/>', {})
+        old = time.time() - 120
+        for root, _, names in os.walk(self.cache_dir.name):
+            for name in names:
+                os.utime(os.path.join(root, name), (old, old))
+        self.cache.evict()
+        self.assertEqual(self.body_files(), [])
+        self.assertEqual(os.listdir(self.cache.url_dir), [])
+
+
+class TestFeedReplay(unittest.TestCase):
+    """Test fetching through the cache and replaying from it."""
+    arguments = {'from_email': 'from@example.com', 'to_email': 'to@example.com', 'sub_dir': '/app-bin'}
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FeedHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/feed.xml'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.cache_dir.cleanup()
+
+    def acquirer(self, **options):
+        return FeedAcquirer(Mock(), NibblerConfig(cache_dir=self.cache_dir.name, **self.arguments, **options))
+
+    def test_fetch_caches_body_and_keeps_validators(self):
+        """a live fetch parses like feedparser would and leaves the raw body in the cache"""
+        rss_feed = self.acquirer().fetch_feed(self.url)
+        self.assertEqual(rss_feed.status, 200)
+        self.assertEqual(rss_feed.etag, '"v1"')
+        self.assertEqual(rss_feed.entries[0].link, 'http://example.com/1')
+        self.assertEqual(FeedCache(self.cache_dir.name).load(self.url)[0], RSS)
+
+        not_modified = self.acquirer().fetch_feed(self.url, etag='"v1"')
+        self.assertEqual(not_modified.status, 304)
+        self.assertEqual(not_modified.entries, [])
+
+    def test_replay_reads_the_cache_not_the_network(self):
+        """replay gives the cached entries without a status, even with the server gone"""
+        live = self.acquirer().fetch_feed(self.url)
+        self.server.shutdown()
+        replayed = self.acquirer(replay=True).fetch_feed(self.url)
+        self.assertNotIn('status', replayed)
+        self.assertEqual([entry.guid for entry in replayed.entries], [entry.guid for entry in live.entries])
+        self.assertEqual(replayed.entries[0].summary, live.entries[0].summary)
+
+    def test_replay_of_uncached_feed_is_not_a_failure(self):
+        """a feed missing from the cache yields no entries and does not count against the feed"""
+        acquirer = self.acquirer(replay=True)
+        rss_feed = acquirer.fetch_feed('http://uncached.example/feed')
+        self.assertEqual(rss_feed.entries, [])
+        self.assertFalse(acquirer.fetch_failed(rss_feed))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+"""Test the keep-alive http connection pool against a local server."""
+# python3 library
+import gzip
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+import unittest
+import urllib.error
+import zlib
+
+# nibbler imports
+from nibbler.httpclient import HttpConnectionPool, ResponseTooLarge
+
+RSS = b'<?xml version="1.0"?><rss version="2.0"><channel><title>Pooled</title></channel></rss>'
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """http/1.1 with keep-alive; /gzip and /deflate compress, /moved redirects, /big is large,
+    /etag honours If-None-Match and /drop closes the connection without saying so"""
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def respond(self, body, status=200, **headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name.replace('_', '-'), value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        self.server.request_headers.append(dict(self.headers))
+        if self.path == '/gzip':
+            self.respond(gzip.compress(RSS), Content_Encoding='gzip')
+        elif self.path in ('/deflate', '/raw-deflate'):
+            compressor = zlib.compressobj(wbits=15 if self.path == '/deflate' else -15)
+            self.respond(compressor.compress(RSS) + compressor.flush(), Content_Encoding='deflate')
+        elif self.path == '/moved':
+            self.respond(b'', 301, Location='/feed')
+        elif self.path == '/loop':
+            self.respond(b'', 302, Location='/loop')
+        elif self.path == '/big':
+            self.respond(b'x' * 5000)
+        elif self.path == '/bomb':
+            self.respond(gzip.compress(b' ' * 1_000_000), Content_Encoding='gzip')
+        elif self.path == '/etag':
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.respond(b'', 304)
+            else:
+                self.respond(RSS, ETag='"v1"', Last_Modified='Mon, 01 May 2023 06:00:00 GMT')
+        elif self.path == '/trickle':
+            self.send_response(200)
+            self.send_header('Content-Length', '1000')
+            self.end_headers()
+            for _ in range(1000):
+                self.wfile.write(b'x')
+                self.wfile.flush()
+                time.sleep(0.05)
+        elif self.path == '/drop':
+            self.respond(RSS)
+            self.close_connection = True
+        else:
+            self.respond(RSS)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHttpConnectionPool(unittest.TestCase):
+    """Test the HttpConnectionPool class."""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.server.lock = threading.Lock()
+        self.server.connections = 0
+        self.server.paths = []
+        self.server.request_headers = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.pool = HttpConnectionPool(timeout=5, max_bytes=4096)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def url(self, path):
+        return f'http://127.0.0.1:{self.server.server_port}{path}'
+
+    def test_reuses_the_connection(self):
+        """sequential requests to one host share a single connection"""
+        for _ in range(5):
+            result = {}
+            self.assertEqual(RSS, self.pool.get(self.url('/feed'), result=result))
+            self.assertEqual(200, result['status'])
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual((1, 5), (self.pool.connects, self.pool.requests))
+
+    def test_decompresses(self):
+        """gzip, zlib and raw deflate bodies come back decompressed, and compression is asked for"""
+        for path in ('/gzip', '/deflate', '/raw-deflate'):
+            self.assertEqual(RSS, self.pool.get(self.url(path)))
+        self.assertEqual('gzip, deflate', self.server.request_headers[0]['Accept-Encoding'])
+
+    def test_conditional_request(self):
+        """validators are reported and sent back, an unchanged feed is a 304 without a body"""
+        result = {}
+        self.pool.get(self.url('/etag'), agent='nibbler-test', result=result)
+        self.assertEqual(('"v1"', 'Mon, 01 May 2023 06:00:00 GMT'), (result['etag'], result['modified']))
+        self.assertEqual('nibbler-test', self.server.request_headers[0]['User-Agent'])
+        result = {}
+        self.assertEqual(b'', self.pool.get(self.url('/etag'), etag='"v1"', result=result))
+        self.assertEqual(304, result['status'])
+
+    def test_follows_redirects(self):
+        """like urllib the status is the redirect's and href is the final url; loops give up"""
+        result = {}
+        self.assertEqual(RSS, self.pool.get(self.url('/moved'), result=result))
+        self.assertEqual((301, self.url('/feed')), (result['status'], result['href']))
+        with self.assertRaises(urllib.error.URLError):
+            self.pool.get(self.url('/loop'))
+
+    def test_size_cap(self):
+        """responses over max_bytes are abandoned, before or after decompression"""
+        for path in ('/big', '/bomb'):
+            with self.assertRaises(urllib.error.URLError) as raised:
+                self.pool.get(self.url(path))
+            self.assertIsInstance(raised.exception.reason, ResponseTooLarge)
+        # the connection was dropped with the oversized response, the next request still works
+        self.assertEqual(RSS, self.pool.get(self.url('/feed')))
+
+    def test_reconnects_when_the_server_closed_the_connection(self):
+        """a connection the server dropped while idle is replaced without an error"""
+        self.assertEqual(RSS, self.pool.get(self.url('/drop')))
+        self.assertEqual(RSS, self.pool.get(self.url('/feed')))
+        self.assertEqual(2, self.server.connections)
+
+    def test_deadline_for_the_whole_download(self):
+        """a server that keeps sending a byte at a time is cut off at the timeout, not per read"""
+        self.pool.timeout = 0.5
+        start = time.monotonic()
+        with self.assertRaises(urllib.error.URLError) as raised:
+            self.pool.get(self.url('/trickle'))
+        self.assertIsInstance(raised.exception.reason, TimeoutError)
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_connection_refused(self):
+        """a host that is down raises a URLError like feedparser's download"""
+        closed = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        port = closed.server_port
+        closed.server_close()
+        with self.assertRaises(urllib.error.URLError):
+            self.pool.get(f'http://127.0.0.1:{port}/feed')
+
+    def test_malformed_urls(self):
+        """urls without a host or with a bad port raise a URLError too"""
+        for url in ('http:///feed', 'http://127.0.0.1:notaport/feed', 'ftp://example.com/feed'):
+            with self.assertRaises(urllib.error.URLError):
+                self.pool.get(url)
+
+
+if __name__ == '__main__':
+    unittest.main()
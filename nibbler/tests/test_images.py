@@ -0,0 +1,160 @@
+"""Test the digest image stage against a local image server."""
+# python3 library
+import email
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import Mock
+
+# nibbler imports
+from nibbler import images
+from nibbler.httpclient import HttpConnectionPool
+from nibbler.images import DigestImages, ImageCache, ImageFetcher
+from nibbler.nibbler import HTMLNormalizer, NibblerConfig, NibblerNewsletter
+
+PNG = bytes.fromhex('89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489'
+                    '0000000d49444154789c6360f8cfc0f01f0005000201e5270de40000000049454e44ae426082')
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """serves a png at /*.png, html at /page and a 404 elsewhere, counting requests"""
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.hits[self.path] = self.server.hits.get(self.path, 0) + 1
+        if self.path.endswith('.png'):
+            body, content_type = PNG, 'image/png'
+        elif self.path == '/page':
+            body, content_type = b'<html></html>', 'text/html'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+        self.server.lock = threading.Lock()
+        self.server.hits = {}
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.cache = ImageCache(os.path.join(self.work_dir.name, 'images'))
+        self.fetcher = ImageFetcher(self.cache, HttpConnectionPool(timeout=5), max_workers=4)
+
+    def tearDown(self):
+        self.fetcher.http_pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.work_dir.cleanup()
+
+    def url(self, path):
+        return f'http://127.0.0.1:{self.server.server_port}{path}'
+
+
+class TestImageFetcher(ImageTestCase):
+    """Test the ImageCache and ImageFetcher classes."""
+
+    def test_downloads_each_image_once(self):
+        """images are fetched once and then come from the cache; missing images and non-images are skipped"""
+        urls = [self.url('/a.png'), self.url('/b.png'), self.url('/a.png'), self.url('/missing.gif'), self.url('/page')]
+        paths = self.fetcher.fetch(urls)
+        self.assertEqual({self.url('/a.png'), self.url('/b.png')}, set(paths))
+        # the same bytes are stored once, with an extension for their type
+        self.assertEqual(paths[self.url('/a.png')], paths[self.url('/b.png')])
+        self.assertTrue(paths[self.url('/a.png')].endswith('.png'))
+        self.assertEqual(self.fetcher.fetch([self.url('/a.png')]), {self.url('/a.png'): paths[self.url('/a.png')]})
+        self.assertEqual(1, self.server.hits['/a.png'])
+
+    def test_eviction(self):
+        """the least recently used images go when the cache is over its size"""
+        self.cache.max_bytes = 0
+        paths = self.fetcher.fetch([self.url('/a.png')])
+        self.cache.evict()
+        self.assertFalse(os.path.exists(paths[self.url('/a.png')]))
+        self.assertIsNone(self.cache.image_path(self.url('/a.png')))
+
+    @unittest.skipIf(images.Image is not None, 'Pillow is installed')
+    def test_kept_as_is_without_pillow(self):
+        """without Pillow the image is stored as the publisher served it"""
+        self.assertEqual((PNG, 'image/png'), self.fetcher.shrink(PNG, 'image/png'))
+        # and the operator is told, once
+        images.warn_without_pillow.cache_clear()
+        with self.assertLogs('nibbler.images', 'WARNING'):
+            ImageFetcher(self.cache, self.fetcher.http_pool)
+        with self.assertNoLogs('nibbler.images', 'WARNING'):
+            ImageFetcher(self.cache, self.fetcher.http_pool)
+
+    @unittest.skipIf(images.Image is None, 'Pillow is not installed')
+    def test_shrinks_large_images(self):
+        """a large image is scaled to fit the email size, keeping its aspect ratio"""
+        import io
+        out = io.BytesIO()
+        images.Image.new('RGB', (1600, 800), 'white').save(out, 'JPEG')
+        data, content_type = self.fetcher.shrink(out.getvalue(), 'image/jpeg')
+        self.assertEqual('image/jpeg', content_type)
+        self.assertEqual((480, 240), images.Image.open(io.BytesIO(data)).size)
+
+
+class TestDigestImages(ImageTestCase):
+    """Test the DigestImages class and its use in the newsletter."""
+
+    def normalizer(self):
+        return HTMLNormalizer(NibblerConfig('to@example.com', 'from@example.com', '.'))
+
+    def test_inline(self):
+        """images become content id references, attached once, and unknown images keep their link"""
+        attachments = {}
+        digest_images = DigestImages(self.fetcher, 'inline', attachments)
+        html = self.normalizer().add_email_markup(
+            f'<p><img src="{self.url("/a.png")}" srcset="{self.url("/a.png")} 2x">'
+            f'<img src="{self.url("/missing.gif")}"><img alt="no source"></p>', digest_images)
+        [content_id] = attachments
+        self.assertIn(f'src="cid:{content_id}"', html)
+        self.assertNotIn('srcset', html)
+        self.assertIn(f'src="{self.url("/missing.gif")}"', html)
+
+    def test_static(self):
+        """images are copied to the static directory and linked at its url"""
+        static_dir = os.path.join(self.work_dir.name, 'static')
+        os.makedirs(static_dir)
+        digest_images = DigestImages(self.fetcher, 'static', {}, static_dir, 'https://img.example.com/nibbler/')
+        sources = digest_images.sources([self.url('/a.png')])
+        [name] = os.listdir(static_dir)
+        self.assertEqual({self.url('/a.png'): f'https://img.example.com/nibbler/{name}'}, sources)
+
+    def test_newsletter_attaches_images(self):
+        """the streamed newsletter carries the article's image as a part referenced by content id"""
+        config = NibblerConfig('to@example.com', 'from@example.com', '.', email_dir=self.work_dir.name,
+                               cache_dir=self.work_dir.name, image_mode='inline')
+        article = Mock(title='Pictured', feed_title='Feed', feed_category=None, link='https://example.com/1',
+                       article_text=f'<p><img src="{self.url("/a.png")}"></p>')
+        dal = Mock()
+        dal.sync_subscribers.return_value = ([None], 0)
+        dal.pending_post_ids.return_value = [1]
+        dal.iter_posts_by_id.return_value = iter([article])
+        NibblerNewsletter(dal, config).main()
+        [filename] = [name for name in os.listdir(self.work_dir.name) if name.endswith('.eml')]
+        with open(os.path.join(self.work_dir.name, filename), 'rb') as email_file:
+            message = email.message_from_binary_file(email_file)
+        parts = message.get_payload()
+        html = parts[1].get_payload(decode=True).decode('utf-8')
+        # besides the template's own logos
+        [image] = [part for part in parts if part['Content-ID'] not in (None, '<image1>', '<image2>')]
+        self.assertEqual(PNG, image.get_payload(decode=True))
+        self.assertIn(f'cid:{image["Content-ID"].strip("<>")}', html)
+        dal.clear_pending.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+"""Test the run metrics."""
+# python3 library
+import json
+import os
+import tempfile
+import unittest
+
+# nibbler imports
+from nibbler.metrics import RunMetrics
+
+
+class TestRunMetrics(unittest.TestCase):
+    """Test the RunMetrics class."""
+
+    def setUp(self):
+        self.metrics = RunMetrics()
+        self.metrics.observe('fetch', 1.5)
+        self.metrics.observe('fetch', 0.5)
+        self.metrics.count('entries_new', 3)
+        self.metrics.feed_fetched(7, 0.25)
+
+    def test_summary(self):
+        """stages add up seconds and calls, counters add up amounts"""
+        with self.metrics.timer('clean'):
+            pass
+        summary = self.metrics.summary()
+        self.assertEqual(summary['stages']['fetch'], {'seconds': 2.0, 'calls': 2})
+        self.assertEqual(summary['stages']['clean']['calls'], 1)
+        self.assertEqual(summary['counters'], {'entries_new': 3})
+        self.assertEqual(summary['feed_latency'], {'7': 0.25})
+
+    def test_hooks_see_everything_recorded(self):
+        """a hook gets every timing and count, and a failing hook does not break the run"""
+        seen = []
+        self.metrics.add_hook(lambda name, value, labels: seen.append((name, value, labels)))
+        self.metrics.add_hook(lambda name, value, labels: 1 / 0)
+        self.metrics.observe('parse', 0.1, feed_id=1)
+        self.metrics.count('feeds_failed')
+        self.assertEqual(seen, [('parse', 0.1, {'feed_id': 1}), ('feeds_failed', 1, {})])
+
+    def test_write_json_and_prometheus(self):
+        """the file format follows the file name"""
+        with tempfile.TemporaryDirectory() as out_dir:
+            json_file = os.path.join(out_dir, 'nibbler.json')
+            prom_file = os.path.join(out_dir, 'nibbler.prom')
+            self.metrics.write(json_file)
+            self.metrics.write(prom_file)
+            with open(json_file) as metrics_file:
+                self.assertEqual(json.load(metrics_file)['counters'], {'entries_new': 3})
+            with open(prom_file) as metrics_file:
+                prom = metrics_file.read().splitlines()
+            self.assertEqual(sorted(os.listdir(out_dir)), ['nibbler.json', 'nibbler.prom'])
+        self.assertIn('nibbler_stage_seconds_total{stage="fetch"} 2.0', prom)
+        self.assertIn('nibbler_stage_calls_total{stage="fetch"} 2', prom)
+        self.assertIn('nibbler_entries_new_total 3', prom)
+        self.assertIn('nibbler_feed_fetch_seconds{feed_id="7"} 0.25', prom)
+
+
+if __name__ == '__main__':
+    unittest.main()
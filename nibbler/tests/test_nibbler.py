@@ -1,10 +1,20 @@
 """Test the Nibbler classes."""
 # python3 library
+from datetime import datetime, timedelta
+import email
+import os
+import socket
+import sqlite3
+import io
+import tempfile
+import time
 import unittest
 from unittest.mock import Mock, patch
+from urllib.error import URLError
 
 # dependency imports
 import feedparser
+from sqlalchemy import event, text
 
 # nibbler imports
 from nibbler.nibbler import NibblerConfig
@@ -12,6 +22,20 @@ from nibbler.nibbler import HTMLNormalizer
 #from nibbler.nibbler import FeedAcquirer
 #from nibbler.nibbler import DatabaseAccess
 import nibbler.nibbler
+import nibbler.opml
+
+
+def stored_posts(dal, guids):
+    """The stored posts with the guids, read back through iter_posts_by_id the way the newsletter reads them."""
+    post_ids = dal.session.query(nibbler.nibbler.Article.post_id)\
+        .filter(nibbler.nibbler.Article.guid.in_(guids)).order_by(nibbler.nibbler.Article.post_id)
+    return list(dal.iter_posts_by_id([post_id for post_id, in post_ids]))
+
+
+def stored_post(dal, guid):
+    """The stored post with the guid, None when there is none."""
+    posts = stored_posts(dal, [guid])
+    return posts[0] if posts else None
 
 class NibblerTestCase(unittest.TestCase):
     """Base class for all Nibbler tests."""
@@ -82,6 +106,16 @@ class TestHTMLNormalizer(NibblerTestCase):
         email_html = '<p>I added some text <a href="http://www.jamesaltucher.com/2017/03/matt-mullenweg/">joined in for the James Altucher<img src="https://i1.wp.com/ma.tt/files/2017/04/ultralight.gif?resize=500%2C288&amp;ssl=1" alt="ultralight.gif" width="480" height="320" border="0"> podcast in an episode that covered a lot of ground</a>. It just needs to be two-way.</p>'
         self.assertEqual(email_html, self.normalizer.add_email_markup(clean_html))
 
+    def test_normalize_matches_separate_steps(self):
+        """Test the single pass normalize gives the same html as the separate steps."""
+        link = 'https://kottke.org/18/06/the-problem-with-action-scenes-in-dc-movies'
+        input_html = '<div class="post"><p style="color: red">Hi<br/><span>there</span></p><img id="x" width="9" src="/plus/a.jpg"><!-- note --><script>alert(1)</script></div>'
+        separate = self.normalizer.add_email_markup(
+            self.normalizer.add_full_image_path(self.normalizer.clean_html(input_html), link))
+        self.assertEqual(separate, self.normalizer.normalize(input_html, link, email_markup=True))
+        self.assertEqual('<div><p>Hithere</p><img src="https://kottke.org/plus/a.jpg" width="480" height="320" border="0"></div>',
+                         self.normalizer.normalize(input_html, link, email_markup=True))
+
     def test_add_full_image_path(self):
         """Test the add_full_image_path method."""
         link = 'https://kottke.org/18/06/the-problem-with-action-scenes-in-dc-movies'
@@ -89,12 +123,558 @@ class TestHTMLNormalizer(NibblerTestCase):
         email_html = '<p><img src="https://kottke.org/plus/misc/images/ai-image-iso-02.jpg" alt="AI image in the dark"></p>'
         self.assertEqual(email_html, self.normalizer.add_full_image_path(input_html, link))
 
+    def test_resolves_relative_urls(self):
+        """Test relative src, srcset and href resolve against the base, whatever the shape of the link."""
+        link = 'https://example.com/blog/2023/05/post'
+        input_html = ('<p><img src="pic.jpg" srcset="pic-2x.jpg 2x,/pic,3x.jpg 3x , https://cdn.example.net/p.jpg 640w">'
+                      '<img alt="no source"><a href="../about">about</a><a href="mailto:me@example.com">mail</a>'
+                      '<a href="#top">top</a><img srcset="//cdn.example.net/v.webp"></p>')
+        self.assertEqual('<p><img src="https://example.com/blog/2023/05/pic.jpg" srcset="https://example.com/blog/2023/05/pic-2x.jpg 2x, '
+                         'https://example.com/pic,3x.jpg 3x, https://cdn.example.net/p.jpg 640w">'
+                         '<img alt="no source"><a href="https://example.com/blog/2023/about">about</a>'
+                         '<a href="mailto:me@example.com">mail</a><a href="https://example.com/blog/2023/05/post#top">top</a>'
+                         '<img srcset="https://cdn.example.net/v.webp"></p>',
+                         self.normalizer.normalize(input_html, link))
+        # a link without a usable base, or none at all, leaves the urls alone
+        for base in (None, 'not a url'):
+            self.assertIn('src="pic.jpg"', self.normalizer.normalize(input_html, base))
+
+    def test_entry_base(self):
+        """Test the xml:base of an entry's content wins over the article link."""
+        entries = [feedparser.parse(f'<feed xmlns="http://www.w3.org/2005/Atom">{entry}</feed>').entries[0] for entry in (
+            '<entry><id>1</id><link href="https://example.com/posts/1"/>'
+            '<content type="html" xml:base="https://static.example.com/assets/">&lt;img src="a.png"&gt;</content></entry>',
+            '<entry><id>2</id><link href="https://example.com/posts/2"/>'
+            '<summary type="html">&lt;img src="b.png"&gt;</summary></entry>')]
+        self.assertEqual('https://static.example.com/assets/', nibbler.nibbler.entry_base(entries[0], entries[0].link))
+        self.assertEqual('https://example.com/posts/2', nibbler.nibbler.entry_base(entries[1], entries[1].link))
+
 
     def tearDown(self):
         """Tear down the test case."""
         pass
 
 
+class TestNibblerNewsletter(NibblerTestCase):
+    """Test the NibblerNewsletter class."""
+
+    def setUp(self):
+        """Set up the test case."""
+        self.newsletter = nibbler.nibbler.NibblerNewsletter(Mock(), NibblerConfig(**self.arguments))
+        self.email_dir = tempfile.TemporaryDirectory()
+
+    def test_write_nibbler_newsletter_streams_valid_email(self):
+        """Test the streamed email file parses back to the rendered newsletter."""
+        articles = []
+        for number in range(3):
+            article = nibbler.nibbler.Article()
+            article.title = f'Post {number} caf\u00e9'
+            article.link = f'https://kottke.org/{number}'
+            article.feed_title = 'Kottke'
+            article.article_text = '<p>' + 'A long line of text. ' * 20 + '</p>\n.starts with a dot'
+            articles.append(article)
+        filename = os.path.join(self.email_dir.name, 'nibbler.eml')
+
+        self.newsletter.write_nibbler_newsletter(iter(articles), filename)
+
+        with open(filename, 'rb') as email_file:
+            msg = email.message_from_binary_file(email_file)
+        self.assertEqual('multipart/alternative', msg.get_content_type())
+        self.assertEqual(self.arguments['to_email'], msg['To'])
+        parts = msg.get_payload()
+        self.assertEqual(['text/plain', 'text/html', 'image/png', 'image/png'],
+                         [part.get_content_type() for part in parts])
+        html = parts[1].get_payload(decode=True).decode('utf-8')
+        self.assertEqual(self.newsletter._template().render(articles=articles), html)
+        self.assertEqual('<image1>', parts[2]['Content-ID'])
+
+    def test_main_drains_queue_after_delivery(self):
+        """Test main writes the queued posts and only then takes them off the queue."""
+        arguments = {'from_email': 'from@example.com', 'to_email': 'to@example.com', 'sub_dir': self.email_dir.name,
+                     'email_dir': self.email_dir.name}
+        config = NibblerConfig(**arguments)
+        dal = nibbler.nibbler.DatabaseAccess(f"sqlite:///{os.path.join(self.email_dir.name, 'nibbler.db')}")
+        dal.session.add(nibbler.nibbler.Feed('AVC', 'https://avc.com/feed'))
+        dal.session.commit()
+        article = nibbler.nibbler.Article()
+        article.feed_id = 1
+        article.guid = 'queued'
+        article.title = 'Queued post'
+        article.link = 'https://avc.com/queued'
+        article.article_text = '<p>Queued<img src="https://avc.com/a.png"></p>'
+        dal.store_posts([article])
+        self.assertEqual(1, len(dal.pending_post_ids()))
+
+        nibbler.nibbler.NibblerNewsletter(dal, config).main()
+
+        self.assertEqual([], dal.pending_post_ids())
+        emails = [name for name in os.listdir(self.email_dir.name) if name.endswith('.eml')]
+        self.assertEqual(1, len(emails))
+        with open(os.path.join(self.email_dir.name, emails[0]), 'rb') as email_file:
+            html = email.message_from_binary_file(email_file).get_payload()[1].get_payload(decode=True)
+        self.assertIn(b'Queued post', html)
+        self.assertIn(b'width="480"', html)
+        # the email markup stays out of the stored article
+        self.assertNotIn('width', stored_post(dal, 'queued').article_text)
+        dal.session.close()
+
+    def test_main_sends_to_the_configured_subscribers(self):
+        """Test a digest run uses the email and subscribers of this run, not those stored by an earlier one."""
+        dal = nibbler.nibbler.DatabaseAccess(f"sqlite:///{os.path.join(self.email_dir.name, 'nibbler.db')}")
+        dal.sync_subscribers([(nibbler.nibbler.PRIMARY_SUBSCRIBER, 'old@example.com', 'subscriptions.xml'),
+                              ('ann', 'ann@example.com', 'ann.xml')])
+        dal.session.add(nibbler.nibbler.Feed('AVC', 'https://avc.com/feed'))
+        dal.session.commit()
+        article = nibbler.nibbler.Article()
+        article.feed_id = 1
+        article.guid = 'queued'
+        article.title = 'Queued post'
+        article.link = 'https://avc.com/queued'
+        article.article_text = '<p>Queued</p>'
+        dal.store_posts([article])
+        config = NibblerConfig(from_email='from@example.com', to_email='new@example.com', sub_dir=self.email_dir.name,
+                               email_dir=self.email_dir.name)
+
+        nibbler.nibbler.NibblerNewsletter(dal, config).main()
+
+        [name] = [name for name in os.listdir(self.email_dir.name) if name.endswith('.eml')]
+        with open(os.path.join(self.email_dir.name, name), 'rb') as email_file:
+            self.assertEqual('new@example.com', email.message_from_binary_file(email_file)['To'])
+        # ann is no longer in a subscribers ini, so gets nothing
+        self.assertEqual(['primary'], [subscriber.name for subscriber in dal.subscribers()])
+        dal.session.close()
+
+    @patch('nibbler.delivery.DeliveryService.deliver', return_value=[False])
+    def test_main_keeps_queue_when_send_fails(self, mock_send):
+        """Test posts stay queued when the smtp server does not take the newsletter."""
+        self.newsletter.dal.sync_subscribers.return_value = ([None], 0)
+        self.newsletter.dal.pending_post_ids.return_value = [1, 2]
+        self.newsletter.dal.iter_posts_by_id.return_value = iter([])
+
+        self.newsletter.main()
+
+        mock_send.assert_called_once()
+        self.newsletter.dal.clear_pending.assert_not_called()
+
+    def tearDown(self):
+        """Tear down the test case."""
+        self.email_dir.cleanup()
+
+
+class TestNibblerScheduler(NibblerTestCase):
+    """Test the NibblerScheduler class."""
+
+    def setUp(self):
+        """Set up the test case."""
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.dal = nibbler.nibbler.DatabaseAccess(f"sqlite:///{os.path.join(self.db_dir.name, 'nibbler.db')}")
+        self.dal.session.add_all([nibbler.nibbler.Feed('AVC', 'https://avc.com/feed'),
+                                  nibbler.nibbler.Feed('Kottke', 'https://kottke.org/feed')])
+        self.dal.session.commit()
+        self.scheduler = nibbler.nibbler.NibblerScheduler(self.dal, NibblerConfig(**self.arguments))
+        self.scheduler.acquirer = Mock()
+        self.scheduler.newsletter = Mock()
+
+    def test_tick_polls_due_feeds_and_adapts_interval(self):
+        """Test tick polls only due feeds, speeding up busy feeds and slowing down quiet ones."""
+        avc, kottke = self.dal.session.query(nibbler.nibbler.Feed).order_by(nibbler.nibbler.Feed.feed_id).all()
+        self.scheduler.acquirer.acquire_feeds.side_effect = lambda feeds: {avc: ['new-post']}
+        avc.poll_interval = kottke.poll_interval = 3600
+        kottke.ttl = 180
+        now = datetime(2024, 1, 1, 12, 0)
+        self.scheduler.next_digest = now + timedelta(hours=1)
+
+        self.scheduler.tick(now)
+
+        self.assertEqual([avc, kottke], self.scheduler.acquirer.acquire_feeds.call_args.args[0])
+        self.assertEqual(1800, avc.poll_interval)
+        self.assertEqual(now + timedelta(minutes=30), avc.next_poll)
+        # quiet, and its ttl asks for three hours between polls
+        self.assertEqual(3 * 3600, kottke.poll_interval)
+        self.scheduler.newsletter.main.assert_not_called()
+
+        self.scheduler.acquirer.acquire_feeds.reset_mock()
+        self.scheduler.tick(now + timedelta(minutes=45))
+        self.assertEqual([avc], self.scheduler.acquirer.acquire_feeds.call_args.args[0])
+
+    def test_tick_builds_newsletter_at_digest_hour(self):
+        """Test tick builds the newsletter once the digest hour is reached and schedules the next one."""
+        now = datetime(2024, 1, 1, 6, 0)
+        self.scheduler.next_digest = now
+
+        self.scheduler.tick(now)
+
+        self.scheduler.newsletter.main.assert_called_once()
+        self.assertEqual(datetime(2024, 1, 2, 6, 0), self.scheduler.next_digest)
+
+    def tearDown(self):
+        """Tear down the test case."""
+        self.dal.session.close()
+        self.db_dir.cleanup()
+
+
+class TestDatabaseAccess(NibblerTestCase):
+    """Test the DatabaseAccess class."""
+
+    def setUp(self):
+        """Set up the test case."""
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self.db_dir.name, 'nibbler.db')
+
+    def test_upgrade_schema_adds_missing_columns(self):
+        """Test a database from an older release gains the new feed columns and loses retired indexes."""
+        connection = sqlite3.connect(self.db_file)
+        connection.execute('CREATE TABLE nibbler_feed (feed_id INTEGER PRIMARY KEY, title VARCHAR(64), '
+                           'xmlUrl VARCHAR(256), description VARCHAR(256))')
+        connection.execute('CREATE TABLE nibbler_post (post_id INTEGER PRIMARY KEY, feed_id INTEGER, guid VARCHAR(64), '
+                           'title VARCHAR(256), link VARCHAR(256), pub_date VARCHAR(128), '
+                           'article_text VARCHAR(65535), time_stamp DATE)')
+        connection.execute('CREATE INDEX ix_nibbler_post_guid ON nibbler_post (guid)')
+        connection.execute("INSERT INTO nibbler_feed (title, xmlUrl) VALUES ('AVC', 'https://avc.com/feed')")
+        connection.commit()
+        connection.close()
+
+        dal = nibbler.nibbler.DatabaseAccess(f'sqlite:///{self.db_file}')
+        feed = dal.session.query(nibbler.nibbler.Feed).one()
+        self.assertEqual('https://avc.com/feed', feed.xmlUrl)
+        self.assertIsNone(feed.etag)
+        dal.session.close()
+
+        connection = sqlite3.connect(self.db_file)
+        indexes = {row[1] for row in connection.execute("PRAGMA index_list('nibbler_post')")}
+        connection.close()
+        self.assertIn('ix_nibbler_post_feed_id_guid', indexes)
+        # the guid only index no query used is gone
+        self.assertNotIn('ix_nibbler_post_guid', indexes)
+
+    def test_find_new_guids(self):
+        """Test find_new_guids only returns guids the feed has not stored."""
+        dal = nibbler.nibbler.DatabaseAccess(f'sqlite:///{self.db_file}')
+        dal.session.add(nibbler.nibbler.Feed('AVC', 'https://avc.com/feed'))
+        dal.session.commit()
+        dal.store_posts(self.make_articles(1, ['seen-1', 'seen-2']))
+
+        self.assertEqual({'new-1'}, dal.find_new_guids(1, ['seen-1', 'new-1', 'seen-2']))
+        # the same guid in a different feed is a different post
+        self.assertEqual({'seen-1'}, dal.find_new_guids(2, ['seen-1']))
+        self.assertEqual(set(), dal.find_new_guids(1, []))
+        dal.session.close()
+
+    @patch('nibbler.nibbler.IN_CLAUSE_CHUNK', 2)
+    def test_iter_posts_by_id_groups_by_feed(self):
+        """Test the queued posts load in chunks grouped by feed with the feed title."""
+        dal = nibbler.nibbler.DatabaseAccess(f'sqlite:///{self.db_file}')
+        dal.session.add_all([nibbler.nibbler.Feed('AVC', 'https://avc.com/feed'),
+                             nibbler.nibbler.Feed('Kottke', 'https://kottke.org/feed')])
+        dal.session.commit()
+        dal.store_posts(self.make_articles(2, ['k-1']))
+        dal.store_posts(self.make_articles(1, ['a-1', 'a-2']))
+        dal.store_posts(self.make_articles(2, ['k-2']))
+
+        # a post id that is not stored is skipped
+        articles = list(dal.iter_posts_by_id(dal.pending_post_ids() + [999]))
+
+        self.assertEqual(['a-1', 'a-2', 'k-1', 'k-2'], [article.guid for article in articles])
+        self.assertEqual(['AVC', 'AVC', 'Kottke', 'Kottke'], [article.feed_title for article in articles])
+        # detached, so changing them does not write back
+        articles[0].title = 'changed'
+        dal.session.commit()
+        self.assertEqual('title a-1', stored_post(dal, 'a-1').title)
+        dal.session.close()
+
+    def test_store_posts_in_batches(self):
+        """Test store_posts writes every post across several batches."""
+        dal = nibbler.nibbler.DatabaseAccess(f'sqlite:///{self.db_file}', batch_size=2)
+        dal.session.add(nibbler.nibbler.Feed('AVC', 'https://avc.com/feed'))
+        dal.session.commit()
+
+        stored = dal.store_posts(self.make_articles(1, ['post-1', 'post-2', 'post-3']))
+
+        self.assertEqual(3, stored)
+        self.assertEqual(3, dal.session.query(nibbler.nibbler.Article).count())
+        self.assertEqual('title post-2', stored_post(dal, 'post-2').title)
+        journal_mode = dal.session.execute(text('PRAGMA journal_mode')).scalar()
+        self.assertEqual('wal', journal_mode)
+        dal.session.close()
+
+    def test_load_new_feeds_syncs_subscriptions(self):
+        """Test load_new_feeds adds, deactivates and reactivates feeds and skips unchanged files."""
+        dal = nibbler.nibbler.DatabaseAccess(f'sqlite:///{self.db_file}')
+        acquirer = nibbler.nibbler.FeedAcquirer(dal, NibblerConfig(**dict(self.arguments, sub_dir=self.db_dir.name)))
+        opml_file = os.path.join(self.db_dir.name, 'subscriptions.xml')
+        outline = '<outline text="{0}" type="rss" xmlUrl="https://{0}.example.com/feed"/>'
+
+        def write_subscriptions(*names, mtime):
+            with open(opml_file, 'w') as subscriptions:
+                subscriptions.write('<?xml version="1.0" encoding="UTF-8"?><opml version="2.0"><head/><body>'
+                                    + ''.join(outline.format(name) for name in names) + '</body></opml>')
+            os.utime(opml_file, (mtime, mtime))
+
+        def active_feeds():
+            query = dal.session.query(nibbler.nibbler.Feed.title).filter(nibbler.nibbler.Feed.active.is_(True))
+            return sorted(title for title, in query)
+
+        write_subscriptions('avc', 'kottke', 'avc', mtime=1000)
+        acquirer.load_new_feeds()
+        self.assertEqual(['avc', 'kottke'], active_feeds())
+
+        # an unchanged or only touched file is not parsed again, an edited one is
+        with patch('nibbler.opml.iter_feeds', wraps=nibbler.opml.iter_feeds) as mock_parse:
+            acquirer.load_new_feeds()
+            os.utime(opml_file, (1500, 1500))
+            acquirer.load_new_feeds()
+            mock_parse.assert_not_called()
+            write_subscriptions('kottke', 'avc', mtime=1600)
+            acquirer.load_new_feeds()
+            mock_parse.assert_called_once()
+        self.assertEqual(['avc', 'kottke'], active_feeds())
+
+        write_subscriptions('kottke', mtime=2000)
+        acquirer.load_new_feeds()
+        self.assertEqual(['kottke'], active_feeds())
+        self.assertEqual(2, dal.session.query(nibbler.nibbler.Feed).count())
+
+        write_subscriptions('avc', 'kottke', mtime=3000)
+        acquirer.load_new_feeds()
+        self.assertEqual(['avc', 'kottke'], active_feeds())
+        self.assertEqual(2, dal.session.query(nibbler.nibbler.Feed).count())
+
+        # moving a feed into a folder updates its category
+        with open(opml_file, 'w') as subscriptions:
+            subscriptions.write('<opml version="2.0"><body><outline text="Tech">' + outline.format('kottke')
+                                + '</outline>' + outline.format('avc') + '</body></opml>')
+        acquirer.load_new_feeds()
+        categories = dict(dal.session.query(nibbler.nibbler.Feed.title, nibbler.nibbler.Feed.category))
+        self.assertEqual({'avc': None, 'kottke': 'Tech'}, categories)
+        dal.session.close()
+
+    def test_subscribers_share_feeds_and_get_their_own_newsletter(self):
+        """Test each feed is stored once for all subscribers and every subscriber gets their own queue."""
+        def write_opml(path, body):
+            with open(path, 'w') as opml_file:
+                opml_file.write(f'<opml version="2.0"><body>{body}</body></opml>')
+        outline = '<outline text="{0}" type="rss" xmlUrl="https://{0}.example.com/feed"/>'
+        write_opml(os.path.join(self.db_dir.name, 'subscriptions.xml'), outline.format('avc') + outline.format('kottke'))
+        write_opml(os.path.join(self.db_dir.name, 'ann.xml'),
+                   '<outline text="Culture">' + outline.format('kottke') + '</outline>' + outline.format('waxy'))
+        subscribers_ini = os.path.join(self.db_dir.name, 'subscribers.ini')
+        ann_section = '[ann]\nemail = ann@example.com\nsubscriptions = ann.xml\n'
+        with open(subscribers_ini, 'w') as ini_file:
+            ini_file.write(ann_section)
+        config = NibblerConfig(**dict(self.arguments, sub_dir=self.db_dir.name, email_dir=self.db_dir.name,
+                                      smtp_ini=None, subscribers_ini=subscribers_ini))
+        dal = nibbler.nibbler.DatabaseAccess(f'sqlite:///{self.db_file}')
+        # a post queued before there were subscribers
+        dal.session.add(nibbler.nibbler.Feed('avc', 'https://avc.example.com/feed'))
+        dal.session.commit()
+        articles = self.make_articles(1, ['avc-old'])
+        articles[0].article_text = '<p>old</p>'
+        dal.store_posts(articles)
+
+        nibbler.nibbler.FeedAcquirer(dal, config).load_new_feeds()
+        feeds = {feed.title: feed.feed_id for feed in dal.session.query(nibbler.nibbler.Feed)}
+        self.assertEqual(['avc', 'kottke', 'waxy'], sorted(feeds))
+        articles = self.make_articles(feeds['kottke'], ['kottke-1']) + self.make_articles(feeds['waxy'], ['waxy-1'])
+        for article in articles:
+            article.article_text = f'<p>{article.guid}</p>'
+        dal.store_posts(articles)
+
+        primary, ann = dal.subscribers()
+        self.assertEqual(('primary', 'ann'), (primary.name, ann.name))
+        def guids(post_ids):
+            return [article.guid for article in dal.iter_posts_by_id(post_ids)]
+        self.assertEqual(['avc-old', 'kottke-1'], guids(dal.pending_post_ids(primary)))
+        self.assertEqual(['waxy-1', 'kottke-1'], guids(dal.pending_post_ids(ann)))
+        # unfiled feeds first, then by folder
+        self.assertEqual([None, 'Culture'], [article.feed_category for article in
+                                             dal.iter_posts_by_id(dal.pending_post_ids(ann), ann)])
+
+        newsletter = nibbler.nibbler.NibblerNewsletter(dal, config)
+        newsletter.send_newsletter(ann)
+        self.assertEqual([], dal.pending_post_ids(ann))
+        self.assertEqual(2, len(dal.pending_post_ids(primary)))
+        newsletter.main()
+        self.assertEqual([], dal.pending_post_ids())
+        recipients = set()
+        for name in os.listdir(self.db_dir.name):
+            if name.endswith('.eml'):
+                with open(os.path.join(self.db_dir.name, name), 'rb') as email_file:
+                    recipients.add(email.message_from_binary_file(email_file)['To'])
+        self.assertEqual({'ann@example.com', self.arguments['to_email']}, recipients)
+
+        # dropping ann from the ini file drops the feed only she read
+        with open(subscribers_ini, 'w') as ini_file:
+            ini_file.write('')
+        nibbler.nibbler.FeedAcquirer(dal, config).load_new_feeds()
+        self.assertEqual(['primary'], [subscriber.name for subscriber in dal.subscribers()])
+        active = dal.session.query(nibbler.nibbler.Feed.title).filter(nibbler.nibbler.Feed.active.is_(True))
+        self.assertEqual(['avc', 'kottke'], sorted(title for title, in active))
+        self.assertIsNone(dal.get_setting('opml_signature:ann'))
+        self.assertIsNone(dal.get_setting('opml_sha256:ann'))
+
+        # added back with the same unchanged file, her subscriptions are read again
+        with open(subscribers_ini, 'w') as ini_file:
+            ini_file.write(ann_section)
+        nibbler.nibbler.FeedAcquirer(dal, config).load_new_feeds()
+        ann = dal.subscribers()[1]
+        subscribed = dal.session.query(nibbler.nibbler.Subscription.xmlUrl).filter_by(subscriber_id=ann.subscriber_id)
+        self.assertEqual(2, subscribed.count())
+        active = dal.session.query(nibbler.nibbler.Feed.title).filter(nibbler.nibbler.Feed.active.is_(True))
+        self.assertEqual(['avc', 'kottke', 'waxy'], sorted(title for title, in active))
+        dal.session.close()
+
+    def test_broken_subscriptions_file_skips_only_that_subscriber(self):
+        """Test a malformed subscriptions.xml is logged and the other subscribers still sync."""
+        outline = '<outline text="{0}" type="rss" xmlUrl="https://{0}.example.com/feed"/>'
+        with open(os.path.join(self.db_dir.name, 'subscriptions.xml'), 'w') as opml_file:
+            opml_file.write(f'<opml version="2.0"><body>{outline.format("avc")}</body></opml>')
+        with open(os.path.join(self.db_dir.name, 'bob.xml'), 'w') as opml_file:
+            opml_file.write(f'<opml version="2.0"><body>{outline.format("waxy")}')
+        subscribers_ini = os.path.join(self.db_dir.name, 'subscribers.ini')
+        with open(subscribers_ini, 'w') as ini_file:
+            ini_file.write('[bob]\nemail = bob@example.com\nsubscriptions = bob.xml\n')
+        config = NibblerConfig(**dict(self.arguments, sub_dir=self.db_dir.name, subscribers_ini=subscribers_ini))
+        dal = nibbler.nibbler.DatabaseAccess(f'sqlite:///{self.db_file}')
+
+        with self.assertLogs('nibbler.nibbler', 'ERROR') as logs:
+            nibbler.nibbler.FeedAcquirer(dal, config).load_new_feeds()
+
+        self.assertIn('Could not read the subscriptions of bob', logs.output[0])
+        self.assertEqual(['avc'], [title for title, in dal.session.query(nibbler.nibbler.Feed.title)])
+        # nothing of bob's file is remembered, once fixed it is read again
+        self.assertIsNone(dal.get_setting('opml_sha256:bob'))
+        self.assertIsNone(dal.get_setting('opml_signature:bob'))
+        dal.session.close()
+
+    def test_failing_feeds_are_skipped_and_reported(self):
+        """Test quarantined and backing off feeds are not fetched and show up in the report."""
+        dal = nibbler.nibbler.DatabaseAccess(f'sqlite:///{self.db_file}')
+        now = datetime(2024, 1, 1, 12, 0)
+        healthy = nibbler.nibbler.Feed('AVC', 'https://avc.com/feed')
+        dead = nibbler.nibbler.Feed('Dead', 'https://dead.example.com/feed')
+        dead.quarantined = True
+        dead.consecutive_failures = 10
+        flaky = nibbler.nibbler.Feed('Flaky', 'https://flaky.example.com/feed')
+        flaky.consecutive_failures = 1
+        flaky.backoff_until = now + timedelta(hours=1)
+        dal.session.add_all([healthy, dead, flaky])
+        dal.session.commit()
+
+        self.assertEqual([healthy], dal.fetchable_feeds(now).all())
+        self.assertEqual([healthy, flaky], dal.fetchable_feeds(now + timedelta(hours=2)).all())
+
+        out = io.StringIO()
+        nibbler.nibbler.print_feed_report(dal, out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(3, len(lines))
+        self.assertTrue(lines[1].startswith('quarantined'))
+        self.assertTrue(lines[1].endswith('https://dead.example.com/feed'))
+        self.assertTrue(lines[2].startswith('backing off'))
+        dal.session.close()
+
+    def test_prune_posts_keeps_tombstones_and_queued_posts(self):
+        """Test pruning drops old bodies, keeps guids for dedup and never touches queued posts."""
+        dal = nibbler.nibbler.DatabaseAccess(f'sqlite:///{self.db_file}')
+        dal.session.add(nibbler.nibbler.Feed('AVC', 'https://avc.com/feed'))
+        dal.session.commit()
+        articles = self.make_articles(1, ['old', 'queued-old', 'recent-1', 'recent-2'])
+        for article in articles:
+            article.article_text = '<p>body</p>'
+            article.time_stamp = datetime(2023, 1, 1) if 'old' in article.guid else datetime(2023, 5, 1)
+        dal.store_posts(articles)
+        queued = stored_post(dal, 'queued-old').post_id
+        dal.clear_pending([post_id for post_id in dal.pending_post_ids() if post_id != queued])
+
+        self.assertEqual(1, dal.prune_posts(1, max_age_days=30, now=datetime(2023, 5, 2)))
+        old = dal.session.query(nibbler.nibbler.Article).filter_by(guid='old').one()
+        self.assertIsNone(old.article_text)
+        self.assertIsNone(old.title)
+        self.assertEqual(set(), dal.find_new_guids(1, ['old']))
+        self.assertEqual('<p>body</p>', stored_post(dal, 'queued-old').article_text)
+
+        # only the newest post keeps its content; the queued one is still protected
+        self.assertEqual(1, dal.prune_posts(1, keep_count=1))
+        kept = dal.session.query(nibbler.nibbler.Article).filter(nibbler.nibbler.Article.article_text.is_not(None))
+        self.assertEqual(['queued-old', 'recent-2'], sorted(article.guid for article in kept))
+        dal.session.close()
+
+    def test_compaction_reclaims_space(self):
+        """Test compact mode prunes with per-feed overrides and shrinks the database file."""
+        retention_ini = os.path.join(self.db_dir.name, 'retention.ini')
+        with open(retention_ini, 'w') as ini_file:
+            ini_file.write('[https://kottke.org/feed]\ncount =\n')
+        config = NibblerConfig(**dict(self.arguments, retention_count=0, retention_ini=retention_ini))
+        self.assertEqual((None, 0), config.get_retention('https://avc.com/feed'))
+        self.assertEqual((None, None), config.get_retention('https://kottke.org/feed'))
+
+        dal = nibbler.nibbler.DatabaseAccess(f'sqlite:///{self.db_file}')
+        dal.session.add_all([nibbler.nibbler.Feed('AVC', 'https://avc.com/feed'),
+                             nibbler.nibbler.Feed('Kottke', 'https://kottke.org/feed')])
+        dal.session.commit()
+        for feed_id in (1, 2):
+            articles = self.make_articles(feed_id, [f'{feed_id}-{number}' for number in range(200)])
+            for article in articles:
+                article.article_text = os.urandom(2000).hex()
+            dal.store_posts(articles)
+        dal.clear_pending(dal.pending_post_ids())
+
+        report = nibbler.nibbler.NibblerCompactor(dal, config).main()
+        self.assertEqual(200, report['posts_pruned'])
+        self.assertGreater(report['bytes_reclaimed'], 200 * 4000 * 0.9)
+        self.assertEqual(report['bytes_after'], os.path.getsize(self.db_file))
+        self.assertEqual(2, dal.session.execute(text('PRAGMA auto_vacuum')).scalar())
+        self.assertEqual({'2-0'}, {article.guid for article in stored_posts(dal, ['1-0', '2-0'])
+                                   if article.article_text is not None})
+        dal.session.close()
+
+    def test_article_bodies_are_compressed(self):
+        """Test long bodies are stored compressed, short and legacy ones as text, and all read back the same."""
+        dal = nibbler.nibbler.DatabaseAccess(f'sqlite:///{self.db_file}')
+        dal.session.add(nibbler.nibbler.Feed('AVC', 'https://avc.com/feed'))
+        dal.session.commit()
+        long_body = '<p>Fred Wilson writes every day. ✓</p>' * 200
+        articles = self.make_articles(1, ['long', 'short'])
+        articles[0].article_text = long_body
+        articles[1].article_text = '<p>hi</p>'
+        dal.store_posts(articles)
+        dal.session.execute(text("INSERT INTO nibbler_post (feed_id, guid, article_text) VALUES (1, 'legacy', :body)"),
+                            {'body': long_body})
+        dal.session.commit()
+
+        stored = dict(dal.session.execute(text('SELECT guid, typeof(article_text) FROM nibbler_post')).all())
+        self.assertEqual({'long': 'blob', 'short': 'text', 'legacy': 'text'}, stored)
+        for guid, body in (('long', long_body), ('short', '<p>hi</p>'), ('legacy', long_body)):
+            self.assertEqual(body, stored_post(dal, guid).article_text)
+
+        self.assertEqual(1, dal.compress_bodies(batch_size=1))
+        self.assertEqual('3', dal.get_setting(nibbler.nibbler.COMPRESSED_THROUGH_SETTING))
+        # the next compaction does not read the posts it has already scanned
+        statements = []
+        event.listen(dal.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        self.assertEqual(0, dal.compress_bodies())
+        self.assertFalse([statement for statement in statements if 'typeof' in statement])
+        self.assertEqual('blob', dal.session.execute(
+            text("SELECT typeof(article_text) FROM nibbler_post WHERE guid = 'legacy'")).scalar())
+        dal.session.expire_all()
+        self.assertEqual(long_body, stored_post(dal, 'legacy').article_text)
+        dal.session.close()
+
+    def make_articles(self, feed_id, guids):
+        """Build unsaved articles for the guids."""
+        articles = []
+        for guid in guids:
+            article = nibbler.nibbler.Article()
+            article.feed_id = feed_id
+            article.guid = guid
+            article.title = f'title {guid}'
+            articles.append(article)
+        return articles
+
+    def tearDown(self):
+        """Tear down the test case."""
+        self.db_dir.cleanup()
+
+
 class TestFeedAcquirer(NibblerTestCase):
     """Test the FeedAcquirer class."""
 
@@ -255,8 +835,6 @@ class TestFeedAcquirer(NibblerTestCase):
             article = self.feedacquirer.parse_rss_post(entry)
             self.assertEqual(article_text, article.article_text, msg='{}, {}'.format(article_text, article.article_text))
 
-    #@patch('nibbler.nibbler.DatabaseAccess.is_post_in_db')
-    #@patch('nibbler.nibbler.DatabaseAccess.store_post')
     @patch('nibbler.nibbler.DatabaseAccess')
     def test_store_new_content(self, mock_dal):
         """Test the store_new_content"""
@@ -280,14 +858,180 @@ class TestFeedAcquirer(NibblerTestCase):
         </entry>"""
         feed.feed_id = 1
 
-        mock_dal.is_post_in_db.return_value = False
-        mock_dal.store_post.return_value = True
-        #mock_is_post_in_db.return_value.is_post_in_db.return_value = False # means we will add it
-        #mock_store_post.return_value = True
+        mock_dal.find_new_guids.side_effect = lambda feed_id, guids: set(guids)
         feedacquirer = nibbler.nibbler.FeedAcquirer(mock_dal, NibblerConfig(**self.arguments))
         articles_stored = feedacquirer.store_new_content(feed)
         self.assertEqual("tag:daringfireball.net,2018:/linked//6.35263", articles_stored[0])
 
+    def test_acquire_feeds_stores_every_feed(self):
+        """Test acquire_feeds fetches feeds on worker threads and stores each post."""
+        feed_xml = """
+        <feed xmlns="http://www.w3.org/2005/Atom">
+        <title>Daring Fireball</title>
+        <entry>
+        <title>Daring post {0}</title>
+        <link rel="alternate" type="text/html" href="https://daringfireball.net/linked/{0}"/>
+        <id>tag:daringfireball.net,2018:/linked//{0}</id>
+        <content type="html"><![CDATA[<p>Post {0}</p>]]></content>
+        </entry>
+        </feed>"""
+        feeds = []
+        for feed_id in (1, 2, 3):
+            feed = Mock()
+            feed.feed_id = feed_id
+            feed.xmlUrl = feed_xml.format(feed_id)
+            feed.avg_fetch_latency = None
+            feeds.append(feed)
+        self.dal.find_new_guids.side_effect = lambda feed_id, guids: set(guids)
+
+        self.feedacquirer.acquire_feeds(feeds)
+
+        stored = sorted(post.guid for call in self.dal.store_posts.call_args_list for post in call.args[0])
+        self.assertEqual(['tag:daringfireball.net,2018:/linked//1',
+                          'tag:daringfireball.net,2018:/linked//2',
+                          'tag:daringfireball.net,2018:/linked//3'], stored)
+
+    def test_hung_host_backs_off(self):
+        """Test a host that accepts the connection but never answers times out and backs the feed off."""
+        config = NibblerConfig(**dict(self.arguments, feed_timeout=0.5))
+        # never accepted, the connection sits in the backlog and no response comes
+        with socket.create_server(('127.0.0.1', 0)) as hung:
+            for pooled in (True, False):
+                acquirer = nibbler.nibbler.FeedAcquirer(self.dal, config)
+                feed = nibbler.nibbler.Feed('Hung', f'http://127.0.0.1:{hung.getsockname()[1]}/feed')
+                feed.feed_id = 7
+                if not pooled:
+                    # feedparser's own download, as when a proxy is configured
+                    acquirer._http_pool = Mock(return_value=None)
+                start = time.monotonic()
+                self.assertEqual({feed: []}, acquirer.acquire_feeds([feed]))
+                self.assertLess(time.monotonic() - start, 5)
+                self.assertEqual(1, feed.consecutive_failures)
+                self.assertIsNotNone(feed.backoff_until)
+
+    def test_fetch_error_backs_off(self):
+        """Test a fetch that raises still counts as a failure of the feed."""
+        feed = nibbler.nibbler.Feed('Broken', 'https://broken.example.com/feed')
+        feed.feed_id = 8
+        with patch.object(self.feedacquirer, 'fetch_feed', side_effect=RuntimeError('broken')):
+            self.assertEqual({}, self.feedacquirer.acquire_feeds([feed]))
+        self.assertEqual(1, feed.consecutive_failures)
+        self.assertEqual(timedelta(hours=1), feed.backoff_until - feed.last_fetched)
+        self.dal.session.commit.assert_called()
+
+    def test_store_entries_only_cleans_new_posts(self):
+        """Test store_entries does not clean the html of posts already stored."""
+        test_feed = """
+        <feed xmlns="http://www.w3.org/2005/Atom">
+        <title>Daring Fireball</title>
+        <entry>
+        <title>Old post</title>
+        <link rel="alternate" type="text/html" href="https://daringfireball.net/linked/old"/>
+        <id>old</id>
+        <content type="html"><![CDATA[<p>Old</p>]]></content>
+        </entry>
+        <entry>
+        <title>New post</title>
+        <link rel="alternate" type="text/html" href="https://daringfireball.net/linked/new"/>
+        <id>new</id>
+        <content type="html"><![CDATA[<p>New</p>]]></content>
+        </entry>
+        </feed>"""
+        feed = Mock()
+        feed.feed_id = 1
+        self.dal.find_new_guids.return_value = {'new'}
+        self.feedacquirer.cleaner = Mock()
+        self.feedacquirer.cleaner.normalize.side_effect = lambda html, link: html
+
+        self.feedacquirer.store_entries(feed, feedparser.parse(test_feed))
+
+        self.feedacquirer.cleaner.normalize.assert_called_once_with('<p>New</p>', 'https://daringfireball.net/linked/new')
+        stored = self.dal.store_posts.call_args.args[0]
+        self.assertEqual(['new'], [article.guid for article in stored])
+        self.assertEqual(self.feedacquirer.metrics.counters, {'entries_seen': 2, 'entries_new': 1})
+        self.assertEqual(self.feedacquirer.metrics.stage_calls['clean'], 1)
+
+    def test_normalize_posts_in_process_pool(self):
+        """Test a batch cleaned in the process pool matches cleaning in this process."""
+        test_feed = """
+        <feed xmlns="http://www.w3.org/2005/Atom">
+        <title>Kottke</title>
+        <entry>
+        <title>Images</title>
+        <link rel="alternate" type="text/html" href="https://kottke.org/18/06/images"/>
+        <content type="html"><![CDATA[<p class="x">One<img src="/plus/a.jpg"></p>]]></content>
+        </entry>
+        <entry>
+        <title>Summary</title>
+        <link rel="alternate" type="text/html" href="https://kottke.org/18/06/summary"/>
+        <summary type="html"><![CDATA[<p style="color: red">Two</p>]]></summary>
+        </entry>
+        </feed>"""
+        entries = feedparser.parse(test_feed).entries
+        arguments = dict(self.arguments, clean_processes=2, clean_threshold=1)
+        pooled = nibbler.nibbler.FeedAcquirer(self.dal, NibblerConfig(**arguments))
+        posts = [(pooled.extract_post_identity(entry), entry) for entry in entries]
+
+        try:
+            pooled.normalize_posts(posts)
+            self.assertIsNotNone(pooled._clean_executor)
+        finally:
+            pooled.shutdown_clean_pool()
+        self.assertIsNone(pooled._clean_executor)
+
+        expected = [self.feedacquirer.parse_rss_post(entry).article_text for entry in entries]
+        self.assertEqual(expected, [article.article_text for article, _ in posts])
+        self.assertEqual('<p>One<img src="https://kottke.org/plus/a.jpg"></p>', expected[0])
+
+    def test_store_entries_skips_not_modified_feed(self):
+        """Test store_entries records the 304 and does not look at entries."""
+        feed = Mock()
+        feed.feed_id = 1
+        feed.etag = '"abc"'
+        rss_feed = feedparser.FeedParserDict(status=304, entries=[Mock()])
+
+        self.feedacquirer.store_entries(feed, rss_feed)
+
+        self.assertEqual(304, feed.last_status)
+        self.assertEqual('"abc"', feed.etag)
+        self.dal.find_new_guids.assert_not_called()
+        self.dal.store_posts.assert_not_called()
+
+    def test_store_entries_backs_off_and_quarantines_failing_feed(self):
+        """Test failed fetches back off exponentially, quarantine the feed and reset on success."""
+        acquirer = nibbler.nibbler.FeedAcquirer(self.dal, NibblerConfig(**dict(self.arguments, quarantine_after=3)))
+        feed = nibbler.nibbler.Feed('Dead', 'https://dead.example.com/feed')
+        feed.feed_id = 7
+        failure = feedparser.FeedParserDict(bozo=1, bozo_exception=URLError('timed out'), entries=[])
+
+        acquirer.store_entries(feed, failure, latency=30.0)
+        self.assertEqual(1, feed.consecutive_failures)
+        self.assertEqual(timedelta(hours=1), feed.backoff_until - feed.last_fetched)
+        acquirer.store_entries(feed, failure, latency=10.0)
+        self.assertEqual(timedelta(hours=2), feed.backoff_until - feed.last_fetched)
+        self.assertEqual(26.0, feed.avg_fetch_latency)
+        self.assertFalse(feed.quarantined)
+        acquirer.store_entries(feed, feedparser.FeedParserDict(status=404, entries=[]))
+        self.assertTrue(feed.quarantined)
+        self.assertEqual(3, feed.error_count)
+
+        acquirer.store_entries(feed, feedparser.FeedParserDict(status=304, entries=[]))
+        self.assertEqual(0, feed.consecutive_failures)
+        self.assertIsNone(feed.backoff_until)
+        self.assertEqual(3, feed.error_count)
+
+    def test_store_entries_remembers_validators(self):
+        """Test store_entries keeps the etag and last-modified of a successful fetch."""
+        feed = Mock()
+        feed.feed_id = 1
+        rss_feed = feedparser.FeedParserDict(status=200, etag='"xyz"', modified='Sat, 26 Oct 2018 04:30:33 GMT', entries=[])
+
+        self.feedacquirer.store_entries(feed, rss_feed)
+
+        self.assertEqual(200, feed.last_status)
+        self.assertEqual('"xyz"', feed.etag)
+        self.assertEqual('Sat, 26 Oct 2018 04:30:33 GMT', feed.modified)
+
     def tearDown(self):
         """Tear down the test case."""
         pass
@@ -0,0 +1,57 @@
+"""Test the OPML reader."""
+# python3 library
+import io
+import unittest
+
+# nibbler imports
+from nibbler import opml
+from nibbler.opml import FeedOutline
+
+NESTED_OPML = b"""<?xml version="1.0" encoding="UTF-8"?>
+<opml version="2.0">
+  <head>
+    <title>Reader export</title>
+  </head>
+  <body>
+    <outline text="Tech">
+      <outline text="Blogs">
+        <outline text="Kottke" type="rss" xmlUrl="https://kottke.org/feed"/>
+      </outline>
+      <outline title="AVC" type="rss" xmlUrl="https://avc.com/feed"/>
+    </outline>
+    <outline text="Daring Fireball" type="rss" xmlUrl="https://daringfireball.net/feeds/main"/>
+  </body>
+</opml>"""
+
+EXPECTED_FEEDS = [
+    FeedOutline('Kottke', 'https://kottke.org/feed', 'Tech/Blogs'),
+    FeedOutline('AVC', 'https://avc.com/feed', 'Tech'),
+    FeedOutline('Daring Fireball', 'https://daringfireball.net/feeds/main', None),
+]
+
+
+class TestOpml(unittest.TestCase):
+    """Test the opml module."""
+
+    def test_iter_feeds_walks_folders(self):
+        """Test iter_feeds streams feeds at every depth with their folder path."""
+        self.assertEqual(EXPECTED_FEEDS, list(opml.iter_feeds(io.BytesIO(NESTED_OPML))))
+
+    def test_feeds_is_cached(self):
+        """Test Opml.feeds matches iter_feeds and is only walked once."""
+        outline = opml.from_string(NESTED_OPML)
+        self.assertEqual(EXPECTED_FEEDS, outline.feeds)
+        self.assertIs(outline.feeds, outline.feeds)
+
+    def test_top_level_outlines(self):
+        """Test indexing still returns the top-level outlines."""
+        outline = opml.from_string(NESTED_OPML)
+        self.assertEqual('Reader export', outline.title)
+        self.assertEqual(2, len(outline))
+        self.assertEqual('Tech', outline[0].text)
+        self.assertEqual(2, len(outline[0]))
+        self.assertEqual('https://daringfireball.net/feeds/main', outline[1].xmlUrl)
+
+
+if __name__ == '__main__':
+    unittest.main()
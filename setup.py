@@ -37,6 +37,11 @@ setup(
         "Jinja2==3.1.6",
     ],
 
+    # Optional features, pip install nibbler-rss[images]
+    extras_require={
+        "images": ["Pillow"],
+    },
+
     entry_points={
         'console_scripts': [
             # "name_of_executable = module.with:function_to_execute"